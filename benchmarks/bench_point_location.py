@@ -0,0 +1,66 @@
+"""
+Throughput of locating points in a TreeMesh.
+
+The classes follow the airspeed velocity (asv) conventions, and the file can
+also be run on its own to print the number of points located per second::
+
+    python benchmarks/bench_point_location.py
+"""
+from __future__ import print_function
+import timeit
+
+import numpy as np
+import discretize
+
+
+def _tree_mesh(n_base, dim):
+    # fine cells in nested balls around the center of the mesh
+    mesh = discretize.TreeMesh([n_base]*dim)
+    center = np.full(dim, 0.5)
+    radii = np.linspace(0.25, 0.4, 4)
+    for radius, level in zip(radii, range(mesh.max_level, 0, -1)):
+        mesh.refine_ball(center, radius, level, finalize=False)
+    mesh.finalize()
+    return mesh
+
+
+class TimePointLocation(object):
+    params = ([2, 3], [10**4, 10**6])
+    param_names = ['dim', 'n_points']
+    timeout = 300
+
+    def setup(self, dim, n_points):
+        self.mesh = _tree_mesh(1024 if dim == 2 else 128, dim)
+        rng = np.random.RandomState(0)
+        self.points = rng.rand(n_points, dim)
+
+    def time_get_containing_cell_indexes(self, dim, n_points):
+        self.mesh._get_containing_cell_indexes(self.points)
+
+    def time_point2index(self, dim, n_points):
+        self.mesh.point2index(self.points)
+
+    def time_point2index_sorted(self, dim, n_points):
+        self.mesh.point2index(self.points, sort=True)
+
+
+if __name__ == '__main__':
+    bench = TimePointLocation()
+    methods = [
+        name for name in dir(bench) if name.startswith('time_')
+    ]
+    for dim in TimePointLocation.params[0]:
+        for n_points in TimePointLocation.params[1]:
+            bench.setup(dim, n_points)
+            for name in methods:
+                method = getattr(bench, name)
+                best = min(timeit.repeat(
+                    lambda: method(dim, n_points), number=1, repeat=3
+                ))
+                print(
+                    '{}D, {} cells, {:>8d} points, {:<36s} {:.3e} s, '
+                    '{:.3e} points/s'.format(
+                        dim, bench.mesh.nC, n_points, name[5:], best,
+                        n_points/best
+                    )
+                )
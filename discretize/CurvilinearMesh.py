@@ -8,6 +8,7 @@ from .base import BaseRectangularMesh
 from discretize.DiffOperators import DiffOperators
 from discretize.InnerProducts import InnerProducts
 from discretize.View import CurviView
+from discretize.utils.cacheutils import cached_attributes
 
 
 # Some helper functions.
@@ -27,6 +28,10 @@ def normalize3D(x):
     return x/np.kron(np.ones((1, 3)), utils.mkvc(length3D(x), 2))
 
 
+@cached_attributes(
+    '_gridCC', '_gridFx', '_gridFy', '_gridFz', '_gridEx', '_gridEy',
+    '_gridEz', '_vol', '_area', '_edge'
+)
 class CurvilinearMesh(
     BaseRectangularMesh, DiffOperators, InnerProducts, CurviView
 ):
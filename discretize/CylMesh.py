@@ -12,8 +12,16 @@ from .TensorMesh import BaseTensorMesh, BaseRectangularMesh
 from .InnerProducts import InnerProducts
 from .View import CylView
 from .DiffOperators import DiffOperators
+from .utils.cacheutils import cached_attributes
 
 
+@cached_attributes(
+    '_axis_of_symmetry_EzBool', '_axis_of_symmetry_NBool', '_hangingFxDict',
+    '_hangingFyDict', '_hangingExDict', '_hangingEyDict', '_hangingEzDict',
+    '_hangingNDict', '_ishangingFxBool', '_ishangingFyBool',
+    '_ishangingFzBool', '_ishangingExBool', '_ishangingEyBool',
+    '_ishangingEzBool', '_ishangingNBool'
+)
 class CylMesh(
     BaseTensorMesh, BaseRectangularMesh, InnerProducts, CylView, DiffOperators
 ):
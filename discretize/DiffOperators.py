@@ -1,9 +1,11 @@
 from __future__ import print_function
 import numpy as np
 from scipy import sparse as sp
+from scipy.sparse.linalg import LinearOperator
 from six import string_types
 import warnings
 from discretize.utils import sdiag, speye, kron3, spzeros, ddx, av, av_extrap
+from discretize.utils.cacheutils import cached_attributes
 
 
 def checkBC(bc):
@@ -123,6 +125,109 @@ def ddxCellGradBC(n, bc):
     return D
 
 
+class StencilOperator(LinearOperator):
+    """
+    Matrix-free operator acting on the grids of a tensor product mesh.
+
+    The operator is ``sdiag(left) * A * sdiag(right)`` where ``A`` is a
+    block matrix, laid out as for :func:`scipy.sparse.bmat`. Every block is a
+    :class:`discretize.utils.KronOperator` mapping one input grid to one
+    output grid, so only the 1D stencils and the scaling vectors are stored.
+
+    Parameters
+    ----------
+    blocks : list of list of KronOperator
+        Rows of blocks, ``None`` for an empty block.
+    left, right : numpy.ndarray, optional
+        Diagonal scalings applied after and before the blocks.
+    """
+
+    def __init__(self, blocks, left=None, right=None):
+        self.blocks = [list(row) for row in blocks]
+        self.left = left
+        self.right = right
+        n_rows = [None]*len(self.blocks)
+        n_cols = [None]*max(len(row) for row in self.blocks)
+        for i, row in enumerate(self.blocks):
+            for j, B in enumerate(row):
+                if B is not None:
+                    n_rows[i], n_cols[j] = B.shape
+        if None in n_rows or None in n_cols:
+            raise ValueError("Every row and column needs at least one block")
+        self._row_ptr = np.r_[0, np.cumsum(n_rows)]
+        self._col_ptr = np.r_[0, np.cumsum(n_cols)]
+        dtype = np.result_type(*(
+            [np.float64] +
+            [B.dtype for row in self.blocks for B in row if B is not None]
+        ))
+        super(StencilOperator, self).__init__(
+            dtype=dtype, shape=(int(self._row_ptr[-1]), int(self._col_ptr[-1]))
+        )
+
+    def _apply(self, x, adjoint):
+        x = np.asarray(x)
+        x = np.asarray(x, dtype=np.result_type(x.dtype, self.dtype))
+        if adjoint:
+            src_ptr, dst_ptr = self._row_ptr, self._col_ptr
+            pre, post = self.left, self.right
+        else:
+            src_ptr, dst_ptr = self._col_ptr, self._row_ptr
+            pre, post = self.right, self.left
+        if pre is not None:
+            x = pre[:, None]*x
+        out = np.zeros((dst_ptr[-1], x.shape[1]), dtype=x.dtype)
+        for i, row in enumerate(self.blocks):
+            for j, B in enumerate(row):
+                if B is None:
+                    continue
+                if adjoint:
+                    out[dst_ptr[j]:dst_ptr[j+1]] += B.rmatmat(
+                        x[src_ptr[i]:src_ptr[i+1]]
+                    )
+                else:
+                    out[dst_ptr[i]:dst_ptr[i+1]] += B.matmat(
+                        x[src_ptr[j]:src_ptr[j+1]]
+                    )
+        if post is not None:
+            out *= post[:, None]
+        return out
+
+    def _matmat(self, X):
+        return self._apply(X, adjoint=False)
+
+    def _rmatmat(self, X):
+        return self._apply(X, adjoint=True)
+
+    def _matvec(self, x):
+        return self._apply(np.reshape(x, (-1, 1)), adjoint=False)[:, 0]
+
+    def _rmatvec(self, x):
+        return self._apply(np.reshape(x, (-1, 1)), adjoint=True)[:, 0]
+
+    def tocsr(self):
+        """Build the full sparse matrix"""
+        A = sp.bmat([
+            [None if B is None else B.tocsr() for B in row]
+            for row in self.blocks
+        ], format='csr')
+        if self.left is not None:
+            A = sdiag(self.left)*A
+        if self.right is not None:
+            A = A*sdiag(self.right)
+        return sp.csr_matrix(A)
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+
+@cached_attributes(
+    '_faceDiv', '_faceDivx', '_faceDivy', '_faceDivz', '_nodalGrad',
+    '_nodalLaplacian', '_cellGrad', '_cellGradBC', '_cellGradx',
+    '_cellGrady', '_cellGradz', '_edgeCurl', '_aveF2CC', '_aveF2CCV',
+    '_aveFx2CC', '_aveFy2CC', '_aveFz2CC', '_aveCC2F', '_aveCCV2F',
+    '_aveE2CC', '_aveE2CCV', '_aveEx2CC', '_aveEy2CC', '_aveEz2CC',
+    '_aveN2CC', '_aveN2E', '_aveN2F'
+)
 class DiffOperators(object):
     """
     Class creates the differential operators that you need!
@@ -450,6 +555,18 @@ class DiffOperators(object):
         self._cellGradBC_list = BC
         return BC
 
+    def _cache_variant(self, name):
+        # the cell gradients saved on disk also depend on their boundary
+        # conditions, e.g. 'bc-dn-nn' for [['dirichlet', 'neumann'], 'neumann']
+        if name not in ['_cellGrad', '_cellGradBC']:
+            return None
+        BC = self._cellGradBC_list
+        if isinstance(BC, string_types):
+            BC = [BC]*self.dim
+        return 'bc-' + '-'.join(
+            ''.join(bc_i[0] for bc_i in checkBC(bc)) for bc in BC
+        )
+
     @property
     def _cellGradxStencil(self):
         # TODO: remove this hard-coding
@@ -1002,16 +1119,16 @@ class DiffOperators(object):
         "Construct the averaging operator on cell edges to cell centers."
         if getattr(self, '_aveE2CC', None) is None:
             if self.dim == 1:
-                self._avE2CC = self.aveEx2CC
+                self._aveE2CC = self.aveEx2CC
             elif self.dim == 2:
-                self._avE2CC = 0.5*sp.hstack(
+                self._aveE2CC = 0.5*sp.hstack(
                     (self.aveEx2CC, self.aveEy2CC), format="csr"
                 )
             elif self.dim == 3:
-                self._avE2CC = (1./3)*sp.hstack((
+                self._aveE2CC = (1./3)*sp.hstack((
                     self.aveEx2CC, self.aveEy2CC, self.aveEz2CC
                 ), format="csr")
-        return self._avE2CC
+        return self._aveE2CC
 
     @property
     def aveE2CCV(self):
@@ -106,7 +106,7 @@ class InnerProducts(object):
         if hasattr(self, '_fastInnerProduct') and doFast:
             fast = self._fastInnerProduct(projType, prop=prop, invProp=invProp, invMat=invMat)
         if fast is not None:
-            return fast
+            return self._operator_astype(fast)
 
         if invProp:
             prop = invPropertyTensor(self, prop)
@@ -122,7 +122,7 @@ class InnerProducts(object):
         elif invMat and tensorType == 3:
             raise Exception('Solver needed to invert A.')
 
-        return A
+        return self._operator_astype(A)
 
     def _getInnerProductProjectionMatrices(self, projType, tensorType):
         """
@@ -1,11 +1,12 @@
 from __future__ import print_function
 import numpy as np
+import scipy.sparse as sp
 
 from discretize import utils
 
 from .base import BaseRectangularMesh, BaseTensorMesh
 from .View import TensorView
-from .DiffOperators import DiffOperators
+from .DiffOperators import DiffOperators, StencilOperator, ddxCellGrad
 from .InnerProducts import InnerProducts
 from .MeshIO import TensorMeshIO
 
@@ -346,6 +347,328 @@ class TensorMesh(
             indzu = (self.gridCC[:, 2] == max(self.gridCC[:, 2]))
             return indxd, indxu, indyd, indyu, indzd, indzu
 
+    def get_ray_matrix(self, starts, ends):
+        """Lengths of line segments inside of each cell
+
+        Any part of a segment outside of the mesh is ignored. A segment that
+        runs along a face between two cells is put in the lower cell.
+
+        Parameters
+        ----------
+        starts, ends : array_like of shape (n_rays, dim)
+            The beginning and ending points of the line segments
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix of shape (n_rays, nC)
+            The length of each segment inside of each cell
+
+        Examples
+        --------
+        >>> from discretize import TensorMesh
+        >>> mesh = TensorMesh([16, 16])
+        >>> src = np.c_[np.zeros(10), np.linspace(0, 1, 10)]
+        >>> rec = np.c_[np.ones(10), np.linspace(1, 0, 10)]
+        >>> G = mesh.get_ray_matrix(src, rec)
+        >>> travel_times = G @ np.ones(mesh.nC)
+        """
+        starts = np.atleast_2d(np.asarray(starts, dtype=float))
+        ends = np.atleast_2d(np.asarray(ends, dtype=float))
+        if starts.shape != ends.shape or starts.shape[1] != self.dim:
+            raise ValueError(
+                "starts and ends must both have shape (n_rays, {}), not {} and {}".format(
+                    self.dim, starts.shape, ends.shape)
+            )
+        n_rays = starts.shape[0]
+        nodes = [self.vectorNx, self.vectorNy, self.vectorNz][:self.dim]
+        d = ends - starts
+        length = np.linalg.norm(d, axis=1)
+
+        # clip the segments to the mesh
+        t0 = np.zeros(n_rays)
+        t1 = np.where(length > 0, 1.0, -1.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i, x in enumerate(nodes):
+                flat = d[:, i] == 0
+                ta = (x[0] - starts[:, i])/d[:, i]
+                tb = (x[-1] - starts[:, i])/d[:, i]
+                t0 = np.where(flat, t0, np.maximum(t0, np.minimum(ta, tb)))
+                t1 = np.where(flat, t1, np.minimum(t1, np.maximum(ta, tb)))
+                outside = flat & ((starts[:, i] < x[0]) | (starts[:, i] > x[-1]))
+                t1[outside] = -1.0
+        rays = np.flatnonzero(t0 < t1)
+
+        # the parameters where the segments enter, cross a plane of nodes and
+        # leave the mesh
+        ts = [t0[rays], t1[rays]]
+        ids = [rays, rays]
+        for i, x in enumerate(nodes):
+            r = rays[d[rays, i] != 0]
+            a = starts[r, i] + t0[r]*d[r, i]
+            b = starts[r, i] + t1[r]*d[r, i]
+            lo = np.searchsorted(x, np.minimum(a, b), side='right')
+            hi = np.searchsorted(x, np.maximum(a, b), side='left')
+            counts = np.maximum(hi - lo, 0)
+            r = np.repeat(r, counts)
+            planes = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            planes += np.arange(counts.sum())
+            ts.append((x[planes] - starts[r, i])/d[r, i])
+            ids.append(r)
+        ts = np.concatenate(ts)
+        ids = np.concatenate(ids)
+        order = np.lexsort((ts, ids))
+        ts, ids = ts[order], ids[order]
+
+        # each piece between two crossings lies in one cell
+        keep = (ids[1:] == ids[:-1]) & (ts[1:] > ts[:-1])
+        rows = ids[:-1][keep]
+        mid = starts[rows] + 0.5*(ts[1:] + ts[:-1])[keep, None]*d[rows]
+        inds = [
+            np.clip(np.searchsorted(x, mid[:, i], side='left') - 1, 0, len(x) - 2)
+            for i, x in enumerate(nodes)
+        ]
+        cols = np.ravel_multi_index(inds, self.vnC, order='F')
+        V = (ts[1:] - ts[:-1])[keep]*length[rows]
+        return sp.csr_matrix((V, (rows, cols)), shape=(n_rays, self.nC))
+
+    def get_matrix_free_operator(self, name):
+        """Matrix-free version of a differential or averaging operator
+
+        The returned operator gives the same results as the sparse matrix of
+        the same name, but applies its stencils as strided finite differences
+        on the reshaped grids instead of storing the matrix. It can be used
+        anywhere a :class:`scipy.sparse.linalg.LinearOperator` is accepted,
+        for instance in the iterative solvers of :mod:`scipy.sparse.linalg`.
+
+        Parameters
+        ----------
+        name : str
+            One of ``'faceDiv'``, ``'faceDivx'``, ``'faceDivy'``,
+            ``'faceDivz'``, ``'nodalGrad'``, ``'cellGrad'``, ``'edgeCurl'``,
+            ``'aveF2CC'``, ``'aveF2CCV'``, ``'aveFx2CC'``, ``'aveFy2CC'``,
+            ``'aveFz2CC'``, ``'aveCC2F'``, ``'aveCCV2F'``, ``'aveE2CC'``,
+            ``'aveE2CCV'``, ``'aveEx2CC'``, ``'aveEy2CC'``, ``'aveEz2CC'``,
+            ``'aveN2CC'``, ``'aveN2E'`` or ``'aveN2F'``.
+
+        Returns
+        -------
+        discretize.DiffOperators.StencilOperator
+
+        Examples
+        --------
+        >>> from discretize import TensorMesh
+        >>> mesh = TensorMesh([32, 32, 32])
+        >>> Div = mesh.get_matrix_free_operator('faceDiv')
+        >>> u = np.random.rand(mesh.nF)
+        >>> np.allclose(Div*u, mesh.faceDiv*u)
+        True
+        """
+        dim = self.dim
+        n = list(self.vnC)
+        axes = range(dim)
+        shape_C = n
+        shape_N = [m + 1 for m in n]
+        shape_F = [[m + (j == i) for j, m in enumerate(n)] for i in axes]
+        shape_E = [[m + (j != i) for j, m in enumerate(n)] for i in axes]
+        block = self._kron_block
+
+        def av_all(skip=None):
+            return {j: utils.av(n[j]) for j in axes if j != skip}
+
+        if name == 'faceDiv':
+            return StencilOperator(
+                [[block(shape_F[i], {i: utils.ddx(n[i])}) for i in axes]],
+                left=1./self.vol, right=self.area
+            )
+        if name in ['faceDivx', 'faceDivy', 'faceDivz']:
+            i = 'xyz'.index(name[-1])
+            if i >= dim:
+                return None
+            area = self.r(self.area, 'F', 'F' + name[-1], 'V')
+            return StencilOperator(
+                [[block(shape_F[i], {i: utils.ddx(n[i])})]],
+                left=1./self.vol, right=area
+            )
+        if name == 'nodalGrad':
+            return StencilOperator(
+                [[block(shape_N, {i: utils.ddx(n[i])})] for i in axes],
+                left=1./self.edge
+            )
+        if name == 'cellGrad':
+            BC = self.setCellGradBC(self._cellGradBC_list)
+            V = self.get_matrix_free_operator('aveCC2F')*self.vol
+            return StencilOperator(
+                [[block(shape_C, {i: ddxCellGrad(n[i], BC[i])})] for i in axes],
+                left=self.area/V
+            )
+        if name == 'edgeCurl':
+            if dim == 2:
+                # matches the sparse operator, which scales by 1/area
+                return StencilOperator(
+                    [[
+                        block(shape_E[0], {1: utils.ddx(n[1])}, -1.),
+                        block(shape_E[1], {0: utils.ddx(n[0])})
+                    ]],
+                    right=1./self.area
+                )
+            if dim == 3:
+                # the curl of the i-th component from the k-th edges
+                def curl(i, k):
+                    j = 3 - i - k
+                    sign = 1. if (k - i) % 3 == 2 else -1.
+                    return block(shape_E[k], {j: utils.ddx(n[j])}, sign)
+                return StencilOperator(
+                    [[curl(i, k) if k != i else None for k in axes] for i in axes],
+                    left=1./self.area, right=self.edge
+                )
+            raise ValueError("Edge Curl only programed for 2 or 3D.")
+        if name == 'aveF2CC':
+            return StencilOperator(
+                [[block(shape_F[i], {i: utils.av(n[i])}, 1./dim) for i in axes]]
+            )
+        if name == 'aveF2CCV':
+            return StencilOperator([
+                [block(shape_F[i], {i: utils.av(n[i])}) if j == i else None
+                 for i in axes] for j in axes
+            ])
+        if name in ['aveFx2CC', 'aveFy2CC', 'aveFz2CC']:
+            i = 'xyz'.index(name[4])
+            if i >= dim:
+                return None
+            return StencilOperator([[block(shape_F[i], {i: utils.av(n[i])})]])
+        if name == 'aveCC2F':
+            return self.get_kron_operator('aveCC2F')
+        if name == 'aveCCV2F':
+            return StencilOperator([
+                [block(shape_C, {i: utils.av_extrap(n[i])}) if j == i else None
+                 for j in axes] for i in axes
+            ])
+        if name == 'aveE2CC':
+            return StencilOperator(
+                [[block(shape_E[i], av_all(skip=i), 1./dim) for i in axes]]
+            )
+        if name == 'aveE2CCV':
+            return StencilOperator([
+                [block(shape_E[i], av_all(skip=i)) if j == i else None
+                 for i in axes] for j in axes
+            ])
+        if name in ['aveEx2CC', 'aveEy2CC', 'aveEz2CC']:
+            i = 'xyz'.index(name[4])
+            if i >= dim:
+                return None
+            return StencilOperator([[block(shape_E[i], av_all(skip=i))]])
+        if name == 'aveN2CC':
+            return StencilOperator([[block(shape_N, av_all())]])
+        if name == 'aveN2E':
+            return self.get_kron_operator('aveN2E')
+        if name == 'aveN2F':
+            if dim == 1:
+                # the sparse operator averages to cell centers in 1D
+                return self.get_matrix_free_operator('aveN2CC')
+            return StencilOperator(
+                [[block(shape_N, av_all(skip=i))] for i in axes]
+            )
+        raise ValueError(
+            "No matrix-free version of the operator '{}'".format(name)
+        )
+
+    def _kron_block(self, shape, stencils, coefficient=1.):
+        """KronOperator of 1D stencils acting on a grid of the given shape
+
+        stencils maps an axis to its 1D matrix, the grid is unchanged along
+        the other axes. The coefficient is folded into one of the factors.
+        """
+        factors = [stencils.get(i, m) for i, m in enumerate(shape)]
+        if coefficient != 1.:
+            i = min(stencils) if stencils else 0
+            f = factors[i]
+            factors[i] = coefficient*(utils.speye(f) if i not in stencils else f)
+        return utils.KronOperator(*factors[::-1])
+
+    def get_kron_operator(self, name):
+        """Kronecker factored version of an operator
+
+        Operators of a tensor mesh that act along each axis independently
+        are Kronecker products of 1D matrices. This returns them as a
+        :class:`discretize.utils.KronOperator` that keeps the 1D factors,
+        which is cheap to build and to apply on large grids. The sparse
+        matrix is built only when calling its ``tocsr`` method. Operators
+        stacking one product per axis, ``'aveCC2F'`` and ``'aveN2E'``, are
+        returned as a :class:`discretize.DiffOperators.StencilOperator` with
+        a KronOperator block for each axis.
+
+        Parameters
+        ----------
+        name : str
+            One of ``'faceDivx'``, ``'faceDivy'``, ``'faceDivz'``,
+            ``'cellGradx'``, ``'cellGrady'``, ``'cellGradz'``,
+            ``'_nodalGradStencilx'``, ``'_nodalGradStencily'``,
+            ``'_nodalGradStencilz'``, ``'aveFx2CC'``, ``'aveFy2CC'``,
+            ``'aveFz2CC'``, ``'aveEx2CC'``, ``'aveEy2CC'``, ``'aveEz2CC'``,
+            ``'aveN2CC'``, ``'aveCC2F'`` or ``'aveN2E'``. Other operators
+            that stack several components, like ``faceDiv``, are available
+            from :meth:`get_matrix_free_operator`.
+
+        Returns
+        -------
+        discretize.utils.KronOperator or discretize.DiffOperators.StencilOperator
+
+        Examples
+        --------
+        >>> from discretize import TensorMesh
+        >>> mesh = TensorMesh([64, 64, 64])
+        >>> Av = mesh.get_kron_operator('aveN2CC')
+        >>> phi = np.random.rand(mesh.nN)
+        >>> np.allclose(Av*phi, mesh.aveN2CC*phi)
+        True
+        """
+        n = list(self.vnC)
+        axes = range(self.dim)
+        shape_N = [m + 1 for m in n]
+        if name in [
+            'faceDivx', 'faceDivy', 'faceDivz', 'cellGradx', 'cellGrady',
+            'cellGradz', 'aveFx2CC', 'aveFy2CC', 'aveFz2CC',
+            '_nodalGradStencilx', '_nodalGradStencily', '_nodalGradStencilz'
+        ]:
+            i = 'xyz'.index(name[-1] if name[0] != 'a' else name[4])
+            if i >= self.dim:
+                return None
+            h = self.h[i]
+            if name.startswith('faceDiv'):
+                return self._kron_block(
+                    n, {i: utils.sdiag(1./h)*utils.ddx(n[i])}
+                )
+            if name.startswith('cellGrad'):
+                # same hard-coded neumann condition as the sparse operator
+                G = ddxCellGrad(n[i], ['neumann', 'neumann'])
+                return self._kron_block(
+                    n, {i: utils.sdiag(1./(utils.av_extrap(n[i])*h))*G}
+                )
+            if name.startswith('_nodalGrad'):
+                return self._kron_block(shape_N, {i: utils.ddx(n[i])})
+            return self._kron_block(n, {i: utils.av(n[i])})
+        if name in ['aveEx2CC', 'aveEy2CC', 'aveEz2CC']:
+            i = 'xyz'.index(name[4])
+            if i >= self.dim:
+                return None
+            return self._kron_block(
+                [m + (j != i) for j, m in enumerate(n)],
+                {j: utils.av(n[j]) for j in axes if j != i}
+            )
+        if name == 'aveN2CC':
+            return self._kron_block(shape_N, {j: utils.av(n[j]) for j in axes})
+        if name == 'aveCC2F':
+            return StencilOperator(
+                [[self._kron_block(n, {i: utils.av_extrap(n[i])})] for i in axes]
+            )
+        if name == 'aveN2E':
+            return StencilOperator(
+                [[self._kron_block(shape_N, {i: utils.av(n[i])})] for i in axes]
+            )
+        raise ValueError(
+            "The operator '{}' is not a Kronecker product".format(name)
+        )
+
     def _repr_attributes(self):
         """Attributes for the representation of the mesh."""
 
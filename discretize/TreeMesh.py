@@ -85,6 +85,7 @@
 #      |___________|         |___> x
 #      0    e3     1
 
+import base64
 import properties
 
 from .base import BaseTensorMesh
@@ -98,6 +99,7 @@ import scipy.sparse as sp
 from six import integer_types
 
 from discretize.utils.codeutils import requires
+from discretize.utils.cacheutils import cached_attributes, operator_cache
 # matplotlib is a soft dependencies for discretize
 try:
     import matplotlib.pyplot as plt
@@ -106,14 +108,34 @@ except ImportError:
     matplotlib = False
 
 
+@cached_attributes(
+    '_gridhN', '_gridhEx', '_gridhEy', '_gridhEz', '_gridhFx', '_gridhFy',
+    '_gridhFz', '_h_gridded', '_aveFx2CC', '_aveFy2CC', '_aveFz2CC',
+    '_aveF2CC', '_aveF2CCV', '_aveN2CC', '_aveN2E', '_aveN2Ex', '_aveN2Ey',
+    '_aveN2Ez', '_aveN2F', '_aveN2Fx', '_aveN2Fy', '_aveN2Fz', '_aveEx2CC',
+    '_aveEy2CC', '_aveEz2CC', '_aveE2CC', '_aveE2CCV', '_aveCC2F',
+    '_aveCCV2F', '_aveCC2Fx', '_aveCC2Fy', '_aveCC2Fz', '_faceDiv',
+    '_faceDivx', '_faceDivy', '_faceDivz', '_edgeCurl', '_nodalGrad',
+    '_cellGradStencil', '_cellGrad', '_cellGradx', '_cellGrady', '_cellGradz',
+    '_cell_nodes', '_cell_edges', '_cell_faces', '_cell_neighbors',
+    '_face_cells', '_edge_nodes', '_cell_adjacency', '_cellGradxStencilMat',
+    '_cellGradyStencilMat', '_cellGradzStencilMat', '_deflate_edges_x_mat',
+    '_deflate_edges_y_mat', '_deflate_edges_z_mat', '_deflate_faces_x_mat',
+    '_deflate_faces_y_mat', '_deflate_faces_z_mat', '_deflate_nodes_mat'
+)
 class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
     """
     TreeMesh is a class for adaptive QuadTree (2D) and OcTree (3D) meshes.
+
+    The optional ordering ('default', 'morton' or 'hilbert') sets how the
+    cells, nodes, edges and faces are numbered once the mesh is finalized.
+    The space filling curve orderings keep items that are close in space
+    close in the numbering, which narrows the bandwidth of the operators.
     """
     _meshType = 'TREE'
 
     #inheriting stuff from BaseTensorMesh that isn't defined in _QuadTree
-    def __init__(self, h=None, x0=None, **kwargs):
+    def __init__(self, h=None, x0=None, ordering='default', **kwargs):
         if 'h' in kwargs.keys():
             h = kwargs.pop('h')
         if 'x0' in kwargs.keys():
@@ -128,9 +150,18 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
         if not (is_pow2(nx) and is_pow2(ny) and is_pow2(nz)):
             raise ValueError("length of cell width vectors must be a power of 2")
         # Now can initialize cpp tree parent
-        _TreeMesh.__init__(self, self.h, self.x0)
-
-        if 'cell_levels' in kwargs.keys() and 'cell_indexes' in kwargs.keys():
+        _TreeMesh.__init__(self, self.h, self.x0, ordering)
+
+        if 'tree_structure' in kwargs.keys():
+            structure = kwargs.pop('tree_structure')
+            tree_format = kwargs.pop('tree_format', self._tree_format)
+            if tree_format != self._tree_format:
+                raise ValueError(
+                    "Unknown tree_format {}, this version of discretize reads "
+                    "{}".format(tree_format, self._tree_format)
+                )
+            self.__setstate__(base64.b64decode(structure))
+        elif 'cell_levels' in kwargs.keys() and 'cell_indexes' in kwargs.keys():
             inds = kwargs.pop('cell_indexes')
             levels = kwargs.pop('cell_levels')
             self.__setstate__((inds, levels))
@@ -256,6 +287,9 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
     @properties.validator('x0')
     def _x0_validator(self, change):
         self._set_x0(change['value'])
+        # the slice meshes were made at the old origin
+        self._slices = {}
+        operator_cache(self)._fingerprint = None
 
     @property
     def vntF(self):
@@ -267,6 +301,22 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
         """Total number of hanging and non-hanging edges in a [nx,ny,nz] form"""
         return [self.ntEx, self.ntEy] + ([] if self.dim == 2 else [self.ntEz])
 
+    def _clear_cache(self):
+        _TreeMesh._clear_cache(self)
+        # the operators that are cached on the python side
+        self._cellGradStencil = None
+        self._cellGrad = None
+        self._cellGradx = None
+        self._cellGrady = None
+        self._cellGradz = None
+        self._faceDivx = None
+        self._faceDivy = None
+        self._faceDivz = None
+        # the 2D meshes of the slices used by plotSlice
+        self._slices = {}
+        # the structure changed, so must the fingerprint
+        operator_cache(self).clear()
+
     @property
     def cellGradStencil(self):
         if getattr(self, '_cellGradStencil', None) is None:
@@ -414,7 +464,7 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
             self._faceDivz = self.faceDiv[:, self.nFx+self.nFy:]
         return self._faceDivz
 
-    def point2index(self, locs):
+    def point2index(self, locs, sort=False):
         """Finds cells that contain the given points.
         Returns an array of index values of the cells that contain the given
         points
@@ -423,6 +473,9 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
         ----------
         locs: array_like of shape (N, dim)
             points to search for the location of
+        sort: bool, optional
+            search the points in Morton order of their location, which can be
+            faster for large scattered sets of points on large meshes
 
         Returns
         -------
@@ -430,7 +483,7 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
             Cell indices that contain the points
         """
         locs = utils.asArray_N_x_Dim(locs, self.dim)
-        inds = self._get_containing_cell_indexes(locs)
+        inds = self._get_containing_cell_indexes(locs, sort=sort)
         return inds
 
     def cell_levels_by_index(self, indices):
@@ -547,7 +600,6 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
             gridOpts = {'color': 'k', 'alpha': 0.5}
         vTypeOpts = ['CC', 'N', 'F', 'E', 'Fx', 'Fy', 'Fz', 'E', 'Ex', 'Ey', 'Ez']
         viewOpts = ['real', 'imag', 'abs']
-        normalOpts = ['X', 'Y', 'Z']
         if vType not in vTypeOpts:
             raise ValueError(
                 "vType must be in ['{0!s}']".format("', '".join(vTypeOpts))
@@ -564,52 +616,16 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
             raise ValueError(
                 "view must be in ['{0!s}']".format("', '".join(viewOpts))
             )
-        normal = normal.upper()
-        if normal not in normalOpts:
-            raise ValueError(
-                "normal must be in ['{0!s}']".format("', '".join(normalOpts))
-            )
-
         if not isinstance(grid, bool):
             raise TypeError('grid must be a boolean')
 
+        normal = normal.upper()
+        temp_mesh, ind_3d_to_2d = self.get_slice(normal, ind)
         normalInd = {'X': 0, 'Y': 1, 'Z': 2}[normal]
-        antiNormalInd = {'X': [1, 2], 'Y': [0, 2], 'Z': [0, 1]}[normal]
-
-        h2d = (self.h[antiNormalInd[0]], self.h[antiNormalInd[1]])
-        x2d = (self.x0[antiNormalInd[0]], self.x0[antiNormalInd[1]])
-
-        #: Size of the sliced dimension
-        szSliceDim = len(self.h[normalInd])
         if ind is None:
-            ind = int(szSliceDim//2)
-
-        cc_tensor = [None, None, None]
-        for i in range(3):
-            cc_tensor[i] = np.cumsum(np.r_[self.x0[i], self.h[i]])
-            cc_tensor[i] = (cc_tensor[i][1:] + cc_tensor[i][:-1])*0.5
-        slice_loc = cc_tensor[normalInd][ind]
-
-        if type(ind) not in integer_types:
-            raise ValueError('ind must be an integer')
-
-        # create a temporary TreeMesh with the slice through
-        temp_mesh = TreeMesh(h2d, x2d)
-        level_diff = self.max_level - temp_mesh.max_level
-
-        XS = [None, None, None]
-        XS[antiNormalInd[0]], XS[antiNormalInd[1]] = np.meshgrid(cc_tensor[antiNormalInd[0]],
-                                                                 cc_tensor[antiNormalInd[1]])
-        XS[normalInd] = np.ones_like(XS[antiNormalInd[0]])*slice_loc
-        loc_grid = np.c_[XS[0].reshape(-1), XS[1].reshape(-1), XS[2].reshape(-1)]
-        inds = np.unique(self._get_containing_cell_indexes(loc_grid))
-
-        grid2d = self.gridCC[inds][:, antiNormalInd]
-        levels = self._cell_levels_by_indexes(inds) - level_diff
-        temp_mesh.insert_cells(grid2d, levels)
-        tm_gridboost = np.empty((temp_mesh.nC, 3))
-        tm_gridboost[:, antiNormalInd] = temp_mesh.gridCC
-        tm_gridboost[:, normalInd] = slice_loc
+            ind = int(len(self.h[normalInd])//2)
+        cc_normal = np.cumsum(np.r_[self.x0[normalInd], self.h[normalInd]])
+        slice_loc = 0.5*(cc_normal[1:] + cc_normal[:-1])[ind]
 
         # interpolate values to self.gridCC if not 'CC'
         if vType is not 'CC':
@@ -628,8 +644,7 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
                 v = v[i_s[vec_ind]:i_s[vec_ind+1]]
                 v = Av*v
 
-        # interpolate values from self.gridCC to grid2d
-        ind_3d_to_2d = self._get_containing_cell_indexes(tm_gridboost)
+        # values from self.gridCC on the cells of the slice
         v2d = v[ind_3d_to_2d]
 
         if ax is None:
@@ -656,17 +671,117 @@ class TreeMesh(_TreeMesh, BaseTensorMesh, InnerProducts, TreeMeshIO):
             plt.show()
         return tuple(out)
 
-    def serialize(self):
-        serial = BaseTensorMesh.serialize(self)
-        inds, levels = self.__getstate__()
-        serial['cell_indexes'] = inds.tolist()
-        serial['cell_levels'] = levels.tolist()
+    def get_slice(self, normal='Z', ind=None):
+        """The 2D TreeMesh of a slice through the cell centers of this mesh
+
+        The slice meshes are cached by (normal, ind), so repeatedly plotting
+        the same slice, e.g. for every time step, only indexes the values.
+
+        Parameters
+        ----------
+        normal : {'X', 'Y', 'Z'}
+            The direction normal to the slice
+        ind : int, optional
+            The index of the slice along the base tensor cells in the normal
+            direction, defaults to the middle
+
+        Returns
+        -------
+        slice_mesh : TreeMesh
+            The 2D mesh of the cells intersected by the slice
+        index : numpy.ndarray of int
+            The index of the 3D cell for every cell of slice_mesh, so that
+            ``v[index]`` are the cell centered values ``v`` on the slice
+
+        Examples
+        --------
+        >>> slice_mesh, index = mesh.get_slice('X', 4)
+        >>> slice_mesh.plotImage(model[index])
+        """
+        if self.dim != 3:
+            raise NotImplementedError('Must be a 3D mesh.')
+        normalOpts = ['X', 'Y', 'Z']
+        normal = normal.upper()
+        if normal not in normalOpts:
+            raise ValueError(
+                "normal must be in ['{0!s}']".format("', '".join(normalOpts))
+            )
+        normalInd = {'X': 0, 'Y': 1, 'Z': 2}[normal]
+        antiNormalInd = {'X': [1, 2], 'Y': [0, 2], 'Z': [0, 1]}[normal]
+
+        #: Size of the sliced dimension
+        szSliceDim = len(self.h[normalInd])
+        if ind is None:
+            ind = int(szSliceDim//2)
+        if type(ind) not in integer_types:
+            raise ValueError('ind must be an integer')
+        if (normal, ind) in self._slices:
+            return self._slices[(normal, ind)]
+
+        h2d = (self.h[antiNormalInd[0]], self.h[antiNormalInd[1]])
+        x2d = (self.x0[antiNormalInd[0]], self.x0[antiNormalInd[1]])
+
+        cc_tensor = [None, None, None]
+        for i in range(3):
+            cc_tensor[i] = np.cumsum(np.r_[self.x0[i], self.h[i]])
+            cc_tensor[i] = (cc_tensor[i][1:] + cc_tensor[i][:-1])*0.5
+        slice_loc = cc_tensor[normalInd][ind]
+
+        # create a temporary TreeMesh with the slice through
+        temp_mesh = TreeMesh(h2d, x2d)
+        level_diff = self.max_level - temp_mesh.max_level
+
+        XS = [None, None, None]
+        XS[antiNormalInd[0]], XS[antiNormalInd[1]] = np.meshgrid(cc_tensor[antiNormalInd[0]],
+                                                                 cc_tensor[antiNormalInd[1]])
+        XS[normalInd] = np.ones_like(XS[antiNormalInd[0]])*slice_loc
+        loc_grid = np.c_[XS[0].reshape(-1), XS[1].reshape(-1), XS[2].reshape(-1)]
+        inds = np.unique(self._get_containing_cell_indexes(loc_grid))
+
+        grid2d = self.gridCC[inds][:, antiNormalInd]
+        levels = self._cell_levels_by_indexes(inds) - level_diff
+        temp_mesh.insert_cells(grid2d, levels)
+        tm_gridboost = np.empty((temp_mesh.nC, 3))
+        tm_gridboost[:, antiNormalInd] = temp_mesh.gridCC
+        tm_gridboost[:, normalInd] = slice_loc
+
+        # the cells of self containing the cell centers of the slice
+        ind_3d_to_2d = self._get_containing_cell_indexes(tm_gridboost)
+        self._slices[(normal, ind)] = (temp_mesh, ind_3d_to_2d)
+        return temp_mesh, ind_3d_to_2d
+
+    #: Version of the compact tree_structure serialization
+    _tree_format = 1
+
+    def serialize(self, compact=False, **kwargs):
+        """Serialize the mesh to a dictionary
+
+        By default the cells are listed under ``cell_indexes`` and
+        ``cell_levels``, which every version of discretize can read. With
+        ``compact=True`` they are replaced by the refinement bitstream of the
+        tree, base64 encoded under ``tree_structure`` next to its
+        ``tree_format`` version. It is much smaller and faster to load, but
+        only versions of discretize that know the format can read it.
+        """
+        serial = BaseTensorMesh.serialize(self, **kwargs)
+        if compact:
+            structure = self._get_structure()
+            serial['tree_structure'] = base64.b64encode(structure).decode('ascii')
+            serial['tree_format'] = self._tree_format
+        else:
+            inds, levels = self.__getstate__()
+            serial['cell_indexes'] = inds.tolist()
+            serial['cell_levels'] = levels.tolist()
+        serial['ordering'] = self.ordering
         return serial
 
+    def _fingerprint_serial(self):
+        return self.serialize(compact=True)
+
     @classmethod
-    def deserialize(cls, serial):
+    def deserialize(cls, serial, **kwargs):
         mesh = cls(**serial)
         return mesh
 
     def __reduce__(self):
-        return TreeMesh, (self.h, self.x0), self.__getstate__()
+        return TreeMesh, (self.h, self.x0, self.ordering), self._get_structure()
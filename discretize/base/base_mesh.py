@@ -6,8 +6,10 @@ import numpy as np
 import properties
 import os
 import json
+import hashlib
 
 from ..utils import mkvc
+from ..utils.cacheutils import operator_cache
 from ..mixins import InterfaceMixins
 
 
@@ -111,6 +113,8 @@ class BaseMesh(properties.HasProperties, InterfaceMixins):
                 "Dimension mismatch. x0 has length {} != len(n) which is "
                 "{}".format(len(x0), len(n))
             )
+        # the fingerprint covers the origin
+        operator_cache(self)._fingerprint = None
 
     @property
     def dim(self):
@@ -415,6 +419,178 @@ class BaseMesh(properties.HasProperties, InterfaceMixins):
         """
         return properties.copy(self)
 
+    #: Byte budget given to the operator cache of new meshes, None for no limit
+    default_cache_budget = None
+
+    @property
+    def cache_budget(self):
+        """
+        Number of bytes the cached operators and geometry of this mesh may
+        use. Past it the least recently used ones are dropped, and built
+        again when next needed. None (the default) means no limit.
+        """
+        return operator_cache(self).budget
+
+    @cache_budget.setter
+    def cache_budget(self, value):
+        cache = operator_cache(self)
+        cache.budget = None if value is None else int(value)
+        cache.evict()
+
+    def cache_info(self):
+        """
+        Describe what the mesh has cached.
+
+        Returns a dictionary with the ``budget``, the total ``nbytes`` in use,
+        the number of lookups served from the cache (``hits``), of lookups
+        that had to build the value (``misses``), the number of
+        ``evictions``, the :attr:`cache_dir` as ``directory``, the number of
+        operators loaded from and saved to it (``disk_loads`` and
+        ``disk_saves``) and the cached ``entries``. Entries map each name, from
+        least to most recently used, to its ``nbytes``, ``hits`` and
+        ``misses``.
+
+        .. code:: python
+
+            mesh.faceDiv
+            mesh.cache_info()['entries']['faceDiv']['nbytes']
+        """
+        return operator_cache(self).info()
+
+    def clear_cache(self, pattern=None):
+        """
+        Drop the cached operators whose name matches the glob ``pattern``,
+        such as ``'ave*'``, or all of them when ``pattern`` is None.
+        """
+        operator_cache(self).clear(pattern)
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the geometry of the mesh.
+
+        It is the sha256 hex digest of the serialized mesh, so it covers the
+        cell widths ``h``, the origin ``x0``, the orientation and, for a
+        TreeMesh, the tree structure and ordering. Identical meshes have the
+        same fingerprint in every process and session.
+
+        .. code:: python
+
+            mesh = discretize.TensorMesh([8, 8])
+            mesh.fingerprint == discretize.TensorMesh([8, 8]).fingerprint
+        """
+        cache = operator_cache(self)
+        if cache._fingerprint is None:
+            serial = json.dumps(self._fingerprint_serial(), sort_keys=True)
+            cache._fingerprint = hashlib.sha256(serial.encode()).hexdigest()
+        return cache._fingerprint
+
+    def _fingerprint_serial(self):
+        # the serialization that the fingerprint is the hash of
+        return self.serialize()
+
+    #: Directory of the on disk operator cache of new meshes, None to disable
+    default_cache_dir = None
+
+    @property
+    def cache_dir(self):
+        """
+        Directory of the on disk operator cache, None (the default) disables
+        it.
+
+        Sparse operators (faceDiv, edgeCurl, aveE2CCV, aveCC2F, the TreeMesh
+        deflation matrices, ...) built by this mesh are saved there as
+        ``.npy`` arrays under its :attr:`fingerprint`. A mesh with the same
+        fingerprint, in this or a later process, memory maps them instead of
+        building them again. The mapped arrays are copy-on-write, so the
+        files are never modified. Operators that also depend on other
+        settings, like the boundary conditions of ``cellGrad``, are saved
+        apart for each setting.
+
+        .. code:: python
+
+            mesh.cache_dir = '/scratch/discretize_cache'
+            mesh.faceDiv  # built and saved
+            other = discretize.TensorMesh(mesh.h, mesh.x0)
+            other.cache_dir = '/scratch/discretize_cache'
+            other.faceDiv  # memory mapped from the saved arrays
+        """
+        return operator_cache(self).directory
+
+    @cache_dir.setter
+    def cache_dir(self, value):
+        operator_cache(self).directory = (
+            None if value is None else os.path.abspath(value)
+        )
+
+    #: Type of the values of the sparse operators of new meshes
+    default_operator_dtype = None
+
+    #: Type of the indices of the sparse operators of new meshes
+    default_index_dtype = None
+
+    @property
+    def operator_dtype(self):
+        """
+        Type of the values of the sparse operators and inner product
+        matrices of the mesh, such as ``numpy.float32``. None (the default)
+        keeps the float64 values they are built with.
+
+        Single precision halves the memory of the values and speeds up the
+        memory bound sparse products, which is enough for preconditioners.
+        The geometry (``vol``, ``area``, grids, ...) stays in double
+        precision.
+
+        Setting it converts the cached operators, except when going back to
+        a wider type or to None, which drops the rounded operators so that
+        they are built again at full precision.
+
+        .. code:: python
+
+            mesh.operator_dtype = np.float32
+            mesh.index_dtype = np.int32
+            mesh.faceDiv.dtype, mesh.faceDiv.indices.dtype
+        """
+        return operator_cache(self).dtype
+
+    @operator_dtype.setter
+    def operator_dtype(self, value):
+        if value is not None:
+            value = np.dtype(value)
+            if not np.issubdtype(value, np.inexact):
+                raise ValueError(
+                    "operator_dtype must be a floating point type, not "
+                    "{}".format(value)
+                )
+        cache = operator_cache(self)
+        cache.dtype = value
+        cache.convert()
+
+    @property
+    def index_dtype(self):
+        """
+        Type of the indices of the sparse operators and inner product
+        matrices of the mesh, ``numpy.int32`` or ``numpy.int64``. None (the
+        default) lets scipy choose, which is int32 when it fits.
+        """
+        return operator_cache(self).index_dtype
+
+    @index_dtype.setter
+    def index_dtype(self, value):
+        if value is not None:
+            value = np.dtype(value)
+            if value not in [np.int32, np.int64]:
+                raise ValueError(
+                    "index_dtype must be int32 or int64, not {}".format(value)
+                )
+        cache = operator_cache(self)
+        cache.index_dtype = value
+        cache.convert()
+
+    def _operator_astype(self, A):
+        # sparse matrices that are not cached, with the operator types
+        return operator_cache(self).astype(A)
+
     axis_u = properties.Vector3(
         'Vector orientation of u-direction. For more details see the docs for the :attr:`~discretize.base.BaseMesh.rotation_matrix` property.',
         default='X',
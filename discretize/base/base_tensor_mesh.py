@@ -8,7 +8,13 @@ import properties
 
 from .base_mesh import BaseMesh
 from .. import utils
+from ..utils.cacheutils import cached_attributes
 
+@cached_attributes(
+    '_gridCC', '_gridN', '_gridFx', '_gridFy', '_gridFz', '_gridEx',
+    '_gridEy', '_gridEz', '_vol', '_area', '_edge', '_areaFx', '_areaFy',
+    '_areaFz', '_edgeEx', '_edgeEy', '_edgeEz'
+)
 class BaseTensorMesh(BaseMesh):
     """
     Base class for tensor-product style meshes
@@ -200,8 +200,7 @@ class InterfaceVTK(object):
         vtkPts = _vtk.vtkPoints()
         vtkPts.SetData(_nps.numpy_to_vtk(ptsMat, deep=True))
         # Cells
-        cellArray = [c for c in mesh]
-        cellConn = np.array([cell.nodes for cell in cellArray])
+        cellConn = mesh.cell_nodes
         cellsMat = np.concatenate((np.ones((cellConn.shape[0], 1), dtype=int)*cellConn.shape[1], cellConn), axis=1).ravel()
         cellsArr = _vtk.vtkCellArray()
         cellsArr.SetNumberOfCells(cellConn.shape[0])
@@ -211,7 +210,7 @@ class InterfaceVTK(object):
         output.SetPoints(vtkPts)
         output.SetCells(VTK_CELL_TYPE, cellsArr)
         # Add the level of refinement as a cell array
-        cell_levels = np.array([cell._level for cell in cellArray])
+        cell_levels = np.atleast_1d(mesh._cell_levels_by_indexes(np.arange(mesh.nC)))
         refineLevelArr = _nps.numpy_to_vtk(cell_levels, deep=1)
         refineLevelArr.SetName('octreeLevel')
         output.GetCellData().AddArray(refineLevelArr)
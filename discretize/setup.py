@@ -1,8 +1,25 @@
 import os
 import os.path
+import sys
 base_path = os.path.abspath(os.path.dirname(__file__))
 
 
+def openmp_flags():
+    """Compile and link flags for OpenMP
+
+    Set DISCRETIZE_NO_OPENMP to build without it, in which case the tree is
+    finalized and its operators are assembled on a single thread.
+    """
+    if os.environ.get('DISCRETIZE_NO_OPENMP'):
+        return [], []
+    if sys.platform == 'win32':
+        return ['/openmp'], []
+    if sys.platform == 'darwin':
+        # Apple's clang does not ship with OpenMP
+        return [], []
+    return ['-fopenmp'], ['-fopenmp']
+
+
 def configuration(parent_package='', top_path=None):
     from numpy.distutils.misc_util import Configuration, get_numpy_include_dirs
     config = Configuration('discretize', parent_package, top_path)
@@ -14,10 +31,13 @@ def configuration(parent_package='', top_path=None):
     except ImportError:
         pass
 
+    compile_args, link_args = openmp_flags()
     config.add_extension(
         ext,
         sources=[ext+'.cpp', 'tree.cpp'],
-        include_dirs=[get_numpy_include_dirs()]
+        include_dirs=[get_numpy_include_dirs()],
+        extra_compile_args=compile_args,
+        extra_link_args=link_args
     )
 
     config.add_subpackage('utils')
@@ -1,8 +1,12 @@
 #include <vector>
-#include <map>
+#include <unordered_map>
 #include "tree.h"
 #include <iostream>
 #include <algorithm>
+#include <cmath>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 Node::Node(){
     location_ind[0] = 0;
@@ -133,51 +137,425 @@ Face::Face(Node& p1, Node& p2, Node& p3, Node& p4){
     edges[3] = NULL;
 }
 
+// number of nodes in each of the blocks new nodes are taken from
+static const int_t NODE_BLOCK_SIZE = 4096;
+
+NodeMap::NodeMap(){
+  n_used = 0;
+}
+
+NodeMap::~NodeMap(){
+  release_blocks();
+}
+
+Node * NodeMap::create(int_t x, int_t y, int_t z, double *xs, double *ys, double *zs){
+  if(blocks.empty() || n_used == NODE_BLOCK_SIZE){
+    blocks.push_back(new Node[NODE_BLOCK_SIZE]);
+    n_used = 0;
+  }
+  Node *point = &blocks.back()[n_used++];
+  *point = Node(x, y, z, xs, ys, zs);
+  emplace(point->key, point);
+  return point;
+}
+
+void NodeMap::release_blocks(){
+  for(int_t i = 0; i < blocks.size(); ++i)
+    delete[] blocks[i];
+  blocks.clear();
+  n_used = 0;
+}
+
 Node * set_default_node(node_map_t& nodes, int_t x, int_t y, int_t z,
                         double *xs, double *ys, double *zs){
   int_t key = key_func(x, y, z);
-  Node * point;
-  if(nodes.count(key) == 0){
-    point = new Node(x, y, z, xs, ys, zs);
-    nodes[key] = point;
+  node_it_type it = nodes.find(key);
+  if(it != nodes.end()){
+    return it->second;
   }
-  else{
-    point = nodes[key];
+  return nodes.create(x, y, z, xs, ys, zs);
+}
+
+template <class T>
+bool key_less(const T *item, int_t key){
+  return item->key < key;
+}
+
+template <class T>
+bool item_key_less(const T *a, const T *b){
+  return a->key < b->key;
+}
+
+template <class T>
+T * find_by_key(std::vector<T *>& items, int_t key){
+  // items must be sorted by key
+  typename std::vector<T *>::iterator it;
+  it = std::lower_bound(items.begin(), items.end(), key, key_less<T>);
+  if(it != items.end() && (*it)->key == key){
+    return *it;
   }
-  return point;
+  return NULL;
 }
 
-Edge * set_default_edge(edge_map_t& edges, Node& p1, Node& p2){
-  int_t xC = (p1.location_ind[0]+p2.location_ind[0])/2;
-  int_t yC = (p1.location_ind[1]+p2.location_ind[1])/2;
-  int_t zC = (p1.location_ind[2]+p2.location_ind[2])/2;
-  int_t key = key_func(xC, yC, zC);
-  Edge * edge;
-  if(edges.count(key) == 0){
-    edge = new Edge(p1, p2);
-    edges[key] = edge;
+int num_threads(){
+#ifdef _OPENMP
+  return omp_get_max_threads();
+#else
+  return 1;
+#endif
+}
+
+template <class T, class Compare>
+void parallel_sort(std::vector<T>& items, Compare comp){
+  // Sort equal chunks on each thread, then merge neighbouring chunks pairwise.
+  // Without OpenMP this is just a std::sort.
+  long long n = items.size();
+  int n_chunks = num_threads();
+  if(n_chunks < 2 || n < 4096){
+    std::sort(items.begin(), items.end(), comp);
+    return;
   }
-  else{
-    edge = edges[key];
+  std::vector<long long> bounds(n_chunks + 1);
+  for(int c = 0; c <= n_chunks; ++c) bounds[c] = n*c/n_chunks;
+  #pragma omp parallel for schedule(static, 1)
+  for(int c = 0; c < n_chunks; ++c){
+    std::sort(items.begin() + bounds[c], items.begin() + bounds[c+1], comp);
   }
-  return edge;
-};
+  for(int step = 1; step < n_chunks; step *= 2){
+    #pragma omp parallel for schedule(static, 1)
+    for(int c = 0; c < n_chunks - step; c += 2*step){
+      int c_end = std::min(c + 2*step, n_chunks);
+      std::inplace_merge(items.begin() + bounds[c],
+                         items.begin() + bounds[c + step],
+                         items.begin() + bounds[c_end], comp);
+    }
+  }
+}
+
+template <class T>
+void parallel_sort(std::vector<T>& items){
+  parallel_sort(items, std::less<T>());
+}
 
-Face * set_default_face(face_map_t& faces, Node& p1, Node& p2, Node& p3, Node& p4){
-    int_t x, y, z, key;
-    x = (p1.location_ind[0]+p2.location_ind[0]+p3.location_ind[0]+p4.location_ind[0])/4;
-    y = (p1.location_ind[1]+p2.location_ind[1]+p3.location_ind[1]+p4.location_ind[1])/4;
-    z = (p1.location_ind[2]+p2.location_ind[2]+p3.location_ind[2]+p4.location_ind[2])/4;
-    key = key_func(x, y, z);
-    Face * face;
-    if(faces.count(key) == 0){
-        face = new Face(p1, p2, p3, p4);
-        faces[key] = face;
+template <class T>
+void number_items(std::vector<T *>& items, int_t n_hanging){
+  // Non hanging items are numbered first, followed by the hanging items, each
+  // in list order. Every thread counts the non hanging items in its chunk so
+  // that the chunks can then be numbered independently.
+  long long n = items.size();
+  int n_chunks = num_threads();
+  std::vector<long long> bounds(n_chunks + 1), n_regular(n_chunks + 1, 0);
+  for(int c = 0; c <= n_chunks; ++c) bounds[c] = n*c/n_chunks;
+  #pragma omp parallel for schedule(static, 1)
+  for(int c = 0; c < n_chunks; ++c){
+    for(long long i = bounds[c]; i < bounds[c+1]; ++i)
+      if(!items[i]->hanging) ++n_regular[c+1];
+  }
+  for(int c = 0; c < n_chunks; ++c) n_regular[c+1] += n_regular[c];
+  #pragma omp parallel for schedule(static, 1)
+  for(int c = 0; c < n_chunks; ++c){
+    int_t ii = n_regular[c];
+    int_t ih = (n - n_hanging) + (bounds[c] - n_regular[c]);
+    for(long long i = bounds[c]; i < bounds[c+1]; ++i){
+      if(items[i]->hanging){
+        items[i]->index = ih;
+        ++ih;
+      }else{
+        items[i]->index = ii;
+        ++ii;
+      }
     }
-    else{
-        face = faces[key];
+  }
+}
+
+int_t curve_code(const int_t *ind, int_t n_dim, int_t n_bits, int ordering){
+  // Position of the integer location ind along a Morton or Hilbert curve
+  // through a grid of 2^n_bits points per side.
+  int_t X[3] = {ind[0], ind[1], (n_dim == 3)? ind[2] : 0};
+  int_t code = 0;
+  if(ordering == ORDER_MORTON){
+    // x varies fastest, matching the order of a cell's children
+    for(int_t b = n_bits; b-- > 0;)
+      for(int_t i = n_dim; i-- > 0;)
+        code = (code << 1) | ((X[i] >> b) & 1);
+    return code;
+  }
+  // Skilling's transform of the axes into the transposed Hilbert index
+  int_t M = (int_t) 1 << (n_bits - 1);
+  for(int_t Q = M; Q > 1; Q >>= 1){
+    int_t P = Q - 1;
+    for(int_t i = 0; i < n_dim; ++i){
+      if(X[i] & Q){
+        X[0] ^= P;
+      }else{
+        int_t t = (X[0] ^ X[i]) & P;
+        X[0] ^= t;
+        X[i] ^= t;
+      }
+    }
+  }
+  for(int_t i = 1; i < n_dim; ++i) X[i] ^= X[i-1];
+  int_t t = 0;
+  for(int_t Q = M; Q > 1; Q >>= 1)
+    if(X[n_dim-1] & Q) t ^= Q - 1;
+  for(int_t i = 0; i < n_dim; ++i) X[i] ^= t;
+  for(int_t b = n_bits; b-- > 0;)
+    for(int_t i = 0; i < n_dim; ++i)
+      code = (code << 1) | ((X[i] >> b) & 1);
+  return code;
+}
+
+template <class T>
+void curve_sort(std::vector<T *>& items, int_t n_dim, int_t n_bits, int ordering){
+  // Every cell of the tree covers a contiguous piece of either curve, so
+  // sorting by the code of each item's location keeps neighbours together.
+  long long n = items.size();
+  std::vector<std::pair<int_t, T *> > codes(n);
+  #pragma omp parallel for
+  for(long long i = 0; i < n; ++i)
+    codes[i] = std::make_pair(curve_code(items[i]->location_ind, n_dim, n_bits, ordering), items[i]);
+  parallel_sort(codes);
+  #pragma omp parallel for
+  for(long long i = 0; i < n; ++i)
+    items[i] = codes[i].second;
+}
+
+template <class T>
+void number_ordered(std::vector<T *>& items, int_t n_hanging,
+                    int_t n_dim, int_t n_bits, int ordering){
+  // items must stay in key order, so a curve ordering numbers a sorted copy
+  if(ordering == ORDER_DEFAULT){
+    number_items(items, n_hanging);
+    return;
+  }
+  std::vector<T *> ordered(items);
+  curve_sort(ordered, n_dim, n_bits, ordering);
+  number_items(ordered, n_hanging);
+}
+
+void sorted_nodes(node_map_t& nodes, node_vec_t& out){
+  out.clear();
+  out.reserve(nodes.size());
+  for(node_it_type it = nodes.begin(); it != nodes.end(); ++it){
+    out.push_back(it->second);
+  }
+  parallel_sort(out, item_key_less<Node>);
+}
+
+Ball::Ball(){
+    n_dim = 0;
+    x0[0] = x0[1] = x0[2] = 0.0;
+    r = 0.0;
+    rsq = 0.0;
+}
+
+Ball::Ball(int_t dim, double *x, double rad){
+    n_dim = dim;
+    x0[2] = 0.0;
+    for(int_t i = 0; i < n_dim; ++i)
+        x0[i] = x[i];
+    r = rad;
+    rsq = rad*rad;
+}
+
+void Ball::bounds(double *lo, double *hi) const{
+    for(int_t i = 0; i < n_dim; ++i){
+        lo[i] = x0[i] - r;
+        hi[i] = x0[i] + r;
+    }
+}
+
+bool Ball::intersects_cell(double *a, double *b) const{
+    // squared distance from the center to the closest point in the box
+    double dsq = 0.0;
+    for(int_t i = 0; i < n_dim; ++i){
+        double d = std::max(a[i], std::min(x0[i], b[i])) - x0[i];
+        dsq += d*d;
+    }
+    return dsq <= rsq;
+}
+
+Box::Box(){
+    n_dim = 0;
+    for(int_t i = 0; i < 3; ++i){
+        x0[i] = 0.0;
+        x1[i] = 0.0;
+    }
+}
+
+Box::Box(int_t dim, double *p0, double *p1){
+    n_dim = dim;
+    x0[2] = x1[2] = 0.0;
+    for(int_t i = 0; i < n_dim; ++i){
+        x0[i] = std::min(p0[i], p1[i]);
+        x1[i] = std::max(p0[i], p1[i]);
+    }
+}
+
+void Box::bounds(double *lo, double *hi) const{
+    for(int_t i = 0; i < n_dim; ++i){
+        lo[i] = x0[i];
+        hi[i] = x1[i];
+    }
+}
+
+bool Box::intersects_cell(double *a, double *b) const{
+    // Boxes must overlap with a non-zero extent, unless they are flat along
+    // an axis, so that cells only touching the box are left alone.
+    for(int_t i = 0; i < n_dim; ++i){
+        if(x0[i] == x1[i]){
+            if(x0[i] < a[i] || x0[i] > b[i]) return false;
+        }else if(x0[i] >= b[i] || x1[i] <= a[i]){
+            return false;
+        }
+    }
+    return true;
+}
+
+Line::Line(){
+    n_dim = 0;
+    for(int_t i = 0; i < 3; ++i){
+        x0[i] = 0.0;
+        x1[i] = 0.0;
+    }
+}
+
+Line::Line(int_t dim, double *p0, double *p1){
+    n_dim = dim;
+    x0[2] = x1[2] = 0.0;
+    for(int_t i = 0; i < n_dim; ++i){
+        x0[i] = p0[i];
+        x1[i] = p1[i];
+    }
+}
+
+void Line::bounds(double *lo, double *hi) const{
+    for(int_t i = 0; i < n_dim; ++i){
+        lo[i] = std::min(x0[i], x1[i]);
+        hi[i] = std::max(x0[i], x1[i]);
+    }
+}
+
+bool Line::intersects_cell(double *a, double *b) const{
+    // clip the segment's parametric range against each slab of the box
+    double t0 = 0.0, t1 = 1.0;
+    for(int_t i = 0; i < n_dim; ++i){
+        double d = x1[i] - x0[i];
+        if(d == 0.0){
+            if(x0[i] < a[i] || x0[i] > b[i]) return false;
+            continue;
+        }
+        double ta = (a[i] - x0[i])/d;
+        double tb = (b[i] - x0[i])/d;
+        if(ta > tb) std::swap(ta, tb);
+        t0 = std::max(t0, ta);
+        t1 = std::min(t1, tb);
+        if(t0 > t1) return false;
+    }
+    return true;
+}
+
+Triangle::Triangle(){
+    n_dim = 0;
+    for(int_t i = 0; i < 3; ++i){
+        x0[i] = 0.0;
+        x1[i] = 0.0;
+        x2[i] = 0.0;
+        padding[i] = 0.0;
+    }
+}
+
+Triangle::Triangle(int_t dim, double *p0, double *p1, double *p2, double *pad){
+    n_dim = dim;
+    for(int_t i = 0; i < 3; ++i){
+        x0[i] = 0.0;
+        x1[i] = 0.0;
+        x2[i] = 0.0;
+        padding[i] = 0.0;
+    }
+    for(int_t i = 0; i < n_dim; ++i){
+        x0[i] = p0[i];
+        x1[i] = p1[i];
+        x2[i] = p2[i];
+        padding[i] = pad[i];
     }
-    return face;
+}
+
+void Triangle::bounds(double *lo, double *hi) const{
+    for(int_t i = 0; i < n_dim; ++i){
+        lo[i] = std::min(x0[i], std::min(x1[i], x2[i])) - padding[i];
+        hi[i] = std::max(x0[i], std::max(x1[i], x2[i])) + padding[i];
+    }
+}
+
+inline bool separated(double *axis, double *v0, double *v1, double *v2, double *h){
+    // Is the axis a separating axis of the triangle and the (centered) box?
+    double p0 = 0.0, p1 = 0.0, p2 = 0.0, r = 0.0;
+    for(int_t i = 0; i < 3; ++i){
+        p0 += axis[i]*v0[i];
+        p1 += axis[i]*v1[i];
+        p2 += axis[i]*v2[i];
+        r += std::abs(axis[i])*h[i];
+    }
+    return (std::min(p0, std::min(p1, p2)) > r ||
+            std::max(p0, std::max(p1, p2)) < -r);
+}
+
+bool Triangle::intersects_cell(double *a, double *b) const{
+    // Separating axis test of the triangle against the cell, after the cell
+    // has been grown by the padding.
+    double h[3] = {0.0, 0.0, 0.0};
+    double v0[3] = {0.0, 0.0, 0.0};
+    double v1[3] = {0.0, 0.0, 0.0};
+    double v2[3] = {0.0, 0.0, 0.0};
+    for(int_t i = 0; i < n_dim; ++i){
+        double c = 0.5*(a[i] + b[i]);
+        h[i] = 0.5*(b[i] - a[i]) + padding[i];
+        v0[i] = x0[i] - c;
+        v1[i] = x1[i] - c;
+        v2[i] = x2[i] - c;
+    }
+    // box axes
+    for(int_t i = 0; i < n_dim; ++i){
+        if(std::min(v0[i], std::min(v1[i], v2[i])) > h[i] ||
+           std::max(v0[i], std::max(v1[i], v2[i])) < -h[i]){
+            return false;
+        }
+    }
+    double e[3][3];
+    for(int_t i = 0; i < 3; ++i){
+        e[0][i] = v1[i] - v0[i];
+        e[1][i] = v2[i] - v1[i];
+        e[2][i] = v0[i] - v2[i];
+    }
+    double axis[3];
+    if(n_dim == 2){
+        // edge normals
+        for(int_t j = 0; j < 3; ++j){
+            axis[0] = -e[j][1];
+            axis[1] = e[j][0];
+            axis[2] = 0.0;
+            if(separated(axis, v0, v1, v2, h)) return false;
+        }
+        return true;
+    }
+    // triangle normal
+    axis[0] = e[0][1]*e[1][2] - e[0][2]*e[1][1];
+    axis[1] = e[0][2]*e[1][0] - e[0][0]*e[1][2];
+    axis[2] = e[0][0]*e[1][1] - e[0][1]*e[1][0];
+    if(separated(axis, v0, v1, v2, h)) return false;
+    // cross products of the box axes with the edges
+    for(int_t j = 0; j < 3; ++j){
+        for(int_t i = 0; i < 3; ++i){
+            double u[3] = {0.0, 0.0, 0.0};
+            u[i] = 1.0;
+            axis[0] = u[1]*e[j][2] - u[2]*e[j][1];
+            axis[1] = u[2]*e[j][0] - u[0]*e[j][2];
+            axis[2] = u[0]*e[j][1] - u[1]*e[j][0];
+            if(separated(axis, v0, v1, v2, h)) return false;
+        }
+    }
+    return true;
 }
 
 Cell::Cell(Node *pts[8], int_t ndim, int_t maxlevel, function func){
@@ -209,6 +587,7 @@ Cell::Cell(Node *pts[8], int_t ndim, int_t maxlevel, function func){
 };
 
 Cell::Cell(Node *pts[8], Cell *parent){
+    this->parent = parent;
     n_dim = parent->n_dim;
     int_t n_points = 1<<n_dim;
     for(int_t i = 0; i < n_points; ++i)
@@ -561,16 +940,206 @@ void Cell::build_cell_vector(cell_vec_t& cells){
     }
 }
 
-Cell* Cell::containing_cell(double x, double y, double z){
+void Cell::write_structure(std::vector<unsigned char>& bits){
+    // One entry per cell in depth first order, 1 if the cell is divided.
+    // Cells at the max level can never be divided, so they are left out.
+    if(level == max_level){
+        return;
+    }
+    bits.push_back(!is_leaf());
     if(is_leaf()){
-      return this;
+        return;
+    }
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        children[i]->write_structure(bits);
+    }
+}
+
+void Cell::read_structure(node_map_t& nodes, const unsigned char *bits, int_t n_bits, int_t& pos,
+                          double *xs, double *ys, double *zs){
+    // Rebuilds the cells written by write_structure. The tree it came from
+    // was balanced, so the cells are divided without balancing them again.
+    if(level == max_level){
+        return;
+    }
+    if(pos >= n_bits){
+        // ran out of bits, flag it by moving past the end
+        pos = n_bits + 1;
+        return;
     }
-    int ix = x > children[0]->points[3]->location[0];
-    int iy = y > children[0]->points[3]->location[1];
-    int iz = n_dim>2 && z>children[0]->points[7]->location[2];
-    return children[ix + 2*iy + 4*iz]->containing_cell(x, y, z);
+    if(!bits[pos++]){
+        return;
+    }
+    divide(nodes, xs, ys, zs, true, false);
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        children[i]->read_structure(nodes, bits, n_bits, pos, xs, ys, zs);
+    }
+}
+
+void Cell::relink_points(std::vector<Node>& pool){
+    // the index of each old node is the position of its copy in the pool
+    for(int_t i = 0; i < (1<<n_dim); ++i)
+        points[i] = &pool[points[i]->index];
+    if(is_leaf()){
+        return;
+    }
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        children[i]->relink_points(pool);
+    }
+}
+
+void Cell::clear_parent_index(){
+    // leaves keep their index, every cell above them goes back to -1
+    if(is_leaf()){
+        return;
+    }
+    index = -1;
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        children[i]->clear_parent_index();
+    }
+}
+
+bool Cell::can_merge(){
+    // A cell can take back its children if they are all leaves, and if no
+    // leaf across its faces would then be more than one level finer than it.
+    if(is_leaf()){
+        return false;
+    }
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        if(!children[i]->is_leaf()) return false;
+    }
+    for(int_t i = 0; i < 2*n_dim; ++i){
+        Cell *other = neighbors[i];
+        if(other == NULL || other->level != level || other->is_leaf()) continue;
+        for(int_t j = 0; j < (1<<n_dim); ++j){
+            Cell *child = other->children[j];
+            Cell *across = child->neighbors[i^1];
+            if(across != NULL && across->parent == this && !child->is_leaf())
+                return false;
+        }
+    }
+    return true;
+}
+
+void Cell::merge(node_map_t& nodes){
+    // Undoes spawn. The children are deleted and the nodes that only they
+    // used are dropped from the map, their storage is reclaimed when the tree
+    // is next finalized. The cells that pointed at them now point at this cell.
+    // The nodes spawn created, as (child, point) pairs, and their references.
+    static const int_t new_nodes_2d[5][3] = {
+        {0, 1, 2}, {0, 2, 2}, {0, 3, 4}, {1, 3, 2}, {2, 3, 2}
+    };
+    static const int_t new_nodes_3d[19][3] = {
+        {0, 1, 2}, {0, 2, 2}, {0, 3, 4}, {1, 3, 2}, {2, 3, 2},
+        {0, 4, 2}, {0, 5, 4}, {1, 5, 2}, {0, 6, 4}, {0, 7, 8},
+        {1, 7, 4}, {2, 6, 2}, {2, 7, 4}, {3, 7, 2},
+        {4, 5, 2}, {4, 6, 2}, {4, 7, 4}, {5, 7, 2}, {6, 7, 2}
+    };
+    for(int_t i = 0; i < 2*n_dim; ++i){
+        Cell *other = neighbors[i];
+        if(other == NULL || other->level != level || other->is_leaf()) continue;
+        for(int_t j = 0; j < (1<<n_dim); ++j){
+            Cell *child = other->children[j];
+            Cell *across = child->neighbors[i^1];
+            if(across != NULL && across->parent == this)
+                child->neighbors[i^1] = this;
+        }
+    }
+    int_t n_new = (n_dim == 3)? 19 : 5;
+    for(int_t i = 0; i < n_new; ++i){
+        const int_t *item = (n_dim == 3)? new_nodes_3d[i] : new_nodes_2d[i];
+        Node *node = children[item[0]]->points[item[1]];
+        node->reference -= item[2];
+        if(node->reference == 0)
+            nodes.erase(node->key);
+    }
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        delete children[i];
+        children[i] = NULL;
+    }
+}
+
+int Cell::coarsen(node_map_t& nodes, int *levels,
+                  std::unordered_map<Cell *, int>& merged, bool& changed){
+    // Returns the finest level wanted by the leaves below this cell. Leaves
+    // with an index look it up in levels, leaves made by merging remember it.
+    if(is_leaf()){
+        if(index >= 0) return levels[index];
+        return merged[this];
+    }
+    int want = 0;
+    for(int_t i = 0; i < (1<<n_dim); ++i){
+        want = std::max(want, children[i]->coarsen(nodes, levels, merged, changed));
+    }
+    if(want <= (int) level && can_merge()){
+        for(int_t i = 0; i < (1<<n_dim); ++i)
+            merged.erase(children[i]);
+        merge(nodes);
+        merged[this] = want;
+        changed = true;
+    }
+    return want;
+}
+
+Cell* Cell::containing_cell(double x, double y, double z){
+    Cell *cell = this;
+    while(!cell->is_leaf()){
+        Cell *child = cell->children[0];
+        int ix = x > child->points[3]->location[0];
+        int iy = y > child->points[3]->location[1];
+        int iz = n_dim>2 && z>child->points[7]->location[2];
+        cell = cell->children[ix + 2*iy + 4*iz];
+    }
+    return cell;
 };
 
+Cell* Cell::leaf_toward(double *p, double *d){
+    // The leaf containing p, breaking ties on a cell boundary toward the
+    // direction d
+    Cell *cell = this;
+    while(!cell->is_leaf()){
+        double *split = cell->children[0]->points[(1<<n_dim) - 1]->location;
+        int_t ind = 0;
+        for(int_t i = 0; i < n_dim; ++i){
+            if(p[i] > split[i] || (p[i] == split[i] && d[i] > 0)){
+                ind += 1<<i;
+            }
+        }
+        cell = cell->children[ind];
+    }
+    return cell;
+}
+
+void Cell::transfer(Cell *other, bool nearest, std::vector<long long>& rows,
+                    std::vector<long long>& cols, std::vector<double>& vals){
+    // Pairs the leaves below this cell with the leaves below other, a cell of
+    // another tree over the same roots where one of the two covers the other.
+    // Each pair is the leaf of other, the leaf below this, and the fraction of
+    // the leaf of other that it fills. With nearest, each leaf of other is
+    // paired only with the leaf containing its center.
+    if(other->is_leaf()){
+        if(nearest || is_leaf()){
+            Cell *source = containing_cell(other->location[0], other->location[1], other->location[2]);
+            rows.push_back(other->index);
+            cols.push_back(source->index);
+            vals.push_back(nearest? 1.0 : std::min(source->volume, other->volume)/other->volume);
+            return;
+        }
+        for(int_t i = 0; i < (1<<n_dim); ++i){
+            children[i]->transfer(other, nearest, rows, cols, vals);
+        }
+    }else if(is_leaf()){
+        for(int_t i = 0; i < (1<<n_dim); ++i){
+            transfer(other->children[i], nearest, rows, cols, vals);
+        }
+    }else{
+        // both are divided, so they cover the same space
+        for(int_t i = 0; i < (1<<n_dim); ++i){
+            children[i]->transfer(other->children[i], nearest, rows, cols, vals);
+        }
+    }
+}
+
 Cell::~Cell(){
         if(is_leaf()){
             return;
@@ -586,12 +1155,17 @@ Tree::Tree(){
     nz = 0;
     n_dim = 0;
     max_level = 0;
+    ordering = ORDER_DEFAULT;
 };
 
 void Tree::set_dimension(int_t dim){
     n_dim = dim;
 }
 
+void Tree::set_ordering(int order){
+    ordering = order;
+}
+
 void Tree::set_levels(int_t l_x, int_t l_y, int_t l_z){
     int_t min_l = std::min(l_x, l_y);
     if(n_dim == 3) min_l = std::min(min_l, l_z);
@@ -660,9 +1234,8 @@ void Tree::initialize_roots(){
             for(int_t iy = 0; iy<ny_roots+1; ++iy){
                 points[iz][iy].resize(nx_roots+1);
                 for(int_t ix = 0; ix<nx_roots+1; ++ix){
-                    points[iz][iy][ix] = new Node(ixs[ix], iys[iy], izs[iz],
-                                                  xs, ys, zs);
-                    nodes[points[iz][iy][ix]->key] = points[iz][iy][ix];
+                    points[iz][iy][ix] = nodes.create(ixs[ix], iys[iy], izs[iz],
+                                                      xs, ys, zs);
                 }
             }
         }
@@ -715,21 +1288,55 @@ void Tree::initialize_roots(){
 
 void Tree::insert_cell(double *new_center, int_t p_level){
     // find containing root
-    int_t ix = 0;
-    int_t iy = 0;
-    int_t iz = 0;
-    while (new_center[0]>=xs[ixs[ix+1]] && ix<nx_roots-1){
-        ++ix;
+    int_t ix = find_root(xs, ixs, nx_roots, new_center[0]);
+    int_t iy = find_root(ys, iys, ny_roots, new_center[1]);
+    int_t iz = (n_dim == 3)? find_root(zs, izs, nz_roots, new_center[2]) : 0;
+    roots[iz][iy][ix]->insert_cell(nodes, new_center, p_level, xs, ys, zs);
+}
+
+void Tree::coarsen(int *levels){
+    // Merges cells whose leaves all want to be at the cell's level or coarser.
+    // A merge can allow a neighbor to merge on the next pass, so the passes
+    // repeat until nothing changes. The leaves must be numbered, with every
+    // cell above them at an index of -1.
+    std::unordered_map<Cell *, int> merged;
+    bool changed = true;
+    while(changed){
+        changed = false;
+        for(int_t iz=0; iz<nz_roots; ++iz)
+            for(int_t iy=0; iy<ny_roots; ++iy)
+                for(int_t ix=0; ix<nx_roots; ++ix)
+                    roots[iz][iy][ix]->coarsen(nodes, levels, merged, changed);
     }
-    while (new_center[1]>=ys[iys[iy+1]] && iy<ny_roots-1){
-        ++iy;
+}
+
+void Tree::refine_ball(double *centers, double *radii, int *levels, int_t n_balls){
+    for(int_t i = 0; i < n_balls; ++i){
+        Ball ball(n_dim, centers + i*n_dim, radii[i]);
+        refine_geom(ball, levels[i]);
     }
-    if(n_dim == 3){
-        while(new_center[2]>=zs[izs[iz+1]] && iz<nz_roots-1){
-            ++iz;
-        }
+}
+
+void Tree::refine_box(double *x0s, double *x1s, int *levels, int_t n_boxes){
+    for(int_t i = 0; i < n_boxes; ++i){
+        Box box(n_dim, x0s + i*n_dim, x1s + i*n_dim);
+        refine_geom(box, levels[i]);
+    }
+}
+
+void Tree::refine_line(double *path, int *levels, int_t n_segments){
+    for(int_t i = 0; i < n_segments; ++i){
+        Line line(n_dim, path + i*n_dim, path + (i + 1)*n_dim);
+        refine_geom(line, levels[i]);
+    }
+}
+
+void Tree::refine_triangle(double *triangles, int *levels, double *padding, int_t n_triangles){
+    for(int_t i = 0; i < n_triangles; ++i){
+        double *tri = triangles + 3*i*n_dim;
+        Triangle triangle(n_dim, tri, tri + n_dim, tri + 2*n_dim, padding + i*n_dim);
+        refine_geom(triangle, levels[i]);
     }
-    roots[iz][iy][ix]->insert_cell(nodes, new_center, p_level, xs, ys, zs);
 }
 
 void Tree::build_tree_from_function(function test_func){
@@ -745,99 +1352,176 @@ void Tree::build_tree_from_function(function test_func){
                 roots[iz][iy][ix]->divide(nodes, xs, ys, zs);
 };
 
-void Tree::finalize_lists(){
+void Tree::write_structure(std::vector<unsigned char>& bits){
     for(int_t iz=0; iz<nz_roots; ++iz)
         for(int_t iy=0; iy<ny_roots; ++iy)
             for(int_t ix=0; ix<nx_roots; ++ix)
-                roots[iz][iy][ix]->build_cell_vector(cells);
-    if(n_dim == 3){
-        // Generate Faces and edges
-        for(std::vector<Cell *>::size_type i = 0; i != cells.size(); i++){
-            Cell *cell = cells[i];
-            Node *p[8];
-            for(int_t it = 0; it < 8; ++it)
-                p[it] = cell->points[it];
-
-            Edge *ex[4];
-            Edge *ey[4];
-            Edge *ez[4];
-
-            ex[0] = set_default_edge(edges_x, *p[0], *p[1]);
-            ex[1] = set_default_edge(edges_x, *p[2], *p[3]);
-            ex[2] = set_default_edge(edges_x, *p[4], *p[5]);
-            ex[3] = set_default_edge(edges_x, *p[6], *p[7]);
-
-            ey[0] = set_default_edge(edges_y, *p[0], *p[2]);
-            ey[1] = set_default_edge(edges_y, *p[1], *p[3]);
-            ey[2] = set_default_edge(edges_y, *p[4], *p[6]);
-            ey[3] = set_default_edge(edges_y, *p[5], *p[7]);
-
-            ez[0] = set_default_edge(edges_z, *p[0], *p[4]);
-            ez[1] = set_default_edge(edges_z, *p[1], *p[5]);
-            ez[2] = set_default_edge(edges_z, *p[2], *p[6]);
-            ez[3] = set_default_edge(edges_z, *p[3], *p[7]);
-
-            Face *fx1, *fx2, *fy1, *fy2, *fz1, *fz2;
-            fx1 = set_default_face(faces_x, *p[0], *p[2], *p[4], *p[6]);
-            fx2 = set_default_face(faces_x, *p[1], *p[3], *p[5], *p[7]);
-            fy1 = set_default_face(faces_y, *p[0], *p[1], *p[4], *p[5]);
-            fy2 = set_default_face(faces_y, *p[2], *p[3], *p[6], *p[7]);
-            fz1 = set_default_face(faces_z, *p[0], *p[1], *p[2], *p[3]);
-            fz2 = set_default_face(faces_z, *p[4], *p[5], *p[6], *p[7]);
-
-            fx1->edges[0] = ez[0];
-            fx1->edges[1] = ey[2];
-            fx1->edges[2] = ez[2];
-            fx1->edges[3] = ey[0];
-
-            fx2->edges[0] = ez[1];
-            fx2->edges[1] = ey[3];
-            fx2->edges[2] = ez[3];
-            fx2->edges[3] = ey[1];
-
-            fy1->edges[0] = ez[0];
-            fy1->edges[1] = ex[2];
-            fy1->edges[2] = ez[1];
-            fy1->edges[3] = ex[0];
-
-            fy2->edges[0] = ez[2];
-            fy2->edges[1] = ex[3];
-            fy2->edges[2] = ez[3];
-            fy2->edges[3] = ex[1];
-
-            fz1->edges[0] = ey[0];
-            fz1->edges[1] = ex[1];
-            fz1->edges[2] = ey[1];
-            fz1->edges[3] = ex[0];
-
-            fz2->edges[0] = ey[2];
-            fz2->edges[1] = ex[3];
-            fz2->edges[2] = ey[3];
-            fz2->edges[3] = ex[2];
-
-            cell->faces[0] = fx1;
-            cell->faces[1] = fx2;
-            cell->faces[2] = fy1;
-            cell->faces[3] = fy2;
-            cell->faces[4] = fz1;
-            cell->faces[5] = fz2;
-
-            for(int_t it = 0; it < 4; ++it){
-                cell->edges[it    ] = ex[it];
-                cell->edges[it + 4] = ey[it];
-                cell->edges[it + 8] = ez[it];
+                roots[iz][iy][ix]->write_structure(bits);
+}
+
+int_t Tree::read_structure(const unsigned char *bits, int_t n_bits){
+    // returns the number of bits used, or more than n_bits if there were too few
+    int_t pos = 0;
+    for(int_t iz=0; iz<nz_roots; ++iz)
+        for(int_t iy=0; iy<ny_roots; ++iy)
+            for(int_t ix=0; ix<nx_roots; ++ix)
+                roots[iz][iy][ix]->read_structure(nodes, bits, n_bits, pos, xs, ys, zs);
+    return pos;
+}
+
+void Tree::build_nodes(){
+    // Copy the live nodes into one pool in key order, then point the cells
+    // and the map at the copies and free the blocks and the old pool.
+    if(nodes.blocks.empty() && nodes.size() == nodes.pool.size()) return;
+    node_vec_t live;
+    sorted_nodes(nodes, live);
+    long long n_nodes = live.size();
+    std::vector<Node> pool(n_nodes);
+    #pragma omp parallel for
+    for(long long i = 0; i < n_nodes; ++i){
+        pool[i] = *live[i];
+        live[i]->index = i;
+    }
+    for(int_t iz=0; iz<nz_roots; ++iz)
+        for(int_t iy=0; iy<ny_roots; ++iy)
+            for(int_t ix=0; ix<nx_roots; ++ix)
+                roots[iz][iy][ix]->relink_points(pool);
+    for(node_it_type it = nodes.begin(); it != nodes.end(); ++it)
+        it->second = &pool[it->second->index];
+    nodes.pool.swap(pool);
+    nodes.release_blocks();
+}
+
+void Tree::build_edges(edge_vec_t& edges, std::vector<Edge>& pool,
+                       const int_t pairs[][2], int_t n_pairs, int_t offset){
+    // Collect the keys of every cell's edges, then sort and unique them so that
+    // each edge is allocated once, contiguously, and listed in key order.
+    long long n_cells = cells.size();
+    std::vector<std::pair<int_t, int_t> > keys(n_cells*n_pairs);
+    #pragma omp parallel for
+    for(long long i = 0; i < n_cells; ++i){
+        Cell *cell = cells[i];
+        for(int_t j = 0; j < n_pairs; ++j){
+            Node *p1 = cell->points[pairs[j][0]];
+            Node *p2 = cell->points[pairs[j][1]];
+            int_t x = (p1->location_ind[0]+p2->location_ind[0])/2;
+            int_t y = (p1->location_ind[1]+p2->location_ind[1])/2;
+            int_t z = (p1->location_ind[2]+p2->location_ind[2])/2;
+            keys[i*n_pairs + j] = std::make_pair(key_func(x, y, z), i*n_pairs + j);
+        }
+    }
+    parallel_sort(keys);
+
+    // each run of equal keys in the sorted list is one edge
+    std::vector<int_t> runs;
+    for(int_t k = 0; k < keys.size(); ++k){
+        if(k == 0 || keys[k].first != keys[k-1].first) runs.push_back(k);
+    }
+    long long n_edges = runs.size();
+    runs.push_back(keys.size());
+    // the pool is sized once, so pointers into it stay valid
+    pool.clear();
+    pool.resize(n_edges);
+    edges.resize(n_edges);
+
+    #pragma omp parallel for
+    for(long long ie = 0; ie < n_edges; ++ie){
+        Edge *edge = &pool[ie];
+        for(int_t k = runs[ie]; k < runs[ie+1]; ++k){
+            Cell *cell = cells[keys[k].second/n_pairs];
+            int_t j = keys[k].second%n_pairs;
+            if(k == runs[ie]){
+                *edge = Edge(*cell->points[pairs[j][0]], *cell->points[pairs[j][1]]);
+                edges[ie] = edge;
             }
+            cell->edges[offset + j] = edge;
+            edge->reference++;
+        }
+    }
+}
 
-            for(int_t it = 0; it < 6; ++it)
-                cell->faces[it]->reference++;
-            for(int_t it = 0; it < 12; ++it)
-                cell->edges[it]->reference++;
+void Tree::build_faces(face_vec_t& faces, std::vector<Face>& pool,
+                       const int_t quads[][4], const int_t quad_edges[][4],
+                       int_t n_quads, int_t offset){
+    // Same as build_edges, but for the faces of each cell. The edges must
+    // already be built, quad_edges gives the cell's edges bounding each face.
+    long long n_cells = cells.size();
+    std::vector<std::pair<int_t, int_t> > keys(n_cells*n_quads);
+    #pragma omp parallel for
+    for(long long i = 0; i < n_cells; ++i){
+        Cell *cell = cells[i];
+        for(int_t j = 0; j < n_quads; ++j){
+            int_t x = 0, y = 0, z = 0;
+            for(int_t ip = 0; ip < 4; ++ip){
+                Node *p = cell->points[quads[j][ip]];
+                x += p->location_ind[0];
+                y += p->location_ind[1];
+                z += p->location_ind[2];
+            }
+            keys[i*n_quads + j] = std::make_pair(key_func(x/4, y/4, z/4), i*n_quads + j);
+        }
+    }
+    parallel_sort(keys);
 
+    std::vector<int_t> runs;
+    for(int_t k = 0; k < keys.size(); ++k){
+        if(k == 0 || keys[k].first != keys[k-1].first) runs.push_back(k);
+    }
+    long long n_faces = runs.size();
+    runs.push_back(keys.size());
+    pool.clear();
+    pool.resize(n_faces);
+    faces.resize(n_faces);
+
+    #pragma omp parallel for
+    for(long long jf = 0; jf < n_faces; ++jf){
+        Face *face = &pool[jf];
+        for(int_t k = runs[jf]; k < runs[jf+1]; ++k){
+            Cell *cell = cells[keys[k].second/n_quads];
+            int_t j = keys[k].second%n_quads;
+            if(k == runs[jf]){
+                Node **p = cell->points;
+                *face = Face(*p[quads[j][0]], *p[quads[j][1]],
+                             *p[quads[j][2]], *p[quads[j][3]]);
+                for(int_t ie = 0; ie < 4; ++ie)
+                    face->edges[ie] = cell->edges[quad_edges[j][ie]];
+                faces[jf] = face;
+            }
+            cell->faces[offset + j] = face;
+            face->reference++;
         }
+    }
+}
+
+void Tree::finalize_lists(){
+    build_nodes();
+    for(int_t iz=0; iz<nz_roots; ++iz)
+        for(int_t iy=0; iy<ny_roots; ++iy)
+            for(int_t ix=0; ix<nx_roots; ++ix)
+                roots[iz][iy][ix]->build_cell_vector(cells);
+    if(n_dim == 3){
+        // Generate Faces and edges
+        static const int_t ex_pairs[4][2] = {{0, 1}, {2, 3}, {4, 5}, {6, 7}};
+        static const int_t ey_pairs[4][2] = {{0, 2}, {1, 3}, {4, 6}, {5, 7}};
+        static const int_t ez_pairs[4][2] = {{0, 4}, {1, 5}, {2, 6}, {3, 7}};
+        build_edges(edges_x, edge_pool_x, ex_pairs, 4, 0);
+        build_edges(edges_y, edge_pool_y, ey_pairs, 4, 4);
+        build_edges(edges_z, edge_pool_z, ez_pairs, 4, 8);
+
+        static const int_t fx_quads[2][4] = {{0, 2, 4, 6}, {1, 3, 5, 7}};
+        static const int_t fy_quads[2][4] = {{0, 1, 4, 5}, {2, 3, 6, 7}};
+        static const int_t fz_quads[2][4] = {{0, 1, 2, 3}, {4, 5, 6, 7}};
+        // indices into cell->edges, x edges are 0-3, y edges 4-7, z edges 8-11
+        static const int_t fx_edges[2][4] = {{8, 6, 10, 4}, {9, 7, 11, 5}};
+        static const int_t fy_edges[2][4] = {{8, 2, 9, 0}, {10, 3, 11, 1}};
+        static const int_t fz_edges[2][4] = {{4, 1, 5, 0}, {6, 3, 7, 2}};
+        build_faces(faces_x, face_pool_x, fx_quads, fx_edges, 2, 0);
+        build_faces(faces_y, face_pool_y, fy_quads, fy_edges, 2, 2);
+        build_faces(faces_z, face_pool_z, fz_quads, fz_edges, 2, 4);
 
         // Process hanging x faces
-        for(face_it_type it = faces_x.begin(); it != faces_x.end(); ++it){
-            Face *face = it->second;
+        for(int_t it = 0; it < faces_x.size(); ++it){
+            Face *face = faces_x[it];
             if(face->reference < 2){
                 int_t x;
                 x = face->location_ind[0];
@@ -851,8 +1535,8 @@ void Tree::finalize_lists(){
                 for(int_t i = 0; i < 4; ++i){
                     node = face->points[i];
                     ip = i;
-                    if(faces_x.count(node->key)){
-                        face->parent = faces_x[node->key];
+                    face->parent = find_by_key(faces_x, node->key);
+                    if(face->parent != NULL){
                         break;
                     }
                 }
@@ -897,8 +1581,8 @@ void Tree::finalize_lists(){
         }
 
         // Process hanging y faces
-        for(face_it_type it = faces_y.begin(); it != faces_y.end(); ++it){
-            Face *face = it->second;
+        for(int_t it = 0; it < faces_y.size(); ++it){
+            Face *face = faces_y[it];
             if(face->reference < 2){
                 int_t y;
                 y = face->location_ind[1];
@@ -911,8 +1595,8 @@ void Tree::finalize_lists(){
                 for(int_t i = 0; i < 4; ++i){
                     node = face->points[i];
                     ip = i;
-                    if(faces_y.count(node->key)){
-                        face->parent = faces_y[node->key];
+                    face->parent = find_by_key(faces_y, node->key);
+                    if(face->parent != NULL){
                         break;
                     }
                 }
@@ -957,8 +1641,8 @@ void Tree::finalize_lists(){
         }
 
         // Process hanging z faces
-        for(face_it_type it = faces_z.begin(); it != faces_z.end(); ++it){
-            Face *face = it->second;
+        for(int_t it = 0; it < faces_z.size(); ++it){
+            Face *face = faces_z[it];
             if(face->reference < 2){
                 int_t z;
                 z = face->location_ind[2];
@@ -978,8 +1662,8 @@ void Tree::finalize_lists(){
                 for(int_t i = 0; i < 4; ++i){
                     node = face->points[i];
                     ip = i;
-                    if(faces_z.count(node->key)){
-                        face->parent = faces_z[node->key];
+                    face->parent = find_by_key(faces_z, node->key);
+                    if(face->parent != NULL){
                         ip = i;
                         break;
                     }
@@ -1028,42 +1712,29 @@ void Tree::finalize_lists(){
     }
     else{
         //Generate Edges (and 1 face for consistency)
-        for(std::vector<Cell *>::size_type i=0; i != cells.size(); i++){
-            Cell *cell = cells[i];
-            Node *p[4];
-            for(int_t i = 0; i < 4; ++i)
-                p[i] = cell->points[i];
-            Edge *e[4];
-            e[0] = set_default_edge(edges_x, *p[0], *p[1]);
-            e[1] = set_default_edge(edges_x, *p[2], *p[3]);
-            e[2] = set_default_edge(edges_y, *p[0], *p[2]);
-            e[3] = set_default_edge(edges_y, *p[1], *p[3]);
-
-            Face *face = set_default_face(faces_z, *p[0], *p[1], *p[2], *p[3]);
-            for(int_t i = 0; i < 4; ++i){
-                cell->edges[i] = e[i];
-                face->edges[i] = e[i];
-                e[i]->reference++;
-            }
+        static const int_t ex_pairs[2][2] = {{0, 1}, {2, 3}};
+        static const int_t ey_pairs[2][2] = {{0, 2}, {1, 3}};
+        build_edges(edges_x, edge_pool_x, ex_pairs, 2, 0);
+        build_edges(edges_y, edge_pool_y, ey_pairs, 2, 2);
 
-            face->hanging=false;
-        }
+        static const int_t fz_quads[1][4] = {{0, 1, 2, 3}};
+        static const int_t fz_edges[1][4] = {{0, 1, 2, 3}};
+        build_faces(faces_z, face_pool_z, fz_quads, fz_edges, 1, 0);
 
         //Process hanging x edges
-        for(edge_it_type it = edges_x.begin(); it != edges_x.end(); ++it){
-            Edge *edge = it->second;
+        for(int_t it = 0; it < edges_x.size(); ++it){
+            Edge *edge = edges_x[it];
             if(edge->reference < 2){
                 int_t y = edge->location_ind[1];
                 if(y==0 || y==ny) continue; //I am on the boundary
                 if(nodes.count(edge->key)) continue; //I am a parent
                 //I am a hanging edge find my parent
-                Node *node;
-                if(edges_x.count(edge->points[0]->key)){
-                    node = edge->points[0];
-                }else{
+                Node *node = edge->points[0];
+                edge->parents[0] = find_by_key(edges_x, node->key);
+                if(edge->parents[0] == NULL){
                     node = edge->points[1];
+                    edge->parents[0] = find_by_key(edges_x, node->key);
                 }
-                edge->parents[0] = edges_x[node->key];
                 edge->parents[1] = edge->parents[0];
 
                 node->hanging = true;
@@ -1074,20 +1745,19 @@ void Tree::finalize_lists(){
         }
 
         //Process hanging y edges
-        for(edge_it_type it = edges_y.begin(); it != edges_y.end(); ++it){
-            Edge *edge = it->second;
+        for(int_t it = 0; it < edges_y.size(); ++it){
+            Edge *edge = edges_y[it];
             if(edge->reference < 2){
                 int_t x = edge->location_ind[0];
                 if(x==0 || x==nx) continue; //I am on the boundary
                 if(nodes.count(edge->key)) continue; //I am a parent
                 //I am a hanging edge find my parent
-                Node *node;
-                if(edges_y.count(edge->points[0]->key)){
-                    node = edge->points[0];
-                }else{
+                Node *node = edge->points[0];
+                edge->parents[0] = find_by_key(edges_y, node->key);
+                if(edge->parents[0] == NULL){
                     node = edge->points[1];
+                    edge->parents[0] = find_by_key(edges_y, node->key);
                 }
-                edge->parents[0] = edges_y[node->key];
                 edge->parents[1] = edge->parents[0];
 
                 node->hanging = true;
@@ -1098,23 +1768,23 @@ void Tree::finalize_lists(){
         }
     }
     //List hanging edges x
-    for(edge_it_type it = edges_x.begin(); it != edges_x.end(); ++it){
-        Edge *edge = it->second;
+    for(int_t it = 0; it < edges_x.size(); ++it){
+        Edge *edge = edges_x[it];
         if(edge->hanging){
             hanging_edges_x.push_back(edge);
         }
     }
     //List hanging edges y
-    for(edge_it_type it = edges_y.begin(); it != edges_y.end(); ++it){
-        Edge *edge = it->second;
+    for(int_t it = 0; it < edges_y.size(); ++it){
+        Edge *edge = edges_y[it];
         if(edge->hanging){
             hanging_edges_y.push_back(edge);
         }
     }
     if(n_dim==3){
         //List hanging edges z
-        for(edge_it_type it = edges_z.begin(); it != edges_z.end(); ++it){
-            Edge *edge = it->second;
+        for(int_t it = 0; it < edges_z.size(); ++it){
+            Edge *edge = edges_z[it];
             if(edge->hanging){
                 hanging_edges_z.push_back(edge);
             }
@@ -1122,120 +1792,85 @@ void Tree::finalize_lists(){
     }
 
     //List hanging nodes
-    for(node_it_type it = nodes.begin(); it != nodes.end(); ++it){
-        Node *node = it->second;
+    for(int_t it = 0; it < nodes.pool.size(); ++it){
+        Node *node = &nodes.pool[it];
         if(node->hanging){
             hanging_nodes.push_back(node);
         }
     }
 }
 
+void Tree::clear_lists(){
+    // Undoes finalize_lists so that the tree can be divided again. The leaves
+    // keep the index they were given by the last numbering.
+    for(int_t iz=0; iz<nz_roots; ++iz)
+        for(int_t iy=0; iy<ny_roots; ++iy)
+            for(int_t ix=0; ix<nx_roots; ++ix)
+                roots[iz][iy][ix]->clear_parent_index();
+    for(int_t it = 0; it < nodes.pool.size(); ++it){
+        Node *node = &nodes.pool[it];
+        node->hanging = false;
+        for(int_t i = 0; i < 4; ++i)
+            node->parents[i] = NULL;
+    }
+    cells.clear();
+    edges_x.clear();
+    edges_y.clear();
+    edges_z.clear();
+    faces_x.clear();
+    faces_y.clear();
+    faces_z.clear();
+    edge_pool_x.clear();
+    edge_pool_y.clear();
+    edge_pool_z.clear();
+    face_pool_x.clear();
+    face_pool_y.clear();
+    face_pool_z.clear();
+    hanging_nodes.clear();
+    hanging_edges_x.clear();
+    hanging_edges_y.clear();
+    hanging_edges_z.clear();
+    hanging_faces_x.clear();
+    hanging_faces_y.clear();
+    hanging_faces_z.clear();
+}
+
 void Tree::number(){
+    // number of bits needed for the largest location index, nx, ny or nz
+    int_t n_bits = 1;
+    while(((int_t) 1 << n_bits) <= std::max(nx, std::max(ny, nz))) ++n_bits;
+
     //Number Nodes
-    int_t ii, ih;
-    ii = 0;
-    ih = nodes.size() - hanging_nodes.size();
-    for(node_it_type it = nodes.begin(); it != nodes.end(); ++it){
-        Node *node = it->second;
-        if(node->hanging){
-            node->index = ih;
-            ++ih;
-        }else{
-            node->index = ii;
-            ++ii;
-        }
-    }
+    // the pool holds the nodes in key order
+    long long n_nodes = nodes.pool.size();
+    node_vec_t node_list(n_nodes);
+    #pragma omp parallel for
+    for(long long i = 0; i < n_nodes; ++i)
+        node_list[i] = &nodes.pool[i];
+    if(ordering != ORDER_DEFAULT)
+        curve_sort(node_list, n_dim, n_bits, ordering);
+    number_items(node_list, hanging_nodes.size());
 
     //Number Cells
-    for(std::vector<Cell *>::size_type i = 0; i != cells.size(); ++i)
+    if(ordering != ORDER_DEFAULT)
+        curve_sort(cells, n_dim, n_bits, ordering);
+    long long n_cells = cells.size();
+    #pragma omp parallel for
+    for(long long i = 0; i < n_cells; ++i)
         cells[i]->index = i;
 
-    //Number edges_x
-    ii = 0;
-    ih = edges_x.size() - hanging_edges_x.size();
-    for(edge_it_type it = edges_x.begin(); it != edges_x.end(); ++it){
-        Edge *edge = it->second;
-        if(edge->hanging){
-          edge->index = ih;
-          ++ih;
-        }else{
-          edge->index = ii;
-          ++ii;
-        }
-    }
-    //Number edges_y
-    ii = 0;
-    ih = edges_y.size() - hanging_edges_y.size();
-    for(edge_it_type it = edges_y.begin(); it != edges_y.end(); ++it){
-        Edge *edge = it->second;
-        if(edge->hanging){
-          edge->index = ih;
-          ++ih;
-        }else{
-          edge->index = ii;
-          ++ii;
-        }
-    }
-
+    number_ordered(edges_x, hanging_edges_x.size(), n_dim, n_bits, ordering);
+    number_ordered(edges_y, hanging_edges_y.size(), n_dim, n_bits, ordering);
     if(n_dim==3){
-        //Number faces_x
-        ii = 0;
-        ih = faces_x.size() - hanging_faces_x.size();
-        for(face_it_type it = faces_x.begin(); it != faces_x.end(); ++it){
-            Face *face = it->second;
-            if(face->hanging){
-                face->index = ih;
-                ++ih;
-            }else{
-                face->index = ii;
-                ++ii;
-            }
-        }
-        //Number faces_y
-        ii = 0;
-        ih = faces_y.size() - hanging_faces_y.size();
-        for(face_it_type it = faces_y.begin(); it != faces_y.end(); ++it){
-            Face *face = it->second;
-            if(face->hanging){
-                face->index = ih;
-                ++ih;
-            }else{
-                face->index = ii;
-                ++ii;
-            }
-        }
-
-        //Number faces_z
-        ii = 0;
-        ih = faces_z.size() - hanging_faces_z.size();
-        for(face_it_type it = faces_z.begin(); it != faces_z.end(); ++it){
-            Face *face = it->second;
-            if(face->hanging){
-                face->index = ih;
-                ++ih;
-            }else{
-                face->index = ii;
-                ++ii;
-            }
-        }
-
-        //Number edges_z
-        ii = 0;
-        ih = edges_z.size() - hanging_edges_z.size();
-        for(edge_it_type it = edges_z.begin(); it != edges_z.end(); ++it){
-            Edge *edge = it->second;
-            if(edge->hanging){
-              edge->index = ih;
-              ++ih;
-            }else{
-              edge->index = ii;
-              ++ii;
-            }
-        }
+        number_ordered(faces_x, hanging_faces_x.size(), n_dim, n_bits, ordering);
+        number_ordered(faces_y, hanging_faces_y.size(), n_dim, n_bits, ordering);
+        number_ordered(faces_z, hanging_faces_z.size(), n_dim, n_bits, ordering);
+        number_ordered(edges_z, hanging_edges_z.size(), n_dim, n_bits, ordering);
     }else{
         //Ensure Fz and cells are numbered the same in 2D
-        for(std::vector<Cell *>::size_type i = 0; i != cells.size(); ++i)
-            faces_z[cells[i]->key]->index = cells[i]->index;
+        #pragma omp parallel for
+        for(long long i = 0; i < n_cells; ++i)
+            cells[i]->faces[0]->index = cells[i]->index;
     }
 
 };
@@ -1254,27 +1889,6 @@ Tree::~Tree(){
     delete[] ixs;
     delete[] iys;
     delete[] izs;
-    for(node_it_type it = nodes.begin(); it != nodes.end(); ++it){
-        delete it->second;
-    }
-    for(face_it_type it = faces_x.begin(); it != faces_x.end(); ++it){
-        delete it->second;
-    }
-    for(face_it_type it = faces_y.begin(); it != faces_y.end(); ++it){
-        delete it->second;
-    }
-    for(face_it_type it = faces_z.begin(); it != faces_z.end(); ++it){
-        delete it->second;
-    }
-    for(edge_it_type it = edges_x.begin(); it != edges_x.end(); ++it){
-        delete it->second;
-    }
-    for(edge_it_type it = edges_y.begin(); it != edges_y.end(); ++it){
-        delete it->second;
-    }
-    for(edge_it_type it = edges_z.begin(); it != edges_z.end(); ++it){
-        delete it->second;
-    }
     roots.clear();
     cells.clear();
     nodes.clear();
@@ -1284,25 +1898,104 @@ Tree::~Tree(){
     edges_x.clear();
     edges_y.clear();
     edges_z.clear();
+    face_pool_x.clear();
+    face_pool_y.clear();
+    face_pool_z.clear();
+    edge_pool_x.clear();
+    edge_pool_y.clear();
+    edge_pool_z.clear();
 };
 
 Cell* Tree::containing_cell(double x, double y, double z){
     // find containing root
-    int_t ix = 0;
-    int_t iy = 0;
-    int_t iz = 0;
-    while (x>=xs[ixs[ix+1]] && ix<nx_roots-1){
-        ++ix;
+    int_t ix = find_root(xs, ixs, nx_roots, x);
+    int_t iy = find_root(ys, iys, ny_roots, y);
+    int_t iz = (n_dim == 3)? find_root(zs, izs, nz_roots, z) : 0;
+    return roots[iz][iy][ix]->containing_cell(x, y, z);
+}
+
+void Tree::trace_ray(double *a, double *b, std::vector<std::pair<long long, double> >& hits){
+    // Walks the leaves crossed by the segment from a to b, adding the index of
+    // each one and the length of the segment inside of it to hits. Any part
+    // of the segment outside of the mesh is ignored.
+    double *grids[3] = {xs, ys, zs};
+    int_t *inds[3] = {ixs, iys, izs};
+    int_t n_roots[3] = {nx_roots, ny_roots, nz_roots};
+    double d[3] = {0.0, 0.0, 0.0};
+    double p[3] = {0.0, 0.0, 0.0};
+    int_t ir[3] = {0, 0, 0};
+    double length = 0.0;
+
+    // clip the segment to the mesh
+    double t = 0.0, t1 = 1.0;
+    for(int_t i = 0; i < n_dim; ++i){
+        d[i] = b[i] - a[i];
+        length += d[i]*d[i];
+        double lo = grids[i][inds[i][0]];
+        double hi = grids[i][inds[i][n_roots[i]]];
+        if(d[i] == 0.0){
+            if(a[i] < lo || a[i] > hi) return;
+        }else{
+            double ta = (lo - a[i])/d[i];
+            double tb = (hi - a[i])/d[i];
+            if(ta > tb) std::swap(ta, tb);
+            t = std::max(t, ta);
+            t1 = std::min(t1, tb);
+        }
     }
-    while (y>=ys[iys[iy+1]] && iy<ny_roots-1){
-        ++iy;
+    length = std::sqrt(length);
+    if(length == 0.0 || t >= t1){
+        return;
     }
-    if(n_dim == 3){
-        while(z>=zs[izs[iz+1]] && iz<nz_roots-1){
-            ++iz;
+
+    for(int_t i = 0; i < n_dim; ++i){
+        p[i] = a[i] + t*d[i];
+        ir[i] = find_root(grids[i], inds[i], n_roots[i], p[i]);
+        if(d[i] < 0 && ir[i] > 0 && p[i] <= grids[i][inds[i][ir[i]]]){
+            --ir[i];
         }
     }
-    return roots[iz][iy][ix]->containing_cell(x, y, z);
+    Cell *cell = roots[ir[2]][ir[1]][ir[0]]->leaf_toward(p, d);
+    int_t last = (1<<n_dim) - 1;
+    while(true){
+        // leave through the first face the segment reaches
+        double t_exit = t1;
+        int exit_dir = -1;
+        for(int_t i = 0; i < n_dim; ++i){
+            if(d[i] == 0.0) continue;
+            double bound = (d[i] > 0)? cell->points[last]->location[i] : cell->points[0]->location[i];
+            double ti = (bound - a[i])/d[i];
+            if(ti < t_exit){
+                t_exit = ti;
+                exit_dir = 2*i + (d[i] > 0);
+            }
+        }
+        if(t_exit > t){
+            hits.push_back(std::make_pair(cell->index, (t_exit - t)*length));
+            t = t_exit;
+        }
+        if(exit_dir < 0){
+            return;
+        }
+        // a step that lands on a corner is followed by a step of zero length
+        Cell *next = cell->neighbors[exit_dir];
+        if(next == NULL){
+            return;
+        }
+        for(int_t i = 0; i < n_dim; ++i){
+            p[i] = a[i] + t*d[i];
+        }
+        cell = next->leaf_toward(p, d);
+    }
+}
+
+void Tree::transfer(Tree *other, bool nearest, std::vector<long long>& rows,
+                    std::vector<long long>& cols, std::vector<double>& vals){
+    // other must have the same roots as this tree
+    for(int_t iz=0; iz<nz_roots; ++iz)
+        for(int_t iy=0; iy<ny_roots; ++iy)
+            for(int_t ix=0; ix<nx_roots; ++ix)
+                roots[iz][iy][ix]->transfer(other->roots[iz][iy][ix], nearest, rows, cols, vals);
 }
 
 void Tree::shift_cell_centers(double *shift){
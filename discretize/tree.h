@@ -2,9 +2,10 @@
 #define __TREE_H
 
 #include <vector>
-#include <map>
+#include <unordered_map>
 #include <iostream>
 #include <algorithm>
+#include <utility>
 
 typedef std::size_t int_t;
 
@@ -23,14 +24,63 @@ class Tree;
 class PyWrapper;
 typedef PyWrapper* function;
 
-typedef std::map<int_t, Node *> node_map_t;
-typedef std::map<int_t, Edge *> edge_map_t;
-typedef std::map<int_t, Face *> face_map_t;
-typedef node_map_t::iterator node_it_type;
-typedef edge_map_t::iterator edge_it_type;
-typedef face_map_t::iterator face_it_type;
+class NodeMap;
+typedef NodeMap node_map_t;
+typedef std::vector<Node *> node_vec_t;
+typedef std::vector<Edge *> edge_vec_t;
+typedef std::vector<Face *> face_vec_t;
+typedef std::unordered_map<int_t, Node *>::iterator node_it_type;
 typedef std::vector<Cell *> cell_vec_t;
 
+// Geometric objects used to refine the tree. Each one can report its bounding
+// box and whether it intersects an axis aligned box given by its lower (a) and
+// upper (b) corners.
+class Ball{
+  public:
+    int_t n_dim;
+    double x0[3];
+    double r, rsq;
+    Ball();
+    Ball(int_t dim, double *x0, double r);
+    void bounds(double *lo, double *hi) const;
+    bool intersects_cell(double *a, double *b) const;
+};
+
+class Box{
+  public:
+    int_t n_dim;
+    double x0[3];
+    double x1[3];
+    Box();
+    Box(int_t dim, double *x0, double *x1);
+    void bounds(double *lo, double *hi) const;
+    bool intersects_cell(double *a, double *b) const;
+};
+
+class Line{
+  public:
+    int_t n_dim;
+    double x0[3];
+    double x1[3];
+    Line();
+    Line(int_t dim, double *x0, double *x1);
+    void bounds(double *lo, double *hi) const;
+    bool intersects_cell(double *a, double *b) const;
+};
+
+class Triangle{
+  public:
+    int_t n_dim;
+    double x0[3];
+    double x1[3];
+    double x2[3];
+    double padding[3];
+    Triangle();
+    Triangle(int_t dim, double *x0, double *x1, double *x2, double *padding);
+    void bounds(double *lo, double *hi) const;
+    bool intersects_cell(double *a, double *b) const;
+};
+
 class PyWrapper{
   public:
     void *py_func;
@@ -66,6 +116,20 @@ class Node{
     };
 };
 
+// The nodes of the tree by key. New nodes are handed out from blocks, so that
+// refining does not allocate them one at a time, and the tree moves the live
+// ones into a single pool sorted by key when it is finalized.
+class NodeMap : public std::unordered_map<int_t, Node *>{
+  public:
+    std::vector<Node> pool;
+    std::vector<Node *> blocks;
+    int_t n_used;
+    NodeMap();
+    ~NodeMap();
+    Node *create(int_t x, int_t y, int_t z, double *xs, double *ys, double *zs);
+    void release_blocks();
+};
+
 class Edge{
   public:
     int_t location_ind[3];
@@ -123,16 +187,71 @@ class Cell{
     void set_neighbor(Cell* other, int_t direction);
     void set_test_function(function func);
     void build_cell_vector(cell_vec_t& cells);
+    void write_structure(std::vector<unsigned char>& bits);
+    void read_structure(node_map_t& nodes, const unsigned char *bits, int_t n_bits, int_t& pos,
+                        double *xs, double *ys, double *zs);
+    void clear_parent_index();
+    void relink_points(std::vector<Node>& pool);
+    bool can_merge();
+    void merge(node_map_t& nodes);
+    int coarsen(node_map_t& nodes, int *levels,
+                std::unordered_map<Cell *, int>& merged, bool& changed);
 
     void insert_cell(node_map_t &nodes, double *new_center, int_t p_level, double* xs, double *ys, double *zs);
 
+    template <class T>
+    void refine_geom(node_map_t& nodes, const T& geom, int_t p_level, double *xs, double *ys, double *zs){
+        // Divides every cell below p_level that intersects the geometry
+        if(level >= p_level || level == max_level){
+            return;
+        }
+        double *a = points[0]->location;
+        double *b = points[(1<<n_dim) - 1]->location;
+        if(!geom.intersects_cell(a, b)){
+            return;
+        }
+        if(is_leaf()){
+            divide(nodes, xs, ys, zs, true);
+        }
+        for(int_t i = 0; i < (1<<n_dim); ++i){
+            children[i]->refine_geom(nodes, geom, p_level, xs, ys, zs);
+        }
+    };
+
     Cell* containing_cell(double, double, double);
+    Cell* leaf_toward(double *p, double *d);
+    void transfer(Cell *other, bool nearest, std::vector<long long>& rows,
+                  std::vector<long long>& cols, std::vector<double>& vals);
     void shift_centers(double * shift);
 };
 
+inline int_t find_root(double *grid, int_t *inds, int_t n_roots, double x){
+    // index of the last root whose lower edge is at or below x (clamped to the roots)
+    int_t lo = 0, hi = n_roots;
+    while(hi - lo > 1){
+        int_t mid = (lo + hi)/2;
+        if(grid[inds[mid]] <= x){
+            lo = mid;
+        }else{
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// numbering of the cells, nodes, edges and faces of a finalized tree
+enum Ordering{
+    ORDER_DEFAULT = 0, // cells in root traversal order, the rest in key order
+    ORDER_MORTON = 1,
+    ORDER_HILBERT = 2
+};
+
+int_t curve_code(const int_t *ind, int_t n_dim, int_t n_bits, int ordering);
+
 class Tree{
   public:
     int_t n_dim;
+    int ordering;
     std::vector<std::vector<std::vector<Cell *> > > roots;
     int_t max_level, nx, ny, nz;
     int_t *ixs, *iys, *izs;
@@ -142,9 +261,12 @@ class Tree{
     double *zs;
 
     std::vector<Cell *> cells;
+    // nodes, edges and faces are sorted by key, their storage lives in the pools
     node_map_t nodes;
-    edge_map_t edges_x, edges_y, edges_z;
-    face_map_t faces_x, faces_y, faces_z;
+    edge_vec_t edges_x, edges_y, edges_z;
+    face_vec_t faces_x, faces_y, faces_z;
+    std::vector<Edge> edge_pool_x, edge_pool_y, edge_pool_z;
+    std::vector<Face> face_pool_x, face_pool_y, face_pool_z;
     std::vector<Node *> hanging_nodes;
     std::vector<Edge *> hanging_edges_x, hanging_edges_y, hanging_edges_z;
     std::vector<Face *> hanging_faces_x, hanging_faces_y, hanging_faces_z;
@@ -154,15 +276,53 @@ class Tree{
 
     void set_dimension(int_t dim);
     void set_levels(int_t l_x, int_t l_y, int_t l_z);
+    void set_ordering(int order);
     void set_xs(double *x , double *y, double *z);
     void initialize_roots();
     void build_tree_from_function(function test_func);
+    void write_structure(std::vector<unsigned char>& bits);
+    int_t read_structure(const unsigned char *bits, int_t n_bits);
     void number();
     void finalize_lists();
+    void clear_lists();
+    void build_nodes();
+    void build_edges(edge_vec_t& edges, std::vector<Edge>& pool,
+                     const int_t pairs[][2], int_t n_pairs, int_t offset);
+    void build_faces(face_vec_t& faces, std::vector<Face>& pool,
+                     const int_t quads[][4], const int_t quad_edges[][4],
+                     int_t n_quads, int_t offset);
 
     void insert_cell(double *new_center, int_t p_level);
+    void coarsen(int *levels);
+
+    template <class T>
+    void refine_geom(const T& geom, int_t p_level){
+        // only visit the roots that overlap the geometry's bounding box
+        double lo[3], hi[3];
+        geom.bounds(lo, hi);
+        int_t ix0 = find_root(xs, ixs, nx_roots, lo[0]);
+        int_t ix1 = find_root(xs, ixs, nx_roots, hi[0]);
+        int_t iy0 = find_root(ys, iys, ny_roots, lo[1]);
+        int_t iy1 = find_root(ys, iys, ny_roots, hi[1]);
+        int_t iz0 = 0, iz1 = 0;
+        if(n_dim == 3){
+            iz0 = find_root(zs, izs, nz_roots, lo[2]);
+            iz1 = find_root(zs, izs, nz_roots, hi[2]);
+        }
+        for(int_t iz = iz0; iz <= iz1; ++iz)
+            for(int_t iy = iy0; iy <= iy1; ++iy)
+                for(int_t ix = ix0; ix <= ix1; ++ix)
+                    roots[iz][iy][ix]->refine_geom(nodes, geom, p_level, xs, ys, zs);
+    };
+    void refine_ball(double *centers, double *radii, int *levels, int_t n_balls);
+    void refine_box(double *x0s, double *x1s, int *levels, int_t n_boxes);
+    void refine_line(double *path, int *levels, int_t n_segments);
+    void refine_triangle(double *triangles, int *levels, double *padding, int_t n_triangles);
 
     Cell* containing_cell(double, double, double);
+    void trace_ray(double *a, double *b, std::vector<std::pair<long long, double> >& hits);
+    void transfer(Tree *other, bool nearest, std::vector<long long>& rows,
+                  std::vector<long long>& cols, std::vector<double>& vals);
 
     void shift_cell_centers(double *shift);
 };
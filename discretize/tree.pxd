@@ -1,6 +1,7 @@
 from libcpp cimport bool
 from libcpp.vector cimport vector
-from libcpp.map cimport map
+from libcpp.unordered_map cimport unordered_map
+from libcpp.pair cimport pair
 
 cdef extern from "tree.h":
     ctypedef int int_t
@@ -44,9 +45,8 @@ cdef extern from "tree.h":
         Face()
         Face(Node& p1, Node& p2, Node& p3, Node& p4)
 
-    ctypedef map[int_t, Node *] node_map_t
-    ctypedef map[int_t, Edge *] edge_map_t
-    ctypedef map[int_t, Face *] face_map_t
+    cdef cppclass node_map_t(unordered_map[int_t, Node *]):
+        vector[Node] pool
 
     cdef cppclass Cell:
         int_t n_dim
@@ -61,7 +61,9 @@ cdef extern from "tree.h":
         int_t key, level, max_level
         long long int index
         double volume
-        inline bool is_leaf()
+        inline bool is_leaf() nogil
+        void divide(node_map_t&, double*, double*, double*, bool, bool) nogil
+        void build_cell_vector(vector[Cell *]&) nogil
 
     cdef cppclass PyWrapper:
         PyWrapper()
@@ -69,12 +71,18 @@ cdef extern from "tree.h":
 
     cdef cppclass Tree:
         int_t n_dim
+        int ordering
         int_t max_level, nx, ny, nz
+        vector[vector[vector[Cell *]]] roots
+        int_t nx_roots, ny_roots, nz_roots
+        double *xs
+        double *ys
+        double *zs
 
         vector[Cell *] cells
         node_map_t nodes
-        edge_map_t edges_x, edges_y, edges_z
-        face_map_t faces_x, faces_y, faces_z
+        vector[Edge *] edges_x, edges_y, edges_z
+        vector[Face *] faces_x, faces_y, faces_z
         vector[Node *] hanging_nodes
         vector[Edge *] hanging_edges_x, hanging_edges_y, hanging_edges_z
         vector[Face *] hanging_faces_x, hanging_faces_y, hanging_faces_z
@@ -83,11 +91,24 @@ cdef extern from "tree.h":
 
         void set_dimension(int_t)
         void set_levels(int_t, int_t, int_t)
+        void set_ordering(int)
         void set_xs(double*, double*, double*)
         void build_tree_from_function(PyWrapper *)
-        void number()
+        void write_structure(vector[unsigned char]&) nogil
+        int_t read_structure(const unsigned char*, int_t) nogil
+        void number() nogil
         void initialize_roots()
         void insert_cell(double *new_center, int_t p_level);
-        void finalize_lists()
-        Cell * containing_cell(double, double, double)
+        void coarsen(int*) nogil
+        void refine_ball(double*, double*, int*, int_t) nogil
+        void refine_box(double*, double*, int*, int_t) nogil
+        void refine_line(double*, int*, int_t) nogil
+        void refine_triangle(double*, int*, double*, int_t) nogil
+        void finalize_lists() nogil
+        void clear_lists() nogil
+        Cell * containing_cell(double, double, double) nogil
+        void trace_ray(double*, double*, vector[pair[long long, double]]&) nogil
+        void transfer(Tree*, bool, vector[long long]&, vector[long long]&, vector[double]&) nogil
         void shift_cell_centers(double*)
+
+    int_t curve_code(const int_t *, int_t, int_t, int) nogil
@@ -1,12 +1,14 @@
 # distutils: language=c++
 #cython: embedsignature=True
 cimport cython
+from cython.parallel cimport prange
 cimport numpy as np
 from libc.math cimport sqrt, abs, cbrt
 from libcpp.vector cimport vector
+from libcpp.pair cimport pair
 from numpy.math cimport INFINITY
 
-from tree cimport int_t, Tree as c_Tree, PyWrapper, Node, Edge, Face, Cell as c_Cell
+from tree cimport int_t, Tree as c_Tree, PyWrapper, Node, Edge, Face, Cell as c_Cell, curve_code
 
 import scipy.sparse as sp
 from scipy.spatial import Delaunay, cKDTree
@@ -14,6 +16,7 @@ from six import integer_types
 import numpy as np
 
 from discretize.utils.codeutils import requires
+from discretize.utils.cacheutils import operator_cache
 # matplotlib is a soft dependencies for discretize
 try:
     import matplotlib
@@ -21,7 +24,8 @@ try:
     import matplotlib.pyplot as plt
     import matplotlib.colors as colors
     from mpl_toolkits.mplot3d import Axes3D
-    from matplotlib.collections import PatchCollection
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
+    from matplotlib.collections import PolyCollection, LineCollection
 except ImportError:
     matplotlib = False
 
@@ -104,7 +108,7 @@ cdef class TreeCell:
         """
         cdef Face *faces[6]
         faces = self._cell.faces
-        if self._ == 3:
+        if self._dim == 3:
             return [
                 faces[0].index, faces[1].index,
                 faces[2].index, faces[3].index,
@@ -223,6 +227,31 @@ cdef class TreeCell:
     def _level(self):
         return self._cell.level
 
+# the position of each name matches the Ordering enum in tree.h
+_orderings = ('default', 'morton', 'hilbert')
+
+# Where each type of item sits in a cell's points (n), edges (e) or faces (f).
+# The slots are ordered by the bits of the cell corner that each item is on,
+# along the axes given by _item_axes (the first axis is the lowest bit).
+_cell_item_slots = {
+    2: {'N': ('n', (0, 1, 2, 3)),
+        'Fx': ('e', (2, 3)), 'Fy': ('e', (0, 1)),
+        'Ex': ('e', (0, 1)), 'Ey': ('e', (2, 3))},
+    3: {'N': ('n', (0, 1, 2, 3, 4, 5, 6, 7)),
+        'Fx': ('f', (0, 1)), 'Fy': ('f', (2, 3)), 'Fz': ('f', (4, 5)),
+        'Ex': ('e', (0, 1, 2, 3)), 'Ey': ('e', (4, 5, 6, 7)),
+        'Ez': ('e', (8, 9, 10, 11))},
+}
+
+def _item_axes(locType, dim):
+    # the axes that an item's value varies along inside of a cell
+    if locType == 'N':
+        return list(range(dim))
+    d = 'xyz'.index(locType[1])
+    if locType[0] == 'F':
+        return [d]
+    return [a for a in range(dim) if a != d]
+
 cdef int_t _evaluate_func(void* function, c_Cell* cell) with gil:
     # Wraps a function to be called in C++
     func = <object> function
@@ -230,6 +259,40 @@ cdef int_t _evaluate_func(void* function, c_Cell* cell) with gil:
     pycell._set(cell)
     return <int_t> func(pycell)
 
+cdef struct _CenterBoxes:
+    int n, dim
+    double *x0s
+    double *x1s
+    int *levels
+
+cdef int_t _evaluate_center_boxes(void* data, c_Cell* cell) nogil:
+    # the level of the first box strictly containing the cell center, or the
+    # cell's own level
+    cdef _CenterBoxes *boxes = <_CenterBoxes *> data
+    cdef int i, d
+    cdef bint inside
+    for i in range(boxes.n):
+        inside = True
+        for d in range(boxes.dim):
+            if not (
+                boxes.x0s[i*boxes.dim + d] < cell.location[d] and
+                cell.location[d] < boxes.x1s[i*boxes.dim + d]
+            ):
+                inside = False
+                break
+        if inside:
+            return boxes.levels[i]
+    return cell.level
+
+def _refine_levels(levels, n):
+    # the levels of the n refining objects, checked before the cast to C ints
+    levels = np.broadcast_to(levels, n)
+    if n > 0 and (levels.min() < 0 or levels.max() > np.iinfo(np.int32).max):
+        raise ValueError(
+            "levels must be between 0 and the max_level of the mesh"
+        )
+    return np.array(levels, dtype=np.int32)
+
 cdef class _TreeMesh:
     cdef c_Tree *tree
     cdef PyWrapper *wrapper
@@ -240,19 +303,8 @@ cdef class _TreeMesh:
     cdef double[:] _xs, _ys, _zs
     cdef double[:] _x0
 
-    cdef object _gridCC, _gridN, _gridhN
-    cdef object _gridEx, _gridEy, _gridEz, _gridhEx, _gridhEy, _gridhEz
-    cdef object _gridFx, _gridFy, _gridFz, _gridhFx, _gridhFy, _gridhFz
-
-    cdef object _h_gridded
-    cdef object _vol, _area, _edge
-    cdef object _aveFx2CC, _aveFy2CC, _aveFz2CC, _aveF2CC, _aveF2CCV,
-    cdef object _aveN2CC, _aveN2E, _aveN2Ex, _aveN2Ey, _aveN2Ez
-    cdef object _aveN2F, _aveN2Fx, _aveN2Fy, _aveN2Fz
-    cdef object _aveEx2CC, _aveEy2CC, _aveEz2CC,_aveE2CC,_aveE2CCV
-    cdef object _aveCC2F, _aveCCV2F, _aveCC2Fx, _aveCC2Fy, _aveCC2Fz
-    cdef object _faceDiv
-    cdef object _edgeCurl, _nodalGrad
+    # the cached grids and operators (_gridCC, _faceDiv, ...) are kept in
+    # the operator cache of the mesh, see TreeMesh
 
     cdef object __ubc_order, __ubc_indArr
 
@@ -260,7 +312,11 @@ cdef class _TreeMesh:
         self.wrapper = new PyWrapper()
         self.tree = new c_Tree()
 
-    def __init__(self, h, x0):
+    def __init__(self, h, x0, ordering='default'):
+        if ordering not in _orderings:
+            raise ValueError(
+                "ordering must be one of {}, not {!r}".format(_orderings, ordering)
+            )
         nx2 = 2*len(h[0])
         ny2 = 2*len(h[1])
         self._dim = len(x0)
@@ -292,6 +348,7 @@ cdef class _TreeMesh:
 
         self.tree.set_dimension(self._dim)
         self.tree.set_levels(self.ls[0], self.ls[1], self.ls[2])
+        self.tree.set_ordering(_orderings.index(ordering))
         self.tree.set_xs(&self._xs[0], &self._ys[0], &self._zs[0])
         self.tree.initialize_roots()
         self._finalized = False
@@ -352,6 +409,26 @@ cdef class _TreeMesh:
         self._nodalGrad = None
         self._edgeCurl = None
 
+        self._cellGradxStencilMat = None
+        self._cellGradyStencilMat = None
+        self._cellGradzStencilMat = None
+
+        self._deflate_edges_x_mat = None
+        self._deflate_edges_y_mat = None
+        self._deflate_edges_z_mat = None
+        self._deflate_faces_x_mat = None
+        self._deflate_faces_y_mat = None
+        self._deflate_faces_z_mat = None
+        self._deflate_nodes_mat = None
+
+        self._cell_nodes = None
+        self._cell_edges = None
+        self._cell_faces = None
+        self._cell_neighbors = None
+        self._face_cells = None
+        self._edge_nodes = None
+        self._cell_adjacency = None
+
         self.__ubc_order = None
         self.__ubc_indArr = None
 
@@ -402,6 +479,119 @@ cdef class _TreeMesh:
         self.wrapper.set(func_ptr, _evaluate_func)
         #Then tell c++ to build the tree
         self.tree.build_tree_from_function(self.wrapper)
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def _check_unfinalized(self, method):
+        if self._finalized:
+            raise ValueError(
+                "{} cannot change a finalized mesh, use adapt instead".format(
+                    method
+                )
+            )
+
+    def refine_vectorized(self, function, finalize=True):
+        """ Refine a TreeMesh using a vectorized function.
+
+        Refines the TreeMesh one level at a time. At each pass, the function is
+        called once with the centers, widths and levels of every leaf cell that
+        has not been tested yet, and must return an integer array of the
+        desired level of each of those cells. Cells whose desired level is
+        greater than their current level are divided (along with any neighbors
+        needed to keep the tree balanced), and their children are tested on the
+        next pass. This requires roughly `max_level` calls to the function,
+        instead of one call per cell as in `refine`.
+
+        Parameters
+        ----------
+        function : callable
+            a function with the signature `function(centers, widths, levels)`,
+            where `centers` and `widths` are arrays of shape (n_cells, dim) and
+            `levels` is an integer array of shape (n_cells), returning an
+            integer array of shape (n_cells) of the desired levels.
+        finalize : bool, optional
+            Whether to finalize the mesh
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32,32])
+        >>> def func(centers, widths, levels):
+        >>>     r = np.linalg.norm(centers-0.5, axis=1)
+        >>>     return np.where(r<0.2, mesh.max_level, mesh.max_level-1)
+        >>> mesh.refine_vectorized(func)
+
+        See Also
+        --------
+        discretize.TreeMesh.refine : refine with a function of a single cell
+        """
+        self._check_unfinalized('refine_vectorized')
+        cdef int_t dim = self._dim
+        cdef int_t n_last = (1<<dim) - 1
+        cdef vector[c_Cell *] leaves, pending, next_leaves, next_pending
+        cdef c_Cell *cell
+        cdef int_t i, ii, n, ix, iy, iz
+        cdef np.float64_t[:, :] centers, widths
+        cdef np.int64_t[:] levels, desired
+
+        for iz in range(self.tree.nz_roots):
+            for iy in range(self.tree.ny_roots):
+                for ix in range(self.tree.nx_roots):
+                    self.tree.roots[iz][iy][ix].build_cell_vector(leaves)
+        pending = leaves
+
+        while pending.size() > 0:
+            n = pending.size()
+            centers_arr = np.empty((n, dim), dtype=np.float64)
+            widths_arr = np.empty((n, dim), dtype=np.float64)
+            levels_arr = np.empty(n, dtype=np.int64)
+            centers = centers_arr
+            widths = widths_arr
+            levels = levels_arr
+            for i in range(n):
+                cell = pending[i]
+                levels[i] = cell.level
+                for ii in range(dim):
+                    centers[i, ii] = cell.location[ii]
+                    widths[i, ii] = (cell.points[n_last].location[ii]
+                                     - cell.points[0].location[ii])
+
+            # a writeable copy, the function may return read only arrays
+            out = np.array(
+                function(centers_arr, widths_arr, levels_arr), dtype=np.int64
+            ).reshape(-1)
+            if out.shape[0] != n:
+                raise ValueError(
+                    "function returned {} levels for {} cells".format(
+                        out.shape[0], n
+                    )
+                )
+            desired = out
+
+            with nogil:
+                for i in range(n):
+                    cell = pending[i]
+                    if desired[i] > <np.int64_t> cell.level and cell.is_leaf():
+                        cell.divide(self.tree.nodes, self.tree.xs,
+                                    self.tree.ys, self.tree.zs, True, True)
+
+                # cells that were divided (directly, or to balance the tree)
+                # contribute their new leaves to the next pass
+                next_leaves.clear()
+                next_pending.clear()
+                for i in range(leaves.size()):
+                    cell = leaves[i]
+                    if cell.is_leaf():
+                        next_leaves.push_back(cell)
+                    else:
+                        cell.build_cell_vector(next_pending)
+                for i in range(next_pending.size()):
+                    next_leaves.push_back(next_pending[i])
+                leaves.swap(next_leaves)
+                pending.swap(next_pending)
+
+        self._forget_fingerprint()
         if finalize:
             self.finalize()
 
@@ -440,6 +630,217 @@ cdef class _TreeMesh:
         cdef int_t i
         for i in range(ls.shape[0]):
             self.tree.insert_cell(&cs[i, 0], ls[i])
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def refine_ball(self, points, radii, levels, finalize=True):
+        """Refine the TreeMesh within balls
+
+        Refines the TreeMesh so that every cell intersecting a ball is at least
+        at that ball's level.
+
+        Parameters
+        ----------
+        points : array_like with shape (N, dim)
+            centers of the balls
+        radii : float or array_like with shape (N)
+            radii of the balls
+        levels : int or array_like of integers with shape (N)
+            minimum level of the cells intersecting each ball
+        finalize : bool, optional
+            Whether to finalize after refining
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32,32])
+        >>> mesh.refine_ball([0.5, 0.5], 0.2, mesh.max_level)
+        """
+        self._check_unfinalized('refine_ball')
+        points = np.require(np.atleast_2d(points), dtype=np.float64,
+                            requirements='C')
+        if points.shape[1] != self._dim:
+            raise ValueError(
+                "points must have {} columns, not {}".format(
+                    self._dim, points.shape[1]
+                )
+            )
+        cdef int_t n = points.shape[0]
+        cdef double[:, :] cs = points
+        cdef double[:] rs = np.array(np.broadcast_to(radii, n), dtype=np.float64)
+        cdef int[:] ls = _refine_levels(levels, n)
+        if n > 0:
+            with nogil:
+                self.tree.refine_ball(&cs[0, 0], &rs[0], &ls[0], n)
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def refine_box(self, x0s, x1s, levels, finalize=True):
+        """Refine the TreeMesh within axis aligned boxes
+
+        Refines the TreeMesh so that every cell overlapping a box is at least
+        at that box's level.
+
+        Parameters
+        ----------
+        x0s : array_like with shape (N, dim)
+            one corner of each box
+        x1s : array_like with shape (N, dim)
+            the opposite corner of each box
+        levels : int or array_like of integers with shape (N)
+            minimum level of the cells overlapping each box
+        finalize : bool, optional
+            Whether to finalize after refining
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32,32])
+        >>> mesh.refine_box([0.25, 0.25], [0.75, 0.5], mesh.max_level)
+        """
+        self._check_unfinalized('refine_box')
+        x0s = np.require(np.atleast_2d(x0s), dtype=np.float64,
+                         requirements='C')
+        x1s = np.require(np.atleast_2d(x1s), dtype=np.float64,
+                         requirements='C')
+        if x0s.shape != x1s.shape or x0s.shape[1] != self._dim:
+            raise ValueError(
+                "x0s and x1s must both have the shape (N, {})".format(self._dim)
+            )
+        cdef int_t n = x0s.shape[0]
+        cdef double[:, :] x0 = x0s
+        cdef double[:, :] x1 = x1s
+        cdef int[:] ls = _refine_levels(levels, n)
+        if n > 0:
+            with nogil:
+                self.tree.refine_box(&x0[0, 0], &x1[0, 0], &ls[0], n)
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def refine_line(self, path, levels, finalize=True):
+        """Refine the TreeMesh along a piecewise linear path
+
+        Refines the TreeMesh so that every cell crossed by a segment of the
+        path is at least at that segment's level.
+
+        Parameters
+        ----------
+        path : array_like with shape (N, dim)
+            the points of the path, with N >= 2
+        levels : int or array_like of integers with shape (N - 1)
+            minimum level of the cells crossed by each segment
+        finalize : bool, optional
+            Whether to finalize after refining
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32,32])
+        >>> mesh.refine_line([[0.1, 0.1], [0.5, 0.9], [0.9, 0.2]], mesh.max_level)
+        """
+        self._check_unfinalized('refine_line')
+        path = np.require(np.atleast_2d(path), dtype=np.float64,
+                          requirements='C')
+        if path.shape[1] != self._dim or path.shape[0] < 2:
+            raise ValueError(
+                "path must have the shape (N, {}), with N >= 2".format(self._dim)
+            )
+        cdef int_t n = path.shape[0] - 1
+        cdef double[:, :] ps = path
+        cdef int[:] ls = _refine_levels(levels, n)
+        with nogil:
+            self.tree.refine_line(&ps[0, 0], &ls[0], n)
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def refine_surface(self, xyz, levels, padding=None, finalize=True):
+        """Refine the TreeMesh along a triangulated surface
+
+        Refines the TreeMesh so that every cell within a padding distance of a
+        triangle is at least at that triangle's level.
+
+        Parameters
+        ----------
+        xyz : array_like with shape (N, 3, dim) or tuple
+            the triangles, as an array of their corners, or as a tuple of
+            (vertices, simplices) of shapes (n_vertices, dim) and (N, 3)
+        levels : int or array_like of integers with shape (N)
+            minimum level of the cells near each triangle
+        padding : float or array_like with shape (dim) or (N, dim), optional
+            the distance along each axis to pad the cells by when testing
+            for intersection with the triangles
+        finalize : bool, optional
+            Whether to finalize after refining
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32, 32, 32])
+        >>> tris = [[[0.1, 0.1, 0.5], [0.9, 0.1, 0.6], [0.5, 0.9, 0.4]]]
+        >>> mesh.refine_surface(tris, mesh.max_level, padding=[0, 0, 0.1])
+        """
+        self._check_unfinalized('refine_surface')
+        if isinstance(xyz, tuple):
+            vertices, simplices = xyz
+            xyz = np.asarray(vertices)[np.asarray(simplices)]
+        xyz = np.require(xyz, dtype=np.float64, requirements='C')
+        if xyz.ndim == 2:
+            xyz = xyz[None, :, :]
+        if xyz.ndim != 3 or xyz.shape[1:] != (3, self._dim):
+            raise ValueError(
+                "triangles must have the shape (N, 3, {})".format(self._dim)
+            )
+        cdef int_t n = xyz.shape[0]
+        if padding is None:
+            padding = 0.0
+        cdef double[:, :, :] tris = xyz
+        cdef double[:, :] pad = np.array(
+            np.broadcast_to(padding, (n, self._dim)), dtype=np.float64
+        )
+        cdef int[:] ls = _refine_levels(levels, n)
+        if n > 0:
+            with nogil:
+                self.tree.refine_triangle(&tris[0, 0, 0], &ls[0], &pad[0, 0], n)
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def _refine_center_boxes(self, x0s, x1s, levels, finalize=True):
+        """Refine the cells whose centers are strictly inside boxes
+
+        Cells are tested in the order of refine: a cell whose center is in a
+        box is divided until it reaches the level of the first such box, and
+        cells divided only to balance the tree are tested once the
+        traversal reaches them. The test runs natively, without calling back
+        into Python.
+        """
+        self._check_unfinalized('_refine_center_boxes')
+        x0s = np.require(np.atleast_2d(x0s), dtype=np.float64,
+                         requirements='C')
+        x1s = np.require(np.atleast_2d(x1s), dtype=np.float64,
+                         requirements='C')
+        if x0s.shape != x1s.shape or x0s.shape[1] != self._dim:
+            raise ValueError(
+                "x0s and x1s must both have the shape (N, {})".format(self._dim)
+            )
+        cdef int n = x0s.shape[0]
+        cdef double[:, :] x0 = x0s
+        cdef double[:, :] x1 = x1s
+        cdef int[:] ls = _refine_levels(levels, n)
+        cdef _CenterBoxes boxes
+        boxes.n = n
+        boxes.dim = self._dim
+        if n > 0:
+            boxes.x0s = &x0[0, 0]
+            boxes.x1s = &x1[0, 0]
+            boxes.levels = &ls[0]
+            self.wrapper.set(<void *> &boxes, _evaluate_center_boxes)
+            self.tree.build_tree_from_function(self.wrapper)
+        self._forget_fingerprint()
         if finalize:
             self.finalize()
 
@@ -449,13 +850,296 @@ cdef class _TreeMesh:
         After finalize is called, all other attributes and functions are valid.
         """
         if not self._finalized:
-            self.tree.finalize_lists()
-            self.tree.number()
+            with nogil:
+                self.tree.finalize_lists()
+                self.tree.number()
             self._finalized=True
+            self._forget_fingerprint()
+
+    def _forget_fingerprint(self):
+        # the fingerprint hashes the cells, so it is stale once they change
+        operator_cache(self)._fingerprint = None
 
     def number(self):
         """Number the cells, nodes, faces, and edges of the TreeMesh"""
-        self.tree.number()
+        with nogil:
+            self.tree.number()
+
+    def _unfinalize(self):
+        # drop the finalized lists so that the tree can be divided again
+        with nogil:
+            self.tree.clear_lists()
+        self._finalized = False
+        self._clear_cache()
+
+    def coarsen(self, levels, finalize=True):
+        """Coarsen the TreeMesh by merging cells back into their parents
+
+        The children of a cell are merged into it when all of the cells below
+        it ask for the cell's level or coarser. A merge only happens if the
+        tree stays balanced, so no cell ends up next to a cell more than one
+        level finer than it. Merges are repeated until none are left, as one
+        merge can allow its neighbors to merge.
+
+        Parameters
+        ----------
+        levels : int | array_like of int | callable
+            the desired level of each cell, as one integer for every cell, an
+            array of shape (nC) in the current cell order, or a function of a
+            `TreeCell` returning the desired level of that cell.
+        finalize : bool, optional
+            Whether to finalize the mesh
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32, 32])
+        >>> mesh.refine(5)
+        >>> mesh.coarsen(np.where(mesh.gridCC[:, 0] < 0.5, 5, 2))
+
+        See Also
+        --------
+        discretize.TreeMesh.adapt : change a finalized mesh and get the
+            matrices to transfer fields onto it
+        """
+        # the leaves need an index to look up their level
+        self.finalize()
+        if callable(levels):
+            levels = [levels(self[i]) for i in range(self.nC)]
+        cdef int[:] ls = np.array(np.broadcast_to(levels, self.nC), dtype=np.int32)
+        self._unfinalize()
+        if ls.shape[0] > 0:
+            with nogil:
+                self.tree.coarsen(&ls[0])
+        self._forget_fingerprint()
+        if finalize:
+            self.finalize()
+
+    def adapt(self, function=None, coarsen=None):
+        """Refine and coarsen a finalized TreeMesh in place
+
+        Coarsens the mesh with the same rules as `coarsen`, then refines it
+        with the same rules as `refine`, and returns the matrices that carry
+        fields defined on the mesh before the change over to the new mesh.
+        The cells of the tree are changed in place, but the mesh is numbered
+        again as a whole.
+
+        Cells that were split take the value of the cell they came from, and
+        cells that were merged take the volume average of the cells merged
+        into them. Nodes, faces and edges inside of a cell from before the
+        change are interpolated multilinearly along the directions their values
+        vary in (faces along their normal, edges across their direction).
+        Faces and edges of merged cells take the area or length weighted
+        average of the old faces or edges that they cover. Linear fields are
+        transferred exactly.
+
+        All of the cached grids and operators, including the deflation and
+        averaging matrices, are dropped and rebuilt in full the next time
+        they are used. Updating them incrementally around the changed cells
+        is not supported: the operators are built in single passes over the
+        whole tree, with no builder for a subset of their rows, and the new
+        numbering of the items changes every row and column anyway. The
+        returned transfer matrices are the only thing carried over from the
+        old mesh.
+
+        Parameters
+        ----------
+        function : callable | int, optional
+            a function describing the desired level,
+            or an integer to refine all cells to at least that level.
+        coarsen : int | array_like of int | callable, optional
+            the desired level of each cell, see `coarsen`.
+
+        Returns
+        -------
+        dict
+            sparse matrices keyed by 'CC', 'N', 'F' and 'E', each of shape
+            (n_new, n_old), that map the values on the old cells, nodes, faces
+            or edges onto the new ones.
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([32, 32])
+        >>> mesh.refine(3)
+        >>> sigma = np.random.rand(mesh.nC)
+        >>> P = mesh.adapt(lambda cell: 5 if cell.center[0] < 0.25 else 3)
+        >>> sigma = P['CC']*sigma
+        """
+        if not self._finalized:
+            raise ValueError(
+                "adapt needs a finalized mesh, use refine to build the mesh"
+            )
+        old = self._transfer_state()
+        if coarsen is not None:
+            self.coarsen(coarsen, finalize=False)
+        if function is not None:
+            if self._finalized:
+                self._unfinalize()
+            self.refine(function)
+        self.finalize()
+        return self._transfer_from(old)
+
+    def _transfer_state(self):
+        # everything needed to transfer fields off of the current mesh
+        dim = self._dim
+        locs = ['N'] + ['F'+d for d in 'xyz'[:dim]] + ['E'+d for d in 'xyz'[:dim]]
+        inds, levels = self.__getstate__()
+        return {
+            'inds': inds,
+            'levels': levels,
+            'lo': self.gridCC - 0.5*self.h_gridded,
+            'hi': self.gridCC + 0.5*self.h_gridded,
+            'items': {loc: self._cell_item_indexes(loc) for loc in locs},
+            'deflate': {loc: self._deflate_items(loc) for loc in locs},
+        }
+
+    def _transfer_from(self, old):
+        # the matrices taking fields on the mesh described by old onto this mesh
+        dim = self._dim
+        n_max = max(self._xs.shape[0], self._ys.shape[0], self._zs.shape[0])
+        inds, levels = self.__getstate__()
+        lo = self.gridCC - 0.5*self.h_gridded
+        hi = self.gridCC + 0.5*self.h_gridded
+        n_old = old['levels'].shape[0]
+
+        # new cells that lie in an old cell, and old cells that were merged
+        # into a new cell
+        split = _containing_cells(
+            inds, levels, old['inds'], old['levels'], self.max_level, n_max
+        )
+        merged = _containing_cells(
+            old['inds'], old['levels'], inds, levels, self.max_level, n_max
+        )
+        merged_old = np.where(
+            (merged >= 0) & (levels[np.maximum(merged, 0)] < old['levels'])
+        )[0]
+        merged_new = merged[merged_old]
+        in_old = np.where(split >= 0)[0]
+
+        vol_old = np.prod(old['hi'] - old['lo'], axis=1)
+        transfer = {}
+        transfer['CC'] = sp.csr_matrix(
+            (np.r_[np.ones(in_old.shape[0]), vol_old[merged_old]/self.vol[merged_new]],
+             (np.r_[in_old, merged_new], np.r_[split[in_old], merged_old])),
+            shape=(self.nC, n_old)
+        )
+        for loc, old_items in old['items'].items():
+            items = self._cell_item_indexes(loc)
+            n = getattr(self, 'n'+loc)
+            k = items.shape[1]
+            axes = _item_axes(loc, dim)
+            across = [a for a in range(dim) if a not in axes]
+            # each item is transferred from the first cell it is found in
+            uniq, first = np.unique(items, return_index=True)
+            first = first[uniq < n]
+            chosen = np.zeros(items.shape, dtype=bool)
+            chosen.flat[first] = True
+
+            # items of cells inside an old cell are interpolated in it
+            c = first//k
+            sel = split[c] >= 0
+            rows = items.flat[first[sel]]
+            o = split[c[sel]]
+            W = _corner_weights(
+                getattr(self, 'grid'+loc)[rows], old['lo'][o], old['hi'][o], axes
+            )
+            I = [np.repeat(rows, k)]
+            J = [old_items[o].reshape(-1)]
+            V = [W.reshape(-1)]
+
+            # items of merged cells average the old items lying on them
+            for j in range(k):
+                on = chosen[merged_new, j]
+                for b, a in enumerate(axes):
+                    side = old['hi'] if (j >> b) & 1 else old['lo']
+                    new_side = hi if (j >> b) & 1 else lo
+                    on &= np.abs(
+                        side[merged_old, a] - new_side[merged_new, a]
+                    ) < 0.25*(old['hi'][merged_old, a] - old['lo'][merged_old, a])
+                w = np.ones(np.count_nonzero(on))
+                for a in across:
+                    w *= (
+                        (old['hi'][merged_old[on], a] - old['lo'][merged_old[on], a])
+                        /(hi[merged_new[on], a] - lo[merged_new[on], a])
+                    )
+                I.append(items[merged_new[on], j])
+                J.append(old_items[merged_old[on], j])
+                V.append(w)
+
+            P = sp.csr_matrix(
+                (np.concatenate(V), (np.concatenate(I), np.concatenate(J))),
+                shape=(n, old['deflate'][loc].shape[0])
+            )*old['deflate'][loc]
+            P.eliminate_zeros()
+            transfer[loc] = P
+        transfer['F'] = sp.block_diag(
+            [transfer.pop('F'+d) for d in 'xyz'[:dim]], format='csr'
+        )
+        transfer['E'] = sp.block_diag(
+            [transfer.pop('E'+d) for d in 'xyz'[:dim]], format='csr'
+        )
+        return transfer
+
+    def get_transfer_matrix(self, other, kind='volume_average'):
+        """Matrix transferring a cell centered model onto another TreeMesh
+
+        The two meshes must share the same base grid (the same h and x0). Both
+        trees are walked together, so no points need to be located.
+
+        Parameters
+        ----------
+        other : TreeMesh
+            the mesh to transfer onto
+        kind : {'volume_average', 'nearest'}
+            With 'volume_average', each cell of other is given the volume
+            weighted average of the cells of this mesh that it overlaps, which
+            conserves the integral of the model. With 'nearest', each cell of
+            other takes the value of the cell of this mesh containing its
+            center.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix of shape (other.nC, nC)
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh1 = TreeMesh([32, 32])
+        >>> mesh1.refine_ball([0.3, 0.3], 0.1, mesh1.max_level)
+        >>> mesh2 = TreeMesh([32, 32])
+        >>> mesh2.refine_ball([0.7, 0.7], 0.1, mesh2.max_level)
+        >>> P = mesh1.get_transfer_matrix(mesh2)
+        >>> model2 = P @ np.random.rand(mesh1.nC)
+        """
+        if kind not in ['volume_average', 'nearest']:
+            raise ValueError(
+                "kind must be 'volume_average' or 'nearest', not {!r}".format(kind)
+            )
+        if not isinstance(other, _TreeMesh):
+            raise TypeError("other must be a TreeMesh")
+        cdef _TreeMesh target = other
+        if (
+            target._dim != self._dim
+            or any(len(h1) != len(h2) or not np.allclose(h1, h2) for h1, h2 in zip(self.h, other.h))
+            or not np.allclose(self.x0, other.x0)
+        ):
+            raise ValueError("The two meshes must have the same h and x0")
+        if not (self._finalized and target._finalized):
+            raise ValueError("Both meshes must be finalized")
+
+        cdef vector[long long] rows, cols
+        cdef vector[double] vals
+        cdef bint nearest = kind == 'nearest'
+        with nogil:
+            self.tree.transfer(target.tree, nearest, rows, cols, vals)
+        cdef np.int64_t n = rows.size()
+        if n == 0:
+            return sp.csr_matrix((other.nC, self.nC))
+        I = np.asarray(<long long[:n]> rows.data()).copy()
+        J = np.asarray(<long long[:n]> cols.data()).copy()
+        V = np.asarray(<double[:n]> vals.data()).copy()
+        return sp.csr_matrix((V, (I, J)), shape=(other.nC, self.nC))
 
     def _set_x0(self, x0):
         if not isinstance(x0, (list, tuple, np.ndarray)):
@@ -491,34 +1175,28 @@ cdef class _TreeMesh:
                 for i in range(dim):
                     node.location[i] += shift[i]
 
-            for itE in self.tree.edges_x:
-                edge = itE.second
+            for edge in self.tree.edges_x:
                 for i in range(dim):
                     edge.location[i] += shift[i]
 
-            for itE in self.tree.edges_y:
-                edge = itE.second
+            for edge in self.tree.edges_y:
                 for i in range(dim):
                     edge.location[i] += shift[i]
 
             if dim == 3:
-                for itE in self.tree.edges_z:
-                    edge = itE.second
+                for edge in self.tree.edges_z:
                     for i in range(dim):
                         edge.location[i] += shift[i]
 
-                for itF in self.tree.faces_x:
-                    face = itF.second
+                for face in self.tree.faces_x:
                     for i in range(dim):
                         face.location[i] += shift[i]
 
-                for itF in self.tree.faces_y:
-                    face = itF.second
+                for face in self.tree.faces_y:
                     for i in range(dim):
                         face.location[i] += shift[i]
 
-                for itF in self.tree.faces_z:
-                    face = itF.second
+                for face in self.tree.faces_z:
                     for i in range(dim):
                         face.location[i] += shift[i]
             #clear out all cached grids
@@ -567,6 +1245,100 @@ cdef class _TreeMesh:
         """The maximum possible level for a cell on this mesh"""
         return self.tree.max_level
 
+    @property
+    def ordering(self):
+        """The numbering of the mesh's items, 'default', 'morton' or 'hilbert'
+
+        With 'morton' or 'hilbert', the cells, nodes, edges and faces are each
+        numbered along the space filling curve, non-hanging items first.
+        """
+        return _orderings[self.tree.ordering]
+
+    @cython.boundscheck(False)
+    def get_ordering_permutation(self, locType='CC'):
+        """Permutation from this mesh's numbering to the default numbering
+
+        Parameters
+        ----------
+        locType : str
+            One of 'CC', 'N', 'Fx', 'Fy', 'Fz', 'F', 'Ex', 'Ey', 'Ez' or 'E'
+
+        Returns
+        -------
+        numpy.ndarray of int
+            The indices P, such that v[P] holds the values of v, defined on
+            the (non-hanging) locType items of this mesh, in the order they
+            would have on the same mesh created with ordering='default'.
+        """
+        if locType == 'F':
+            return np.concatenate([
+                self.get_ordering_permutation('F'+d)+offset
+                for d, offset in zip('xyz'[:self._dim], np.cumsum(np.r_[0, self.vnF])[:-1])
+            ])
+        if locType == 'E':
+            return np.concatenate([
+                self.get_ordering_permutation('E'+d)+offset
+                for d, offset in zip('xyz'[:self._dim], np.cumsum(np.r_[0, self.vnE])[:-1])
+            ])
+        if self._dim == 2 and locType in ['Fx', 'Fy']:
+            locType = 'Ey' if locType == 'Fx' else 'Ex'
+
+        cdef vector[c_Cell *] cells
+        cdef vector[Edge *] *edges
+        cdef vector[Face *] *faces
+        cdef Node *node
+        cdef np.int64_t i, ii = 0
+        cdef np.int64_t[:] P
+        if locType == 'CC':
+            # the default numbering is the traversal order of the roots
+            for iz in range(self.tree.nz_roots):
+                for iy in range(self.tree.ny_roots):
+                    for ix in range(self.tree.nx_roots):
+                        self.tree.roots[iz][iy][ix].build_cell_vector(cells)
+            P = np.empty(cells.size(), dtype=np.int64)
+            for i in range(cells.size()):
+                P[i] = cells[i].index
+            return np.asarray(P)
+        if locType == 'N':
+            # the default numbering of the non-hanging nodes is their key order,
+            # which is the order of the node pool
+            P = np.empty(self.nN, dtype=np.int64)
+            for i in range(self.tree.nodes.pool.size()):
+                node = &self.tree.nodes.pool[i]
+                if not node.hanging:
+                    P[ii] = node.index
+                    ii += 1
+            return np.asarray(P)
+
+        # edges and faces are stored in key order
+        if locType == 'Ex':
+            edges = &self.tree.edges_x
+        elif locType == 'Ey':
+            edges = &self.tree.edges_y
+        elif locType == 'Ez' and self._dim == 3:
+            edges = &self.tree.edges_z
+        elif locType == 'Fx' and self._dim == 3:
+            faces = &self.tree.faces_x
+        elif locType == 'Fy' and self._dim == 3:
+            faces = &self.tree.faces_y
+        elif locType == 'Fz' and self._dim == 3:
+            faces = &self.tree.faces_z
+        else:
+            raise ValueError('Invalid locType {!r}'.format(locType))
+        if locType[0] == 'E':
+            P = np.empty(getattr(self, 'n'+locType), dtype=np.int64)
+            for i in range(edges.size()):
+                if not edges[0][i].hanging:
+                    P[ii] = edges[0][i].index
+                    ii += 1
+        else:
+            P = np.empty(getattr(self, 'n'+locType), dtype=np.int64)
+            for i in range(faces.size()):
+                if not faces[0][i].hanging:
+                    P[ii] = faces[0][i].index
+                    ii += 1
+        return np.asarray(P)
+
     @property
     def nC(self):
         """Number of cells"""
@@ -739,13 +1511,13 @@ cdef class _TreeMesh:
         """
         cdef np.float64_t[:, :] gridN
         cdef Node *node
-        cdef np.int64_t ii, ind, dim
+        cdef np.int64_t it, ii, ind, dim
         if self._gridN is None:
             dim = self._dim
             self._gridN = np.empty((self.nN, dim) ,dtype=np.float64)
             gridN = self._gridN
-            for it in self.tree.nodes:
-                node = it.second
+            for it in range(self.tree.nodes.pool.size()):
+                node = &self.tree.nodes.pool[it]
                 if not node.hanging:
                     ind = node.index
                     for ii in range(dim):
@@ -792,6 +1564,273 @@ cdef class _TreeMesh:
 
         return self._h_gridded
 
+    @property
+    def cell_nodes(self):
+        """
+        Returns an (nC, 2**dim) numpy array with the indexes of each cell's
+        nodes, in the same order as `TreeCell.nodes`. Indexes of nN and above
+        are hanging nodes, in the order of gridhN.
+        """
+        if self._cell_nodes is None:
+            self._cell_nodes = self._cell_item_indexes('N')
+        return self._cell_nodes
+
+    @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def cell_edges(self):
+        """
+        Returns an (nC, 4) numpy array in 2D, or (nC, 12) in 3D, with the
+        indexes of each cell's edges, in the same order as `TreeCell.edges`.
+        The edges are numbered with all of the x edges (hanging ones after
+        non-hanging) first, then the y and z edges, so the indexes run up to
+        ntE.
+        """
+        if self._cell_edges is not None:
+            return self._cell_edges
+        cdef int_t dim = self._dim
+        cdef int_t n_edges = 4 if dim == 2 else 12
+        cdef int_t epd = n_edges//dim
+        cdef np.int64_t[:] offsets = np.cumsum(
+            [0, self.ntEx, self.ntEy, self.ntEz], dtype=np.int64)
+        cdef np.int64_t n_cells = self.tree.cells.size()
+        cdef np.int64_t[:, :] out = np.empty((n_cells, n_edges), dtype=np.int64)
+        cdef c_Cell *cell
+        cdef np.int64_t i, j
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
+            for j in range(n_edges):
+                out[cell.index, j] = cell.edges[j].index + offsets[j//epd]
+        self._cell_edges = np.asarray(out)
+        return self._cell_edges
+
+    @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def cell_faces(self):
+        """
+        Returns an (nC, 2*dim) numpy array with the indexes of each cell's
+        faces, ordered -x, +x, -y, +y, -z, +z. The faces are numbered with
+        all of the x faces (hanging ones after non-hanging) first, then the y
+        and z faces, so the indexes run up to ntF.
+        """
+        if self._cell_faces is not None:
+            return self._cell_faces
+        cdef int_t dim = self._dim
+        cdef np.int64_t[:] offsets = np.cumsum(
+            [0, self.ntFx, self.ntFy, self.ntFz], dtype=np.int64)
+        cdef np.int64_t n_cells = self.tree.cells.size()
+        cdef np.int64_t[:, :] out = np.empty((n_cells, 2*dim), dtype=np.int64)
+        cdef c_Cell *cell
+        cdef np.int64_t i, j
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
+            for j in range(2*dim):
+                if dim == 3:
+                    out[cell.index, j] = cell.faces[j].index + offsets[j//2]
+                else:
+                    # the x faces of a 2D cell are its y edges
+                    out[cell.index, j] = cell.edges[j^2].index + offsets[j//2]
+        self._cell_faces = np.asarray(out)
+        return self._cell_faces
+
+    @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def face_cells(self):
+        """
+        Returns an (ntF, 2) numpy array with the indexes of the cells on the
+        negative and positive side of each face, numbered as in cell_faces.
+        The entry is -1 where there is no cell on that side: on the boundary
+        of the mesh, and on the finer side of a face that is split into
+        hanging faces.
+        """
+        if self._face_cells is not None:
+            return self._face_cells
+        cdef int_t dim = self._dim
+        cdef np.int64_t[:, :] faces = self.cell_faces
+        cdef np.int64_t n_cells = self.tree.cells.size()
+        cdef np.int64_t[:, :] out = np.full((self.ntF, 2), -1, dtype=np.int64)
+        cdef c_Cell *cell
+        cdef c_Cell *other
+        cdef np.int64_t i, j, f
+        cdef int hanging
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
+            for j in range(2*dim):
+                f = faces[cell.index, j]
+                out[f, 1 - j%2] = cell.index
+                if dim == 3:
+                    hanging = cell.faces[j].hanging
+                else:
+                    hanging = cell.edges[j^2].hanging
+                # across a hanging face is the coarser cell that holds its parent
+                other = cell.neighbors[j]
+                if hanging and other != NULL:
+                    out[f, j%2] = other.index
+        self._face_cells = np.asarray(out)
+        return self._face_cells
+
+    @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def edge_nodes(self):
+        """
+        Returns an (ntE, 2) numpy array with the indexes of the nodes at the
+        start and end of each edge, numbered as in cell_edges and cell_nodes.
+        """
+        if self._edge_nodes is not None:
+            return self._edge_nodes
+        cdef np.int64_t[:, :] out = np.empty((self.ntE, 2), dtype=np.int64)
+        cdef vector[Edge *] *edges
+        cdef np.int64_t offset = 0
+        cdef np.int64_t i, d, n_edges
+        cdef Edge *edge
+        for d in range(self._dim):
+            if d == 0:
+                edges = &self.tree.edges_x
+            elif d == 1:
+                edges = &self.tree.edges_y
+            else:
+                edges = &self.tree.edges_z
+            n_edges = edges.size()
+            for i in prange(n_edges, nogil=True):
+                edge = edges[0][i]
+                out[edge.index + offset, 0] = edge.points[0].index
+                out[edge.index + offset, 1] = edge.points[1].index
+            offset += n_edges
+        self._edge_nodes = np.asarray(out)
+        return self._edge_nodes
+
+    @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def cell_neighbors(self):
+        """
+        Returns the neighbors of each cell in compressed sparse row form, as
+        a tuple of the numpy arrays (indptr, indices). The neighbors of cell
+        i across its face j (ordered -x, +x, -y, +y, -z, +z) are
+        ``indices[indptr[2*dim*i + j]:indptr[2*dim*i + j + 1]]``, in the same
+        order as `TreeCell.neighbors`. Across a face split into hanging faces
+        there are 2**(dim-1) neighbors, and none on the boundary of the mesh.
+        """
+        if self._cell_neighbors is not None:
+            return self._cell_neighbors
+        cdef int_t dim = self._dim
+        cdef int_t n_dir = 2*dim
+        cdef np.int64_t n_cells = self.tree.cells.size()
+        cdef np.int64_t[:] counts = np.zeros(n_cells*n_dir + 1, dtype=np.int64)
+        cdef c_Cell *cell
+        cdef c_Cell *other
+        cdef np.int64_t i, j, k, ind
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
+            for j in range(n_dir):
+                other = cell.neighbors[j]
+                if other == NULL:
+                    counts[cell.index*n_dir + j + 1] = 0
+                elif other.is_leaf():
+                    counts[cell.index*n_dir + j + 1] = 1
+                else:
+                    counts[cell.index*n_dir + j + 1] = 1<<(dim-1)
+        indptr = np.cumsum(counts)
+        cdef np.int64_t[:] ptr = indptr
+        cdef np.int64_t[:] out = np.empty(ptr[n_cells*n_dir], dtype=np.int64)
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
+            for j in range(n_dir):
+                other = cell.neighbors[j]
+                ind = ptr[cell.index*n_dir + j]
+                if other == NULL:
+                    continue
+                if other.is_leaf():
+                    out[ind] = other.index
+                    continue
+                # the children of the neighbor that touch this cell
+                for k in range(1<<dim):
+                    if ((k>>(j//2))&1) != j%2:
+                        out[ind] = other.children[k].index
+                        ind = ind + 1
+        self._cell_neighbors = (indptr, np.asarray(out))
+        return self._cell_neighbors
+
+    @property
+    def cell_adjacency(self):
+        """
+        Returns the cell adjacency graph as a symmetric scipy.sparse.csr_matrix
+        of shape (nC, nC), with a one for every pair of cells sharing (part
+        of) a face. A cell on the coarse side of hanging faces is connected
+        to each of the 2**(dim-1) finer cells across them. See
+        `get_cell_adjacency` for the graph restricted to one direction or
+        weighted by the shared face areas.
+        """
+        A = self.get_cell_adjacency(weighted=True)
+        return sp.csr_matrix(
+            (np.ones_like(A.data), A.indices, A.indptr), shape=A.shape
+        )
+
+    def get_cell_adjacency(self, direction=None, weighted=False):
+        """
+        Returns the cell adjacency graph as a symmetric scipy.sparse.csr_matrix
+        of shape (nC, nC).
+
+        Parameters
+        ----------
+        direction : {None, 'x', 'y', 'z', 0, 1, 2}
+            only connect cells across faces normal to this direction, by default
+            all faces are used.
+        weighted : bool
+            If True, the entries are the areas of the faces shared by the two
+            cells (the lengths of the shared edges in 2D), otherwise ones.
+
+        Examples
+        --------
+        The graph Laplacian connecting each cell to its neighbors along x:
+
+        >>> A = mesh.get_cell_adjacency('x')
+        >>> L = sp.diags(np.asarray(A.sum(axis=1)).ravel()) - A
+        """
+        if self._cell_adjacency is None:
+            indptr, indices = self.cell_neighbors
+            n_cells = self.nC
+            n_dir = 2*self._dim
+            slots = np.repeat(np.arange(n_cells*n_dir), np.diff(indptr))
+            # every pair is found once from the cell on its negative side
+            plus = slots%2 == 1
+            rows = slots[plus]//n_dir
+            cols = indices[plus]
+            axes = slots[plus]%n_dir//2
+            h = self.h_gridded
+            areas = self.vol[:, None]/h
+            # a hanging face is only as large as the finer of the two cells
+            areas = np.minimum(areas[rows, axes], areas[cols, axes])
+            self._cell_adjacency = []
+            for axis in range(self._dim):
+                on_axis = axes == axis
+                A = sp.csr_matrix(
+                    (areas[on_axis], (rows[on_axis], cols[on_axis])),
+                    shape=(n_cells, n_cells)
+                )
+                self._cell_adjacency.append((A + A.T).tocsr())
+
+        if direction is None:
+            A = self._cell_adjacency[0]
+            for A_axis in self._cell_adjacency[1:]:
+                A = A + A_axis
+        else:
+            if direction in ['x', 'y', 'z']:
+                direction = 'xyz'.index(direction)
+            if direction not in range(self._dim):
+                raise ValueError(
+                    "direction must be None or one of {}, not {!r}".format(
+                        list('xyz'[:self._dim]), direction
+                    )
+                )
+            A = self._cell_adjacency[direction].copy()
+        if not weighted:
+            A.data = np.ones_like(A.data)
+        return A
+
     @property
     def gridEx(self):
         """
@@ -805,8 +1844,7 @@ cdef class _TreeMesh:
             dim = self._dim
             self._gridEx = np.empty((self.nEx, dim), dtype=np.float64)
             gridEx = self._gridEx
-            for it in self.tree.edges_x:
-                edge = it.second
+            for edge in self.tree.edges_x:
                 if not edge.hanging:
                     ind = edge.index
                     for ii in range(dim):
@@ -845,8 +1883,7 @@ cdef class _TreeMesh:
             dim = self._dim
             self._gridEy = np.empty((self.nEy, dim), dtype=np.float64)
             gridEy = self._gridEy
-            for it in self.tree.edges_y:
-                edge = it.second
+            for edge in self.tree.edges_y:
                 if not edge.hanging:
                     ind = edge.index
                     for ii in range(dim):
@@ -885,8 +1922,7 @@ cdef class _TreeMesh:
             dim = self._dim
             self._gridEz = np.empty((self.nEz, dim), dtype=np.float64)
             gridEz = self._gridEz
-            for it in self.tree.edges_z:
-                edge = it.second
+            for edge in self.tree.edges_z:
                 if not edge.hanging:
                     ind = edge.index
                     for ii in range(dim):
@@ -927,8 +1963,7 @@ cdef class _TreeMesh:
             dim = self._dim
             self._gridFx = np.empty((self.nFx, dim), dtype=np.float64)
             gridFx = self._gridFx
-            for it in self.tree.faces_x:
-                face = it.second
+            for face in self.tree.faces_x:
                 if not face.hanging:
                     ind = face.index
                     for ii in range(dim):
@@ -949,8 +1984,7 @@ cdef class _TreeMesh:
             dim = self._dim
             self._gridFy = np.empty((self.nFy, dim), dtype=np.float64)
             gridFy = self._gridFy
-            for it in self.tree.faces_y:
-                face = it.second
+            for face in self.tree.faces_y:
                 if not face.hanging:
                     ind = face.index
                     for ii in range(dim):
@@ -972,8 +2006,7 @@ cdef class _TreeMesh:
             dim = self._dim
             self._gridFz = np.empty((self.nFz, dim), dtype=np.float64)
             gridFz = self._gridFz
-            for it in self.tree.faces_z:
-                face = it.second
+            for face in self.tree.faces_z:
                 if not face.hanging:
                     ind = face.index
                     for ii in range(dim):
@@ -1072,20 +2105,17 @@ cdef class _TreeMesh:
             self._area = np.empty(self.nF, dtype=np.float64)
             area = self._area
 
-            for it in self.tree.faces_x:
-                face = it.second
+            for face in self.tree.faces_x:
                 if face.hanging: continue
                 area[face.index] = face.area
 
             offset = self.nFx
-            for it in self.tree.faces_y:
-                face = it.second
+            for face in self.tree.faces_y:
                 if face.hanging: continue
                 area[face.index + offset] = face.area
 
             offset = self.nFx + self.nFy
-            for it in self.tree.faces_z:
-                face = it.second
+            for face in self.tree.faces_z:
                 if face.hanging: continue
                 area[face.index + offset] = face.area
         return self._area
@@ -1103,21 +2133,18 @@ cdef class _TreeMesh:
             self._edge = np.empty(self.nE, dtype=np.float64)
             edge_l = self._edge
 
-            for it in self.tree.edges_x:
-                edge = it.second
+            for edge in self.tree.edges_x:
                 if edge.hanging: continue
                 edge_l[edge.index] = edge.length
 
             offset = self.nEx
-            for it in self.tree.edges_y:
-                edge = it.second
+            for edge in self.tree.edges_y:
                 if edge.hanging: continue
                 edge_l[edge.index + offset] = edge.length
 
             if self._dim > 2:
                 offset = self.nEx + self.nEy
-                for it in self.tree.edges_z:
-                    edge = it.second
+                for edge in self.tree.edges_z:
                     if edge.hanging: continue
                     edge_l[edge.index + offset] = edge.length
         return self._edge
@@ -1407,6 +2434,66 @@ cdef class _TreeMesh:
                 raise Exception('Path not found')
         return cell_indexes
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def get_ray_matrix(self, starts, ends):
+        """Lengths of line segments inside of each cell
+
+        The segments are traced through the tree in parallel. Any part of a
+        segment outside of the mesh is ignored.
+
+        Parameters
+        ----------
+        starts, ends : array_like of shape (n_rays, dim)
+            The beginning and ending points of the line segments
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix of shape (n_rays, nC)
+            The length of each segment inside of each cell
+
+        Examples
+        --------
+        >>> from discretize import TreeMesh
+        >>> mesh = TreeMesh([16, 16])
+        >>> mesh.refine_ball([0.5, 0.5], 0.2, mesh.max_level)
+        >>> src = np.c_[np.zeros(10), np.linspace(0, 1, 10)]
+        >>> rec = np.c_[np.ones(10), np.linspace(1, 0, 10)]
+        >>> G = mesh.get_ray_matrix(src, rec)
+        >>> travel_times = G @ np.ones(mesh.nC)
+        """
+        if not self._finalized:
+            raise ValueError("The TreeMesh must be finalized to trace rays")
+        starts = np.require(np.atleast_2d(starts), dtype=np.float64, requirements='C')
+        ends = np.require(np.atleast_2d(ends), dtype=np.float64, requirements='C')
+        if starts.shape != ends.shape or starts.shape[1] != self._dim:
+            raise ValueError(
+                "starts and ends must both have shape (n_rays, {}), not {} and {}".format(
+                    self._dim, starts.shape, ends.shape)
+            )
+        cdef double[:, :] a = starts
+        cdef double[:, :] b = ends
+        cdef np.int64_t n_rays = a.shape[0]
+        cdef vector[vector[pair[long long, double]]] hits
+        hits.resize(n_rays)
+        cdef np.int64_t i, j
+        for i in prange(n_rays, nogil=True):
+            self.tree.trace_ray(&a[i, 0], &b[i, 0], hits[i])
+
+        indptr = np.zeros(n_rays + 1, dtype=np.int64)
+        cdef np.int64_t[:] ptr = indptr
+        for i in range(n_rays):
+            ptr[i + 1] = ptr[i] + hits[i].size()
+        cdef np.int64_t[:] J = np.empty(ptr[n_rays], dtype=np.int64)
+        cdef np.float64_t[:] V = np.empty(ptr[n_rays], dtype=np.float64)
+        for i in prange(n_rays, nogil=True):
+            for j in range(<np.int64_t> hits[i].size()):
+                J[ptr[i] + j] = hits[i][j].first
+                V[ptr[i] + j] = hits[i][j].second
+        return sp.csr_matrix(
+            (np.asarray(V), np.asarray(J), indptr), shape=(n_rays, self.nC)
+        )
+
 
     @property
     def faceDiv(self):
@@ -1425,72 +2512,74 @@ cdef class _TreeMesh:
 
     @cython.cdivision(True)
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _faceDiv2D(self):
-        cdef np.int64_t[:] I = np.empty(self.nC*4, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(self.nC*4, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(self.nC*4, dtype=np.float64)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_cells = tree.cells.size()
+            np.int64_t[:] J = np.empty(n_cells*4, dtype=np.int64)
+            np.float64_t[:] V = np.empty(n_cells*4, dtype=np.float64)
 
-        cdef np.int64_t i = 0
-        cdef Edge *edges[4]
-        cdef np.int64_t offset = self.tree.edges_y.size()
-        cdef double volume
+            np.int64_t i
+            c_Cell *cell
+            np.int64_t offset = tree.edges_y.size()
+            double volume
 
-        for cell in self.tree.cells:
-            edges = cell.edges
-            i = cell.index
-            I[i*4 : i*4 + 4] = i
-            J[i*4    ] = edges[0].index + offset #x edge, y face (add offset)
-            J[i*4 + 1] = edges[1].index + offset #x edge, y face (add offset)
-            J[i*4 + 2] = edges[2].index #y edge, x face
-            J[i*4 + 3] = edges[3].index #y edge, x face
+        for i in prange(n_cells, nogil=True):
+            cell = tree.cells[i]
+            J[i*4    ] = cell.edges[0].index + offset #x edge, y face (add offset)
+            J[i*4 + 1] = cell.edges[1].index + offset #x edge, y face (add offset)
+            J[i*4 + 2] = cell.edges[2].index #y edge, x face
+            J[i*4 + 3] = cell.edges[3].index #y edge, x face
 
             volume = cell.volume
-            V[i*4    ] = -edges[0].length/volume
-            V[i*4 + 1] =  edges[1].length/volume
-            V[i*4 + 2] = -edges[2].length/volume
-            V[i*4 + 3] =  edges[3].length/volume
-        return sp.csr_matrix((V, (I, J)))
+            V[i*4    ] = -cell.edges[0].length/volume
+            V[i*4 + 1] =  cell.edges[1].length/volume
+            V[i*4 + 2] = -cell.edges[2].length/volume
+            V[i*4 + 3] =  cell.edges[3].length/volume
+        return _regular_csr(V, J, 4, (n_cells, self.ntF))
 
     @cython.cdivision(True)
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _faceDiv3D(self):
         cdef:
-            np.int64_t[:] I = np.empty(self.nC*6, dtype=np.int64)
-            np.int64_t[:] J = np.empty(self.nC*6, dtype=np.int64)
-            np.float64_t[:] V = np.empty(self.nC*6, dtype=np.float64)
-
-            np.int64_t i = 0
-            Face *faces[6]
-            np.int64_t offset1 = self.tree.faces_x.size()
-            np.int64_t offset2 = offset1 + self.tree.faces_y.size()
+            c_Tree *tree = self.tree
+            np.int64_t n_cells = tree.cells.size()
+            np.int64_t[:] J = np.empty(n_cells*6, dtype=np.int64)
+            np.float64_t[:] V = np.empty(n_cells*6, dtype=np.float64)
+
+            np.int64_t i
+            c_Cell *cell
+            np.int64_t offset1 = tree.faces_x.size()
+            np.int64_t offset2 = offset1 + tree.faces_y.size()
             double volume, fx_area, fy_area, fz_area
 
-        for cell in self.tree.cells:
-            faces = cell.faces
-            i = cell.index
-            I[i*6 : i*6 + 6] = i
-            J[i*6    ] = faces[0].index #x1 face
-            J[i*6 + 1] = faces[1].index #x2 face
-            J[i*6 + 2] = faces[2].index + offset1 #y face (add offset1)
-            J[i*6 + 3] = faces[3].index + offset1 #y face (add offset1)
-            J[i*6 + 4] = faces[4].index + offset2 #z face (add offset2)
-            J[i*6 + 5] = faces[5].index + offset2 #z face (add offset2)
+        for i in prange(n_cells, nogil=True):
+            cell = tree.cells[i]
+            J[i*6    ] = cell.faces[0].index #x1 face
+            J[i*6 + 1] = cell.faces[1].index #x2 face
+            J[i*6 + 2] = cell.faces[2].index + offset1 #y face (add offset1)
+            J[i*6 + 3] = cell.faces[3].index + offset1 #y face (add offset1)
+            J[i*6 + 4] = cell.faces[4].index + offset2 #z face (add offset2)
+            J[i*6 + 5] = cell.faces[5].index + offset2 #z face (add offset2)
 
             volume = cell.volume
-            fx_area = faces[0].area
-            fy_area = faces[2].area
-            fz_area = faces[4].area
+            fx_area = cell.faces[0].area
+            fy_area = cell.faces[2].area
+            fz_area = cell.faces[4].area
             V[i*6    ] = -fx_area/volume
             V[i*6 + 1] =  fx_area/volume
             V[i*6 + 2] = -fy_area/volume
             V[i*6 + 3] =  fy_area/volume
             V[i*6 + 4] = -fz_area/volume
             V[i*6 + 5] =  fz_area/volume
-        return sp.csr_matrix((V, (I, J)))
+        return _regular_csr(V, J, 6, (n_cells, self.ntF))
 
     @property
     @cython.cdivision(True)
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def edgeCurl(self):
         """
         Construct the 3D curl operator.
@@ -1498,24 +2587,25 @@ cdef class _TreeMesh:
         if self._edgeCurl is not None:
             return self._edgeCurl
         cdef:
-            int_t dim = self._dim
-            np.int64_t[:] I = np.empty(4*self.nF, dtype=np.int64)
+            c_Tree *tree = self.tree
             np.int64_t[:] J = np.empty(4*self.nF, dtype=np.int64)
             np.float64_t[:] V = np.empty(4*self.nF, dtype=np.float64)
             Face *face
-            int_t ii
-            int_t face_offset_y = self.nFx
-            int_t face_offset_z = self.nFx + self.nFy
-            int_t edge_offset_y = self.ntEx
-            int_t edge_offset_z = self.ntEx + self.ntEy
+            np.int64_t it, ii
+            np.int64_t n_x = tree.faces_x.size()
+            np.int64_t n_y = tree.faces_y.size()
+            np.int64_t n_z = tree.faces_z.size()
+            np.int64_t face_offset_y = self.nFx
+            np.int64_t face_offset_z = self.nFx + self.nFy
+            np.int64_t edge_offset_y = self.ntEx
+            np.int64_t edge_offset_z = self.ntEx + self.ntEy
             double area
 
-        for it in self.tree.faces_x:
-            face = it.second
+        for it in prange(n_x, nogil=True):
+            face = tree.faces_x[it]
             if face.hanging:
                 continue
             ii = face.index
-            I[4*ii : 4*ii + 4] = ii
             J[4*ii    ] = face.edges[0].index + edge_offset_z
             J[4*ii + 1] = face.edges[1].index + edge_offset_y
             J[4*ii + 2] = face.edges[2].index + edge_offset_z
@@ -1527,12 +2617,11 @@ cdef class _TreeMesh:
             V[4*ii + 2] =  face.edges[2].length/area
             V[4*ii + 3] =  face.edges[3].length/area
 
-        for it in self.tree.faces_y:
-            face = it.second
+        for it in prange(n_y, nogil=True):
+            face = tree.faces_y[it]
             if face.hanging:
                 continue
             ii = face.index + face_offset_y
-            I[4*ii : 4*ii + 4] = ii
             J[4*ii    ] = face.edges[0].index + edge_offset_z
             J[4*ii + 1] = face.edges[1].index
             J[4*ii + 2] = face.edges[2].index + edge_offset_z
@@ -1544,12 +2633,11 @@ cdef class _TreeMesh:
             V[4*ii + 2] = -face.edges[2].length/area
             V[4*ii + 3] = -face.edges[3].length/area
 
-        for it in self.tree.faces_z:
-            face = it.second
+        for it in prange(n_z, nogil=True):
+            face = tree.faces_z[it]
             if face.hanging:
                 continue
             ii = face.index + face_offset_z
-            I[4*ii : 4*ii + 4] = ii
             J[4*ii    ] = face.edges[0].index + edge_offset_y
             J[4*ii + 1] = face.edges[1].index
             J[4*ii + 2] = face.edges[2].index + edge_offset_y
@@ -1561,7 +2649,7 @@ cdef class _TreeMesh:
             V[4*ii + 2] =  face.edges[2].length/area
             V[4*ii + 3] =  face.edges[3].length/area
 
-        C = sp.csr_matrix((V, (I, J)),shape=(self.nF, self.ntE))
+        C = _regular_csr(V, J, 4, (self.nF, self.ntE))
         R = self._deflate_edges()
         self._edgeCurl = C*R
         return self._edgeCurl
@@ -1569,6 +2657,7 @@ cdef class _TreeMesh:
     @property
     @cython.cdivision(True)
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def nodalGrad(self):
         """
         Construct gradient operator (nodes to edges).
@@ -1576,21 +2665,23 @@ cdef class _TreeMesh:
         if self._nodalGrad is not None:
             return self._nodalGrad
         cdef:
+            c_Tree *tree = self.tree
             int_t dim = self._dim
-            np.int64_t[:] I = np.empty(2*self.nE, dtype=np.int64)
             np.int64_t[:] J = np.empty(2*self.nE, dtype=np.int64)
             np.float64_t[:] V = np.empty(2*self.nE, dtype=np.float64)
             Edge *edge
             double length
-            int_t ii
+            np.int64_t it, ii
+            np.int64_t n_x = tree.edges_x.size()
+            np.int64_t n_y = tree.edges_y.size()
+            np.int64_t n_z = tree.edges_z.size()
             np.int64_t offset1 = self.nEx
             np.int64_t offset2 = offset1 + self.nEy
 
-        for it in self.tree.edges_x:
-            edge = it.second
+        for it in prange(n_x, nogil=True):
+            edge = tree.edges_x[it]
             if edge.hanging: continue
             ii = edge.index
-            I[ii*2 : ii*2 + 2] = ii
             J[ii*2    ] = edge.points[0].index
             J[ii*2 + 1] = edge.points[1].index
 
@@ -1598,11 +2689,10 @@ cdef class _TreeMesh:
             V[ii*2    ] = -1.0/length
             V[ii*2 + 1] =  1.0/length
 
-        for it in self.tree.edges_y:
-            edge = it.second
+        for it in prange(n_y, nogil=True):
+            edge = tree.edges_y[it]
             if edge.hanging: continue
             ii = edge.index + offset1
-            I[ii*2 : ii*2 + 2] = ii
             J[ii*2    ] = edge.points[0].index
             J[ii*2 + 1] = edge.points[1].index
 
@@ -1611,11 +2701,10 @@ cdef class _TreeMesh:
             V[ii*2 + 1] =  1.0/length
 
         if(dim>2):
-            for it in self.tree.edges_z:
-                edge = it.second
+            for it in prange(n_z, nogil=True):
+                edge = tree.edges_z[it]
                 if edge.hanging: continue
                 ii = edge.index + offset2
-                I[ii*2 : ii*2 + 2] = ii
                 J[ii*2    ] = edge.points[0].index
                 J[ii*2 + 1] = edge.points[1].index
 
@@ -1623,9 +2712,8 @@ cdef class _TreeMesh:
                 V[ii*2    ] = -1.0/length
                 V[ii*2 + 1] =  1.0/length
 
-
         Rn = self._deflate_nodes()
-        G = sp.csr_matrix((V, (I, J)), shape=(self.nE, self.ntN))
+        G = _regular_csr(V, J, 2, (self.nE, self.ntN))
         self._nodalGrad = G*Rn
         return self._nodalGrad
 
@@ -1919,102 +3007,82 @@ cdef class _TreeMesh:
         return self._cellGradzStencilMat
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_edges_x(self):
-        #I is output index (with hanging)
-        #J is input index (without hanging)
-        cdef np.int64_t[:] I = np.empty(2*self.ntEx, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(2*self.ntEx, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(2*self.ntEx, dtype=np.float64)
-        cdef Edge *edge
-        cdef np.int64_t ii
-        #x edges:
-        for it in self.tree.edges_x:
-            edge = it.second
-            ii = edge.index
-            I[2*ii    ] = ii
-            I[2*ii + 1] = ii
-            if edge.hanging:
-                J[2*ii    ] = edge.parents[0].index
-                J[2*ii + 1] = edge.parents[1].index
-            else:
-                J[2*ii    ] = ii
-                J[2*ii + 1] = ii
+        if self._deflate_edges_x_mat is not None:
+            return self._deflate_edges_x_mat
+        #rows are the hanging edges (offset by nEx)
+        #J is input index (with hanging)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_edges = tree.edges_x.size()
+            np.int64_t n_hanging = tree.hanging_edges_x.size()
+            np.int64_t n = self.nEx
+            np.int64_t[:] J = np.empty(2*n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(2*n_hanging, dtype=np.float64)
+            Edge *edge
+            np.int64_t it, ii
+        for it in prange(n_hanging, nogil=True):
+            edge = tree.hanging_edges_x[it]
+            ii = edge.index - n
+            J[2*ii    ] = edge.parents[0].index
+            J[2*ii + 1] = edge.parents[1].index
             V[2*ii    ] = 0.5
             V[2*ii + 1] = 0.5
-        Rh = sp.csr_matrix((V, (I, J)), shape=(self.ntEx, self.ntEx))
-        # Test if it needs to be deflated again, (if any parents were also hanging)
-        last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nEx)
-        while(last_ind > self.nEx):
-            Rh = Rh*Rh
-            last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nEx)
-        Rh = Rh[:, : last_ind]
-        return Rh
+        self._deflate_edges_x_mat = _deflation_matrix(V, J, 2, n, n_edges)
+        return self._deflate_edges_x_mat
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_edges_y(self):
-        #I is output index (with hanging)
-        #J is input index (without hanging)
-        cdef int_t dim = self._dim
-        cdef np.int64_t[:] I = np.empty(2*self.ntEy, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(2*self.ntEy, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(2*self.ntEy, dtype=np.float64)
-        cdef Edge *edge
-        cdef np.int64_t ii
-        #x edges:
-        for it in self.tree.edges_y:
-            edge = it.second
-            ii = edge.index
-            I[2*ii    ] = ii
-            I[2*ii + 1] = ii
-            if edge.hanging:
-                J[2*ii    ] = edge.parents[0].index
-                J[2*ii + 1] = edge.parents[1].index
-            else:
-                J[2*ii    ] = ii
-                J[2*ii + 1] = ii
+        if self._deflate_edges_y_mat is not None:
+            return self._deflate_edges_y_mat
+        #rows are the hanging edges (offset by nEy)
+        #J is input index (with hanging)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_edges = tree.edges_y.size()
+            np.int64_t n_hanging = tree.hanging_edges_y.size()
+            np.int64_t n = self.nEy
+            np.int64_t[:] J = np.empty(2*n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(2*n_hanging, dtype=np.float64)
+            Edge *edge
+            np.int64_t it, ii
+        for it in prange(n_hanging, nogil=True):
+            edge = tree.hanging_edges_y[it]
+            ii = edge.index - n
+            J[2*ii    ] = edge.parents[0].index
+            J[2*ii + 1] = edge.parents[1].index
             V[2*ii    ] = 0.5
             V[2*ii + 1] = 0.5
-        Rh = sp.csr_matrix((V, (I, J)), shape=(self.ntEy, self.ntEy))
-        # Test if it needs to be deflated again, (if any parents were also hanging)
-        last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nEy)
-        while(last_ind > self.nEy):
-            Rh = Rh*Rh
-            last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nEy)
-        Rh = Rh[:, : last_ind]
-        return Rh
+        self._deflate_edges_y_mat = _deflation_matrix(V, J, 2, n, n_edges)
+        return self._deflate_edges_y_mat
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_edges_z(self):
-        #I is output index (with hanging)
-        #J is input index (without hanging)
-        cdef int_t dim = self._dim
-        cdef np.int64_t[:] I = np.empty(2*self.ntEz, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(2*self.ntEz, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(2*self.ntEz, dtype=np.float64)
-        cdef Edge *edge
-        cdef np.int64_t ii
-        #x edges:
-        for it in self.tree.edges_z:
-            edge = it.second
-            ii = edge.index
-            I[2*ii    ] = ii
-            I[2*ii + 1] = ii
-            if edge.hanging:
-                J[2*ii    ] = edge.parents[0].index
-                J[2*ii + 1] = edge.parents[1].index
-            else:
-                J[2*ii    ] = ii
-                J[2*ii + 1] = ii
+        if self._deflate_edges_z_mat is not None:
+            return self._deflate_edges_z_mat
+        #rows are the hanging edges (offset by nEz)
+        #J is input index (with hanging)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_edges = tree.edges_z.size()
+            np.int64_t n_hanging = tree.hanging_edges_z.size()
+            np.int64_t n = self.nEz
+            np.int64_t[:] J = np.empty(2*n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(2*n_hanging, dtype=np.float64)
+            Edge *edge
+            np.int64_t it, ii
+        for it in prange(n_hanging, nogil=True):
+            edge = tree.hanging_edges_z[it]
+            ii = edge.index - n
+            J[2*ii    ] = edge.parents[0].index
+            J[2*ii + 1] = edge.parents[1].index
             V[2*ii    ] = 0.5
             V[2*ii + 1] = 0.5
-        Rh = sp.csr_matrix((V, (I, J)), shape=(self.ntEz, self.ntEz))
-        # Test if it needs to be deflated again, (if any parents were also hanging)
-        last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nEz)
-        while(last_ind > self.nEz):
-            Rh = Rh*Rh
-            last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nEz)
-        Rh = Rh[:, : last_ind]
-        return Rh
+        self._deflate_edges_z_mat = _deflation_matrix(V, J, 2, n, n_edges)
+        return self._deflate_edges_z_mat
 
     def _deflate_edges(self):
         """Returns a matrix to remove hanging edges.
@@ -2048,109 +3116,114 @@ cdef class _TreeMesh:
             return sp.block_diag((Rx, Ry, Rz))
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_faces_x(self):
-        #I is output index (with hanging)
-        #J is input index (without hanging)
-        cdef np.int64_t[:] I = np.empty(self.ntFx, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(self.ntFx, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(self.ntFx, dtype=np.float64)
-        cdef Face *face
-        cdef np.int64_t ii;
-
-        for it in self.tree.faces_x:
-            face = it.second
-            ii = face.index
-            I[ii] = ii
-            if face.hanging:
-                J[ii] = face.parent.index
-            else:
-                J[ii] = ii
+        if self._deflate_faces_x_mat is not None:
+            return self._deflate_faces_x_mat
+        #rows are the hanging faces (offset by nFx)
+        #J is input index (with hanging)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_faces = tree.faces_x.size()
+            np.int64_t n_hanging = tree.hanging_faces_x.size()
+            np.int64_t n = self.nFx
+            np.int64_t[:] J = np.empty(n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(n_hanging, dtype=np.float64)
+            Face *face
+            np.int64_t it, ii
+        for it in prange(n_hanging, nogil=True):
+            face = tree.hanging_faces_x[it]
+            ii = face.index - n
+            J[ii] = face.parent.index
             V[ii] = 1.0
-        return sp.csr_matrix((V, (I, J)))
+        self._deflate_faces_x_mat = _deflation_matrix(V, J, 1, n, n_faces)
+        return self._deflate_faces_x_mat
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_faces_y(self):
-        #I is output index (with hanging)
-        #J is input index (without hanging)
-        cdef np.int64_t[:] I = np.empty(self.ntFy, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(self.ntFy, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(self.ntFy, dtype=np.float64)
-        cdef Face *face
-        cdef np.int64_t ii;
-
-        for it in self.tree.faces_y:
-            face = it.second
-            ii = face.index
-            I[ii] = ii
-            if face.hanging:
-                J[ii] = face.parent.index
-            else:
-                J[ii] = ii
+        if self._deflate_faces_y_mat is not None:
+            return self._deflate_faces_y_mat
+        #rows are the hanging faces (offset by nFy)
+        #J is input index (with hanging)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_faces = tree.faces_y.size()
+            np.int64_t n_hanging = tree.hanging_faces_y.size()
+            np.int64_t n = self.nFy
+            np.int64_t[:] J = np.empty(n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(n_hanging, dtype=np.float64)
+            Face *face
+            np.int64_t it, ii
+        for it in prange(n_hanging, nogil=True):
+            face = tree.hanging_faces_y[it]
+            ii = face.index - n
+            J[ii] = face.parent.index
             V[ii] = 1.0
-        return sp.csr_matrix((V, (I, J)))
+        self._deflate_faces_y_mat = _deflation_matrix(V, J, 1, n, n_faces)
+        return self._deflate_faces_y_mat
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_faces_z(self):
-        #I is output index (with hanging)
-        #J is input index (without hanging)
-        cdef np.int64_t[:] I = np.empty(self.ntFz, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(self.ntFz, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(self.ntFz, dtype=np.float64)
-        cdef Face *face
-        cdef np.int64_t ii;
-
-        for it in self.tree.faces_z:
-            face = it.second
-            ii = face.index
-            I[ii] = ii
-            if face.hanging:
-                J[ii] = face.parent.index
-            else:
-                J[ii] = ii
+        if self._deflate_faces_z_mat is not None:
+            return self._deflate_faces_z_mat
+        #rows are the hanging faces (offset by nFz)
+        #J is input index (with hanging)
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n_faces = tree.faces_z.size()
+            np.int64_t n_hanging = tree.hanging_faces_z.size()
+            np.int64_t n = self.nFz
+            np.int64_t[:] J = np.empty(n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(n_hanging, dtype=np.float64)
+            Face *face
+            np.int64_t it, ii
+        for it in prange(n_hanging, nogil=True):
+            face = tree.hanging_faces_z[it]
+            ii = face.index - n
+            J[ii] = face.parent.index
             V[ii] = 1.0
-        return sp.csr_matrix((V, (I, J)))
+        self._deflate_faces_z_mat = _deflation_matrix(V, J, 1, n, n_faces)
+        return self._deflate_faces_z_mat
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def _deflate_nodes(self):
         """ Returns a matrix that removes hanging faces
         A hanging node will have 2 parents in 2D or 2 or 4 parents in 3D.
         This matrix assigns the hanging node the average value of its parents.
         """
-        cdef np.int64_t[:] I = np.empty(4*self.ntN, dtype=np.int64)
-        cdef np.int64_t[:] J = np.empty(4*self.ntN, dtype=np.int64)
-        cdef np.float64_t[:] V = np.empty(4*self.ntN, dtype=np.float64)
-
-        # I is output index
+        if self._deflate_nodes_mat is not None:
+            return self._deflate_nodes_mat
+        cdef:
+            c_Tree *tree = self.tree
+            np.int64_t n = self.nN
+            np.int64_t n_hanging = tree.hanging_nodes.size()
+            np.int64_t[:] J = np.empty(4*n_hanging, dtype=np.int64)
+            np.float64_t[:] V = np.empty(4*n_hanging, dtype=np.float64)
+            Node *node
+            np.int64_t it, ii
+
+        # rows are the hanging nodes (offset by nN)
         # J is input index
-        cdef Node *node
-        cdef np.int64_t ii, i, offset
-        offset = self.nN
-        cdef double[4] weights
-
-        for it in self.tree.nodes:
-            node = it.second
-            ii = node.index
-            I[4*ii:4*ii + 4] = ii
-            if node.hanging:
-                J[4*ii    ] = node.parents[0].index
-                J[4*ii + 1] = node.parents[1].index
-                J[4*ii + 2] = node.parents[2].index
-                J[4*ii + 3] = node.parents[3].index
-            else:
-                J[4*ii : 4*ii + 4] = ii
-            V[4*ii : 4*ii + 4] = 0.25;
-
-        Rh = sp.csr_matrix((V, (I, J)), shape=(self.ntN, self.ntN))
-        # Test if it needs to be deflated again, (if any parents were also hanging)
-        last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nN)
-        while(last_ind > self.nN):
-            Rh = Rh*Rh
-            last_ind = max(np.nonzero(Rh.getnnz(0)>0)[0][-1], self.nN)
-        Rh = Rh[:, : last_ind]
-        return Rh
+        for it in prange(n_hanging, nogil=True):
+            node = tree.hanging_nodes[it]
+            ii = node.index - n
+            J[4*ii    ] = node.parents[0].index
+            J[4*ii + 1] = node.parents[1].index
+            J[4*ii + 2] = node.parents[2].index
+            J[4*ii + 3] = node.parents[3].index
+            V[4*ii    ] = 0.25
+            V[4*ii + 1] = 0.25
+            V[4*ii + 2] = 0.25
+            V[4*ii + 3] = 0.25
+        self._deflate_nodes_mat = _deflation_matrix(V, J, 4, n, self.ntN)
+        return self._deflate_nodes_mat
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveEx2CC(self):
         """
         Construct the averaging operator on cell edges in the x direction to
@@ -2158,29 +3231,29 @@ cdef class _TreeMesh:
         """
         if self._aveEx2CC is not None:
             return self._aveEx2CC
-        cdef np.int64_t[:] I,J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ind, ii, n_epc
+        cdef np.int64_t ind, ii, n_epc, n_cells
         cdef double scale
 
         n_epc = 2*(self._dim-1)
-        I = np.empty(self.nC*n_epc, dtype=np.int64)
-        J = np.empty(self.nC*n_epc, dtype=np.int64)
-        V = np.empty(self.nC*n_epc, dtype=np.float64)
+        n_cells = tree.cells.size()
+        J = np.empty(n_cells*n_epc, dtype=np.int64)
+        V = np.empty(n_cells*n_epc, dtype=np.float64)
         scale = 1.0/n_epc
-        for cell in self.tree.cells:
-            ind = cell.index
+        for ind in prange(n_cells, nogil=True):
             for ii in range(n_epc):
-                I[ind*n_epc + ii] = ind
-                J[ind*n_epc + ii] = cell.edges[ii].index
+                J[ind*n_epc + ii] = tree.cells[ind].edges[ii].index
                 V[ind*n_epc + ii] = scale
 
         Rex = self._deflate_edges_x()
-        self._aveEx2CC = sp.csr_matrix((V, (I, J)))*Rex
+        self._aveEx2CC = _regular_csr(V, J, n_epc, (n_cells, self.ntEx))*Rex
         return self._aveEx2CC
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveEy2CC(self):
         """
         Construct the averaging operator on cell edges in the y direction to
@@ -2188,29 +3261,29 @@ cdef class _TreeMesh:
         """
         if self._aveEy2CC is not None:
             return self._aveEy2CC
-        cdef np.int64_t[:] I,J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ind, ii, n_epc
+        cdef np.int64_t ind, ii, n_epc, n_cells
         cdef double scale
 
         n_epc = 2*(self._dim-1)
-        I = np.empty(self.nC*n_epc, dtype=np.int64)
-        J = np.empty(self.nC*n_epc, dtype=np.int64)
-        V = np.empty(self.nC*n_epc, dtype=np.float64)
+        n_cells = tree.cells.size()
+        J = np.empty(n_cells*n_epc, dtype=np.int64)
+        V = np.empty(n_cells*n_epc, dtype=np.float64)
         scale = 1.0/n_epc
-        for cell in self.tree.cells:
-            ind = cell.index
+        for ind in prange(n_cells, nogil=True):
             for ii in range(n_epc):
-                I[ind*n_epc + ii] = ind
-                J[ind*n_epc + ii] = cell.edges[n_epc + ii].index #y edges
+                J[ind*n_epc + ii] = tree.cells[ind].edges[n_epc + ii].index #y edges
                 V[ind*n_epc + ii] = scale
 
         Rey = self._deflate_edges_y()
-        self._aveEy2CC = sp.csr_matrix((V, (I, J)))*Rey
+        self._aveEy2CC = _regular_csr(V, J, n_epc, (n_cells, self.ntEy))*Rey
         return self._aveEy2CC
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveEz2CC(self):
         """
         Construct the averaging operator on cell edges in the z direction to
@@ -2220,25 +3293,24 @@ cdef class _TreeMesh:
             return self._aveEz2CC
         if self._dim == 2:
             raise Exception('There are no z-edges in 2D')
-        cdef np.int64_t[:] I,J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ind, ii, n_epc
+        cdef np.int64_t ind, ii, n_epc, n_cells
         cdef double scale
 
         n_epc = 2*(self._dim-1)
-        I = np.empty(self.nC*n_epc, dtype=np.int64)
-        J = np.empty(self.nC*n_epc, dtype=np.int64)
-        V = np.empty(self.nC*n_epc, dtype=np.float64)
+        n_cells = tree.cells.size()
+        J = np.empty(n_cells*n_epc, dtype=np.int64)
+        V = np.empty(n_cells*n_epc, dtype=np.float64)
         scale = 1.0/n_epc
-        for cell in self.tree.cells:
-            ind = cell.index
+        for ind in prange(n_cells, nogil=True):
             for ii in range(n_epc):
-                I[ind*n_epc + ii] = ind
-                J[ind*n_epc + ii] = cell.edges[ii + 2*n_epc].index
+                J[ind*n_epc + ii] = tree.cells[ind].edges[2*n_epc + ii].index
                 V[ind*n_epc + ii] = scale
 
         Rez = self._deflate_edges_z()
-        self._aveEz2CC = sp.csr_matrix((V, (I, J)))*Rez
+        self._aveEz2CC = _regular_csr(V, J, n_epc, (n_cells, self.ntEz))*Rez
         return self._aveEz2CC
 
     @property
@@ -2263,6 +3335,7 @@ cdef class _TreeMesh:
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveFx2CC(self):
         """
         Construct the averaging operator on cell faces in the x direction to
@@ -2273,30 +3346,27 @@ cdef class _TreeMesh:
         if self._dim == 2:
             return self.aveEy2CC
 
-        cdef np.int64_t[:] I,J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef Face *face1
-        cdef Face *face2
         cdef np.int64_t ii
-        I = np.empty(self.nC*2, dtype=np.int64)
-        J = np.empty(self.nC*2, dtype=np.int64)
-        V = np.empty(self.nC*2, dtype=np.float64)
+        cdef np.int64_t n_cells = tree.cells.size()
+        J = np.empty(n_cells*2, dtype=np.int64)
+        V = np.empty(n_cells*2, dtype=np.float64)
 
-        for cell in self.tree.cells:
-            face1 = cell.faces[0] # x face
-            face2 = cell.faces[1] # x face
-            ii = cell.index
-            I[ii*2 : ii*2 + 2] = ii
-            J[ii*2    ] = face1.index
-            J[ii*2 + 1] = face2.index
-            V[ii*2 : ii*2 + 2] = 0.5
+        for ii in prange(n_cells, nogil=True):
+            J[ii*2    ] = tree.cells[ii].faces[0].index # x face
+            J[ii*2 + 1] = tree.cells[ii].faces[1].index # x face
+            V[ii*2    ] = 0.5
+            V[ii*2 + 1] = 0.5
 
         Rfx = self._deflate_faces_x()
-        self._aveFx2CC = sp.csr_matrix((V, (I, J)))*Rfx
+        self._aveFx2CC = _regular_csr(V, J, 2, (n_cells, self.ntFx))*Rfx
         return self._aveFx2CC
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveFy2CC(self):
         """
         Construct the averaging operator on cell faces in the y direction to
@@ -2307,30 +3377,27 @@ cdef class _TreeMesh:
         if self._dim == 2:
             return self.aveEx2CC
 
-        cdef np.int64_t[:] I,J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef Face *face1
-        cdef Face *face2
         cdef np.int64_t ii
-        I = np.empty(self.nC*2, dtype=np.int64)
-        J = np.empty(self.nC*2, dtype=np.int64)
-        V = np.empty(self.nC*2, dtype=np.float64)
+        cdef np.int64_t n_cells = tree.cells.size()
+        J = np.empty(n_cells*2, dtype=np.int64)
+        V = np.empty(n_cells*2, dtype=np.float64)
 
-        for cell in self.tree.cells:
-            face1 = cell.faces[2] # y face
-            face2 = cell.faces[3] # y face
-            ii = cell.index
-            I[ii*2 : ii*2 + 2] = ii
-            J[ii*2    ] = face1.index
-            J[ii*2 + 1] = face2.index
-            V[ii*2 : ii*2 + 2] = 0.5
+        for ii in prange(n_cells, nogil=True):
+            J[ii*2    ] = tree.cells[ii].faces[2].index # y face
+            J[ii*2 + 1] = tree.cells[ii].faces[3].index # y face
+            V[ii*2    ] = 0.5
+            V[ii*2 + 1] = 0.5
 
         Rfy = self._deflate_faces_y()
-        self._aveFy2CC = sp.csr_matrix((V, (I, J)))*Rfy
+        self._aveFy2CC = _regular_csr(V, J, 2, (n_cells, self.ntFy))*Rfy
         return self._aveFy2CC
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveFz2CC(self):
         """
         Construct the averaging operator on cell faces in the z direction to
@@ -2340,26 +3407,22 @@ cdef class _TreeMesh:
             return self._aveFz2CC
         if self._dim == 2:
             raise Exception('There are no z-faces in 2D')
-        cdef np.int64_t[:] I,J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef Face *face1
-        cdef Face *face2
         cdef np.int64_t ii
-        I = np.empty(self.nC*2, dtype=np.int64)
-        J = np.empty(self.nC*2, dtype=np.int64)
-        V = np.empty(self.nC*2, dtype=np.float64)
+        cdef np.int64_t n_cells = tree.cells.size()
+        J = np.empty(n_cells*2, dtype=np.int64)
+        V = np.empty(n_cells*2, dtype=np.float64)
 
-        for cell in self.tree.cells:
-            face1 = cell.faces[4]
-            face2 = cell.faces[5]
-            ii = cell.index
-            I[ii*2 : ii*2 + 2] = ii
-            J[ii*2    ] = face1.index
-            J[ii*2 + 1] = face2.index
-            V[ii*2 : ii*2 + 2] = 0.5
+        for ii in prange(n_cells, nogil=True):
+            J[ii*2    ] = tree.cells[ii].faces[4].index # z face
+            J[ii*2 + 1] = tree.cells[ii].faces[5].index # z face
+            V[ii*2    ] = 0.5
+            V[ii*2 + 1] = 0.5
 
         Rfy = self._deflate_faces_z()
-        self._aveFz2CC = sp.csr_matrix((V, (I, J)))*Rfy
+        self._aveFz2CC = _regular_csr(V, J, 2, (n_cells, self.ntFz))*Rfy
         return self._aveFz2CC
 
     @property
@@ -2384,87 +3447,95 @@ cdef class _TreeMesh:
 
     @property
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2CC(self):
         "Construct the averaging operator on cell nodes to cell centers."
-        cdef np.int64_t[:] I, J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
         cdef np.int64_t ii, id, n_ppc
+        cdef np.int64_t n_cells = tree.cells.size()
         cdef double scale
         if self._aveN2CC is None:
             n_ppc = 1<<self._dim
             scale = 1.0/n_ppc
-            I = np.empty(self.nC*n_ppc, dtype=np.int64)
-            J = np.empty(self.nC*n_ppc, dtype=np.int64)
-            V = np.empty(self.nC*n_ppc, dtype=np.float64)
+            J = np.empty(n_cells*n_ppc, dtype=np.int64)
+            V = np.empty(n_cells*n_ppc, dtype=np.float64)
 
-            for cell in self.tree.cells:
-                ii = cell.index
+            for ii in prange(n_cells, nogil=True):
                 for id in range(n_ppc):
-                    I[ii*n_ppc + id] = ii
-                    J[ii*n_ppc + id] = cell.points[id].index
+                    J[ii*n_ppc + id] = tree.cells[ii].points[id].index
                     V[ii*n_ppc + id] = scale
 
             Rn = self._deflate_nodes()
-            self._aveN2CC = sp.csr_matrix((V, (I, J)), shape=(self.nC, self.ntN))*Rn
+            self._aveN2CC = _regular_csr(V, J, n_ppc, (n_cells, self.ntN))*Rn
         return self._aveN2CC
 
     @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2Ex(self):
         """
         Averaging operator on cell nodes to x-edges
         """
         if self._aveN2Ex is not None:
             return self._aveN2Ex
-        cdef np.int64_t[:] I, J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ii, id
-        I = np.empty(self.nEx*2, dtype=np.int64)
+        cdef np.int64_t it, ii, id
+        cdef np.int64_t n_edges = tree.edges_x.size()
+        cdef Edge *edge
         J = np.empty(self.nEx*2, dtype=np.int64)
         V = np.empty(self.nEx*2, dtype=np.float64)
 
-        for it in self.tree.edges_x:
-            edge = it.second
+        for it in prange(n_edges, nogil=True):
+            edge = tree.edges_x[it]
             if edge.hanging:
                 continue
             ii = edge.index
             for id in range(2):
-                I[ii*2 + id] = ii
                 J[ii*2 + id] = edge.points[id].index
                 V[ii*2 + id] = 0.5
 
         Rn = self._deflate_nodes()
-        self._aveN2Ex = sp.csr_matrix((V, (I, J)), shape=(self.nEx, self.ntN))*Rn
+        self._aveN2Ex = _regular_csr(V, J, 2, (self.nEx, self.ntN))*Rn
         return self._aveN2Ex
 
     @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2Ey(self):
         """
         Averaging operator on cell nodes to y-edges
         """
         if self._aveN2Ey is not None:
             return self._aveN2Ey
-        cdef np.int64_t[:] I, J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ii, id
-        I = np.empty(self.nEy*2, dtype=np.int64)
+        cdef np.int64_t it, ii, id
+        cdef np.int64_t n_edges = tree.edges_y.size()
+        cdef Edge *edge
         J = np.empty(self.nEy*2, dtype=np.int64)
         V = np.empty(self.nEy*2, dtype=np.float64)
 
-        for it in self.tree.edges_y:
-            edge = it.second
+        for it in prange(n_edges, nogil=True):
+            edge = tree.edges_y[it]
             if edge.hanging:
                 continue
             ii = edge.index
             for id in range(2):
-                I[ii*2 + id] = ii
                 J[ii*2 + id] = edge.points[id].index
                 V[ii*2 + id] = 0.5
 
         Rn = self._deflate_nodes()
-        self._aveN2Ey = sp.csr_matrix((V, (I, J)), shape=(self.nEy, self.ntN))*Rn
+        self._aveN2Ey = _regular_csr(V, J, 2, (self.nEy, self.ntN))*Rn
         return self._aveN2Ey
 
     @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2Ez(self):
         """
         Averaging operator on cell nodes to z-edges
@@ -2473,25 +3544,26 @@ cdef class _TreeMesh:
             raise Exception('TreeMesh has no z-edges in 2D')
         if self._aveN2Ez is not None:
             return self._aveN2Ez
-        cdef np.int64_t[:] I, J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ii, id
-        I = np.empty(self.nEz*2, dtype=np.int64)
+        cdef np.int64_t it, ii, id
+        cdef np.int64_t n_edges = tree.edges_z.size()
+        cdef Edge *edge
         J = np.empty(self.nEz*2, dtype=np.int64)
         V = np.empty(self.nEz*2, dtype=np.float64)
 
-        for it in self.tree.edges_z:
-            edge = it.second
+        for it in prange(n_edges, nogil=True):
+            edge = tree.edges_z[it]
             if edge.hanging:
                 continue
             ii = edge.index
             for id in range(2):
-                I[ii*2 + id] = ii
                 J[ii*2 + id] = edge.points[id].index
                 V[ii*2 + id] = 0.5
 
         Rn = self._deflate_nodes()
-        self._aveN2Ez = sp.csr_matrix((V, (I, J)), shape=(self.nEz, self.ntN))*Rn
+        self._aveN2Ez = _regular_csr(V, J, 2, (self.nEz, self.ntN))*Rn
         return self._aveN2Ez
 
     @property
@@ -2510,6 +3582,8 @@ cdef class _TreeMesh:
         return self._aveN2E
 
     @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2Fx(self):
         """
         Averaging operator on cell nodes to x-faces
@@ -2518,28 +3592,31 @@ cdef class _TreeMesh:
             return self.aveN2Ey
         if self._aveN2Fx is not None:
             return self._aveN2Fx
-        cdef np.int64_t[:] I, J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ii, id
-        I = np.empty(self.nFx*4, dtype=np.int64)
+        cdef np.int64_t it, ii, id
+        cdef np.int64_t n_faces = tree.faces_x.size()
+        cdef Face *face
         J = np.empty(self.nFx*4, dtype=np.int64)
         V = np.empty(self.nFx*4, dtype=np.float64)
 
-        for it in self.tree.faces_x:
-            face = it.second
+        for it in prange(n_faces, nogil=True):
+            face = tree.faces_x[it]
             if face.hanging:
                 continue
             ii = face.index
             for id in range(4):
-                I[ii*4 + id] = ii
                 J[ii*4 + id] = face.points[id].index
                 V[ii*4 + id] = 0.25
 
         Rn = self._deflate_nodes()
-        self._aveN2Fx = sp.csr_matrix((V, (I, J)), shape=(self.nFx, self.ntN))*Rn
+        self._aveN2Fx = _regular_csr(V, J, 4, (self.nFx, self.ntN))*Rn
         return self._aveN2Fx
 
     @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2Fy(self):
         """
         Averaging operator on cell nodes to y-faces
@@ -2548,57 +3625,59 @@ cdef class _TreeMesh:
             return self.aveN2Ex
         if self._aveN2Fy is not None:
             return self._aveN2Fy
-        cdef np.int64_t[:] I, J
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
         cdef np.float64_t[:] V
-        cdef np.int64_t ii, id
-
-        I = np.empty(self.nFy*4, dtype=np.int64)
+        cdef np.int64_t it, ii, id
+        cdef np.int64_t n_faces = tree.faces_y.size()
+        cdef Face *face
         J = np.empty(self.nFy*4, dtype=np.int64)
         V = np.empty(self.nFy*4, dtype=np.float64)
 
-        for it in self.tree.faces_y:
-            face = it.second
+        for it in prange(n_faces, nogil=True):
+            face = tree.faces_y[it]
             if face.hanging:
                 continue
             ii = face.index
             for id in range(4):
-                I[ii*4 + id] = ii
                 J[ii*4 + id] = face.points[id].index
                 V[ii*4 + id] = 0.25
 
         Rn = self._deflate_nodes()
-        self._aveN2Fy = sp.csr_matrix((V, (I, J)), shape=(self.nFy, self.ntN))*Rn
+        self._aveN2Fy = _regular_csr(V, J, 4, (self.nFy, self.ntN))*Rn
         return self._aveN2Fy
 
     @property
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def aveN2Fz(self):
         """
         Averaging operator on cell nodes to z-faces
         """
         if self._dim == 2:
             raise Exception('TreeMesh has no z faces in 2D')
-        cdef np.int64_t[:] I, J
-        cdef np.float64_t[:] V
-        cdef np.int64_t ii, id,
         if self._aveN2Fz is not None:
             return self._aveN2Fz
-
-        I = np.empty(self.nFz*4, dtype=np.int64)
+        cdef c_Tree *tree = self.tree
+        cdef np.int64_t[:] J
+        cdef np.float64_t[:] V
+        cdef np.int64_t it, ii, id
+        cdef np.int64_t n_faces = tree.faces_z.size()
+        cdef Face *face
         J = np.empty(self.nFz*4, dtype=np.int64)
         V = np.empty(self.nFz*4, dtype=np.float64)
 
-        for it in self.tree.faces_z:
-            face = it.second
+        for it in prange(n_faces, nogil=True):
+            face = tree.faces_z[it]
             if face.hanging:
                 continue
             ii = face.index
             for id in range(4):
-                I[ii*4 + id] = ii
                 J[ii*4 + id] = face.points[id].index
                 V[ii*4 + id] = 0.25
 
         Rn = self._deflate_nodes()
-        self._aveN2Fz = sp.csr_matrix((V, (I, J)), shape=(self.nFz, self.ntN))*Rn
+        self._aveN2Fz = _regular_csr(V, J, 4, (self.nFz, self.ntN))*Rn
         return self._aveN2Fz
 
     @property
@@ -2936,24 +4015,115 @@ cdef class _TreeMesh:
             z = 0
         return self.tree.containing_cell(x, y, z).index
 
-    def _get_containing_cell_indexes(self, locs):
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _locate_cells(self, double[:, :] locs, vector[c_Cell *]& cells):
+        """Fill cells with the containing (or closest) cell of each location"""
+        cdef int_t n_locs = locs.shape[0]
+        cdef int_t dim = self._dim
+        cdef int_t i
+        cdef double x, y, z
+        cells.resize(n_locs)
+        for i in prange(n_locs, nogil=True):
+            x = locs[i, 0]
+            y = locs[i, 1]
+            if dim == 3:
+                z = locs[i, 2]
+            else:
+                z = 0.0
+            cells[i] = self.tree.containing_cell(x, y, z)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _morton_order(self, locs):
+        """Order of the locations along a Morton curve through the mesh"""
+        cdef double[:, :] d_locs = locs
+        cdef int_t n_locs = d_locs.shape[0]
+        cdef int_t dim = self._dim
+        cdef int_t n_bits = 63//dim
+        cdef double n_max = ((<np.uint64_t> 1) << n_bits) - 1
+        cdef np.uint64_t[:] codes = np.empty(n_locs, dtype=np.uint64)
+        xs, ys, zs = np.asarray(self._xs), np.asarray(self._ys), np.asarray(self._zs)
+        cdef double[:] x0 = np.array([xs[0], ys[0], zs[0]])
+        cdef double[:] width = np.array([np.ptp(xs), np.ptp(ys), np.ptp(zs)])
+        cdef int_t i
+        cdef double x, y, z
+        for i in prange(n_locs, nogil=True):
+            x = _clip01((d_locs[i, 0] - x0[0])/width[0])
+            y = _clip01((d_locs[i, 1] - x0[1])/width[1])
+            if dim == 3:
+                z = _clip01((d_locs[i, 2] - x0[2])/width[2])
+            else:
+                z = 0.0
+            codes[i] = _morton_code(x*n_max, y*n_max, z*n_max, dim, n_bits)
+        return np.argsort(codes, kind='stable')
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _get_containing_cell_indexes(self, locs, sort=False):
+        """Indexes of the cells containing (or closest to) each location
+
+        The locations are found in parallel. With sort, they are visited in
+        Morton order of their position, so that points in the same part of
+        the tree are located together, which helps large scattered sets.
+        """
         locs = np.require(np.atleast_2d(locs), dtype=np.float64, requirements='C')
+        if sort:
+            order = self._morton_order(locs)
+            locs = locs[order]
         cdef double[:,:] d_locs = locs
         cdef int_t n_locs = d_locs.shape[0]
         cdef np.int64_t[:] indexes = np.empty(n_locs, dtype=np.int64)
-        cdef double x, y, z
-        for i in range(n_locs):
-            x = d_locs[i, 0]
-            y = d_locs[i, 1]
-            if self._dim == 3:
-                z = d_locs[i, 2]
-            else:
-                z = 0
-            indexes[i] = self.tree.containing_cell(x, y, z).index
+        cdef vector[c_Cell *] cells
+        cdef int_t i
+        self._locate_cells(d_locs, cells)
+        for i in prange(n_locs, nogil=True):
+            indexes[i] = cells[i].index
         if n_locs==1:
             return indexes[0]
+        if sort:
+            out = np.empty(n_locs, dtype=np.int64)
+            out[order] = indexes
+            return out
         return np.array(indexes)
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _cell_item_indexes(self, locType):
+        """Indexes of each cell's nodes, faces or edges of the given locType
+
+        Hanging items are included, with the indexes after the non-hanging
+        ones. The columns are in the order given by _cell_item_slots.
+        """
+        kind, slots = _cell_item_slots[self._dim][locType]
+        cdef np.int64_t[:] sl = np.array(slots, dtype=np.int64)
+        cdef np.int64_t k = sl.shape[0]
+        cdef np.int64_t n_cells = self.tree.cells.size()
+        cdef np.int64_t[:, :] out = np.empty((n_cells, k), dtype=np.int64)
+        cdef int which = 'nef'.index(kind)
+        cdef c_Cell *cell
+        cdef np.int64_t i, j
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
+            for j in range(k):
+                if which == 0:
+                    out[cell.index, j] = cell.points[sl[j]].index
+                elif which == 1:
+                    out[cell.index, j] = cell.edges[sl[j]].index
+                else:
+                    out[cell.index, j] = cell.faces[sl[j]].index
+        return np.asarray(out)
+
+    def _deflate_items(self, locType):
+        # the deflation matrix of one type of nodes, faces or edges
+        if locType == 'N':
+            return self._deflate_nodes()
+        if self._dim == 2 and locType[0] == 'F':
+            locType = 'Ey' if locType == 'Fx' else 'Ex'
+        if locType[0] == 'F':
+            return getattr(self, '_deflate_faces_'+locType[1])()
+        return getattr(self, '_deflate_edges_'+locType[1])()
+
     def _count_cells_per_index(self):
         cdef np.int64_t[:] counts = np.zeros(self.max_level+1, dtype=np.int64)
         for cell in self.tree.cells:
@@ -3099,6 +4269,7 @@ cdef class _TreeMesh:
 
             int_t ii, i, j, offset
             c_Cell *cell
+            vector[c_Cell *] cells
             double x, y, z
             double w1, w2
             double eps = 100*np.finfo(float).eps
@@ -3116,12 +4287,13 @@ cdef class _TreeMesh:
         else:
             raise ValueError('Invalid direction, must be x, y, or z')
 
+        self._locate_cells(locations, cells)
         for i in range(n_loc):
             x = locations[i, 0]
             y = locations[i, 1]
             z = locations[i, 2] if dim==3 else 0.0
             #get containing (or closest) cell
-            cell = self.tree.containing_cell(x, y, z)
+            cell = cells[i]
             for j in range(n_edges):
                 I[n_edges*i+j] = i
                 J[n_edges*i+j] = cell.edges[n_edges*dir+j].index + offset
@@ -3164,6 +4336,7 @@ cdef class _TreeMesh:
 
             int_t ii, i, offset
             c_Cell *cell
+            vector[c_Cell *] cells
             double x, y, z
             double w
             double eps = 100*np.finfo(float).eps
@@ -3183,12 +4356,13 @@ cdef class _TreeMesh:
         else:
             raise ValueError('Invalid direction, must be x, y, or z')
 
+        self._locate_cells(locations, cells)
         for i in range(n_loc):
             x = locations[i, 0]
             y = locations[i, 1]
             z = locations[i, 2] if dim==3 else 0.0
             #get containing (or closest) cell
-            cell = self.tree.containing_cell(x, y, z)
+            cell = cells[i]
             I[n_faces*i  ] = i
             I[n_faces*i+1] = i
             if self._dim == 3:
@@ -3225,17 +4399,19 @@ cdef class _TreeMesh:
 
             int_t ii, i
             c_Cell *cell
+            vector[c_Cell *] cells
             double x, y, z
             double wx, wy, wz
             double eps = 100*np.finfo(float).eps
             int zeros_out = zerosOutside
 
+        self._locate_cells(locations, cells)
         for i in range(n_loc):
             x = locations[i, 0]
             y = locations[i, 1]
             z = locations[i, 2] if dim==3 else 0.0
             #get containing (or closest) cell
-            cell = self.tree.containing_cell(x, y, z)
+            cell = cells[i]
             #calculate weights
             wx = ((cell.points[3].location[0] - x)/
                   (cell.points[3].location[0] - cell.points[0].location[0]))
@@ -3289,16 +4465,18 @@ cdef class _TreeMesh:
 
             int_t ii, i
             c_Cell *cell
+            vector[c_Cell *] cells
             double x, y, z
             double eps = 100*np.finfo(float).eps
             int zeros_out = zerosOutside
 
+        self._locate_cells(locations, cells)
         for i in range(n_loc):
             x = locations[i, 0]
             y = locations[i, 1]
             z = locations[i, 2] if dim==3 else 0.0
             # get containing (or closest) cell
-            cell = self.tree.containing_cell(x, y, z)
+            cell = cells[i]
             J[i] = cell.index
             if zeros_out:
                 if x < cell.points[0].location[0]-eps:
@@ -3378,12 +4556,6 @@ cdef class _TreeMesh:
             if self._dim==3:
                 edges_z = True
 
-        cdef:
-            int_t i, offset
-            Node *p1
-            Node *p2
-            Edge *edge
-
         if nodes:
             ax.plot(
                 *np.r_[self.gridN, self.gridhN].T, color="C0", marker='s',
@@ -3441,66 +4613,26 @@ cdef class _TreeMesh:
         if lines:
             color = kwargs.get('color', 'C0')
             linewidth = kwargs.get('linewidth', 1.)
-            if(self._dim) == 2:
-                X = np.empty((self.nE*3))
-                Y = np.empty((self.nE*3))
-                for it in self.tree.edges_x:
-                    edge = it.second
-                    if(edge.hanging): continue
-                    i = edge.index*3
-                    p1 = edge.points[0]
-                    p2 = edge.points[1]
-                    X[i:i + 3] = [p1.location[0], p2.location[0], np.nan]
-                    Y[i:i + 3] = [p1.location[1], p2.location[1], np.nan]
-
-                offset = self.nEx
-                for it in self.tree.edges_y:
-                    edge = it.second
-                    if(edge.hanging): continue
-                    i = (edge.index + offset)*3
-                    p1 = edge.points[0]
-                    p2 = edge.points[1]
-                    X[i : i+3] = [p1.location[0], p2.location[0], np.nan]
-                    Y[i : i+3] = [p1.location[1], p2.location[1], np.nan]
-
-                ax.plot(X, Y, color=color, linestyle="-", lw=linewidth)
+            # segments of the non-hanging edges from the edge to node connectivity
+            n_edges = [self.ntEx, self.ntEy, self.ntEz][:self._dim]
+            offsets = np.cumsum([0] + n_edges[:-1])
+            non_hanging = np.concatenate([
+                offset + np.arange(n) for offset, n
+                in zip(offsets, [self.nEx, self.nEy, self.nEz][:self._dim])
+            ])
+            nodes_loc = np.r_[self.gridN, self.gridhN]
+            segments = nodes_loc[self.edge_nodes[non_hanging]]
+            if self._dim == 2:
+                ax.add_collection(LineCollection(
+                    segments, colors=color, linestyles="-", linewidths=linewidth
+                ))
+                ax.autoscale_view()
             else:
-                X = np.empty((self.nE*3))
-                Y = np.empty((self.nE*3))
-                Z = np.empty((self.nE*3))
-                for it in self.tree.edges_x:
-                    edge = it.second
-                    if(edge.hanging): continue
-                    i = edge.index*3
-                    p1 = edge.points[0]
-                    p2 = edge.points[1]
-                    X[i : i+3] = [p1.location[0], p2.location[0], np.nan]
-                    Y[i : i+3] = [p1.location[1], p2.location[1], np.nan]
-                    Z[i : i+3] = [p1.location[2], p2.location[2], np.nan]
-
-                offset = self.nEx
-                for it in self.tree.edges_y:
-                    edge = it.second
-                    if(edge.hanging): continue
-                    i = (edge.index+offset)*3
-                    p1 = edge.points[0]
-                    p2 = edge.points[1]
-                    X[i : i+3] = [p1.location[0], p2.location[0], np.nan]
-                    Y[i : i+3] = [p1.location[1], p2.location[1], np.nan]
-                    Z[i : i+3] = [p1.location[2], p2.location[2], np.nan]
-
-                offset += self.nEy
-                for it in self.tree.edges_z:
-                    edge = it.second
-                    if(edge.hanging): continue
-                    i = (edge.index + offset)*3
-                    p1 = edge.points[0]
-                    p2 = edge.points[1]
-                    X[i : i+3] = [p1.location[0], p2.location[0], np.nan]
-                    Y[i : i+3] = [p1.location[1], p2.location[1], np.nan]
-                    Z[i : i+3] = [p1.location[2], p2.location[2], np.nan]
-
-                ax.plot(X, Y, Z, color=color, linestyle="-", lw=linewidth)
+                ax.add_collection3d(Line3DCollection(
+                    segments, colors=color, linestyles="-", linewidths=linewidth
+                ))
+                x_max = self.x0 + [h.sum() for h in self.h]
+                ax.auto_scale_xyz(*np.c_[self.x0, x_max])
 
         ax.set_xlabel('x1')
         ax.set_ylabel('x2')
@@ -3518,7 +4650,7 @@ cdef class _TreeMesh:
                   ax=None, clim=None, showIt=False,
                   pcolorOpts=None,
                   gridOpts=None,
-                  range_x=None, range_y=None,
+                  range_x=None, range_y=None, raster=False,
                   **other_kwargs,
                   ):
         """ Plots an image of values defined on the TreeMesh
@@ -3544,9 +4676,14 @@ cdef class _TreeMesh:
             options for the plotting the grid
         range_x, range_y: array_like, optional
             pairs of [min, max] values for the x and y ranges
+        raster : bool or (int, int), optional
+            Paint the cells into an image instead of drawing one polygon per
+            cell, which is much lighter for very large meshes. If True the
+            image has one pixel per display pixel of the axes, otherwise a
+            pair of the number of pixels along x and y.
         """
         if self._dim == 3:
-            self.plotSlice(v, vType=vType, grid=grid, view=view,
+            return self.plotSlice(v, vType=vType, grid=grid, view=view,
                            ax=ax, clim=clim, showIt=showIt,
                            pcolorOpts=pcolorOpts,
                            range_x=range_x, range_y=range_y,
@@ -3611,52 +4748,77 @@ cdef class _TreeMesh:
             else:
                 edge_color = colors.to_rgba_array(edge_color, edge_alpha)
 
-        rectangles = []
-        facecolors = scalarMap.to_rgba(I[~np.isnan(I)])
-        facecolors[:,-1] = alpha
-        for cell in self.tree.cells:
-            ii = cell.index
-            if np.isnan(I[ii]):
-                continue
-            x0 = np.array([cell.points[0].location[0], cell.points[0].location[1]])
-            sz = np.array([cell.edges[0].length, cell.edges[2].length])
-            rectangles.append(plt.Rectangle((x0[0], x0[1]), sz[0], sz[1]))
-
-        pc = PatchCollection(rectangles, facecolor=facecolors, edgecolor=edge_color)
-        # Add collection to axes
-        ax.add_collection(pc)
+        if range_x is None:
+            range_x = self.vectorNx[[0, -1]]
+        if range_y is None:
+            range_y = self.vectorNy[[0, -1]]
+
+        if raster is not False:
+            if raster is True:
+                bbox = ax.get_window_extent()
+                raster = (max(int(bbox.width), 1), max(int(bbox.height), 1))
+            n_x, n_y = raster
+            dx = (range_x[1] - range_x[0])/n_x
+            dy = (range_y[1] - range_y[0])/n_y
+            x = range_x[0] + dx*(np.arange(n_x) + 0.5)
+            y = range_y[0] + dy*(np.arange(n_y) + 0.5)
+            pixels = np.c_[np.tile(x, n_y), np.repeat(y, n_x)]
+            x_max = [self.vectorNx[-1], self.vectorNy[-1]]
+            inside = ((pixels >= self.x0) & (pixels <= x_max)).all(axis=1)
+            image = np.full(n_x*n_y, np.nan)
+            image[inside] = I[self._get_containing_cell_indexes(pixels[inside])]
+            ax.imshow(
+                image.reshape(n_y, n_x), origin='lower', cmap=cm, norm=cNorm,
+                alpha=alpha, interpolation='nearest', aspect='auto',
+                extent=[range_x[0], range_x[1], range_y[0], range_y[1]]
+            )
+            if grid:
+                self.plotGrid(ax=ax, **gridOpts)
+        else:
+            # quadrilaterals from the cell to node connectivity
+            nodes = np.r_[self.gridN, self.gridhN]
+            keep = ~np.isnan(I)
+            verts = nodes[self.cell_nodes[keep][:, [0, 1, 3, 2]]]
+            facecolors = scalarMap.to_rgba(I[keep])
+            facecolors[:, -1] = alpha
+            pc = PolyCollection(
+                verts, facecolors=facecolors, edgecolors=edge_color
+            )
+            # Add collection to axes
+            ax.add_collection(pc)
         # http://stackoverflow.com/questions/8342549/matplotlib-add-colorbar-to-a-sequence-of-line-plots
         scalarMap._A = []
         ax.set_xlabel('x')
         ax.set_ylabel('y')
-
-        if range_x is not None:
-            ax.set_xlim(*range_x)
-        else:
-            ax.set_xlim(*self.vectorNx[[0, -1]])
-
-        if range_y is not None:
-            ax.set_ylim(*range_y)
-        else:
-            ax.set_ylim(*self.vectorNy[[0, -1]])
+        ax.set_xlim(*range_x)
+        ax.set_ylim(*range_y)
 
         if showIt:
             plt.show()
         return [scalarMap]
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def __getstate__(self):
-        cdef int id, dim = self._dim
-        indArr = np.empty((self.nC, dim), dtype=np.int)
-        levels = np.empty((self.nC), dtype=np.int)
-        cdef np.int_t[:, :] _indArr = indArr
-        cdef np.int_t[:] _levels = levels
-        for cell in self.tree.cells:
+        cdef int_t dim = self._dim
+        cdef np.int64_t n_cells = self.tree.cells.size()
+        indArr = np.empty((n_cells, dim), dtype=np.int64)
+        levels = np.empty(n_cells, dtype=np.int64)
+        cdef np.int64_t[:, :] _indArr = indArr
+        cdef np.int64_t[:] _levels = levels
+        cdef c_Cell *cell
+        cdef np.int64_t i, id
+        for i in prange(n_cells, nogil=True):
+            cell = self.tree.cells[i]
             for id in range(dim):
                 _indArr[cell.index, id] = cell.location_ind[id]
             _levels[cell.index] = cell.level
         return indArr, levels
 
     def __setstate__(self, state):
+        if isinstance(state, bytes):
+            self._set_structure(state)
+            return
         indArr, levels = state
         indArr = np.asarray(indArr)
         levels = np.asarray(levels)
@@ -3671,6 +4833,52 @@ cdef class _TreeMesh:
             points = np.column_stack((xs[indArr[:, 0]], ys[indArr[:, 1]]))
         self.insert_cells(points, levels)
 
+    def _get_structure(self):
+        """The refinement of the tree as a compact bitstream
+
+        Every cell below the max level has one bit, set if it is divided, in
+        depth first order through the roots. The bits are packed into bytes.
+        """
+        cdef vector[unsigned char] bits
+        with nogil:
+            self.tree.write_structure(bits)
+        if bits.size() == 0:
+            return b''
+        cdef unsigned char[:] flags = <unsigned char[:bits.size()]> bits.data()
+        return np.packbits(flags).tobytes()
+
+    def _set_structure(self, structure):
+        """Rebuild the cells of an unrefined mesh from _get_structure
+
+        The cells are divided directly, without locating points or balancing
+        the tree, and the mesh is then finalized.
+        """
+        n_root_nodes = (self.tree.nx_roots + 1)*(self.tree.ny_roots + 1)
+        if self._dim == 3:
+            n_root_nodes *= self.tree.nz_roots + 1
+        if self._finalized or self.tree.nodes.size() != n_root_nodes:
+            raise ValueError("The tree structure can only be set on an unrefined mesh")
+        bits = np.unpackbits(np.frombuffer(structure, dtype=np.uint8))
+        bits = np.require(bits, dtype=np.uint8, requirements='C')
+        cdef unsigned char[:] flags = bits
+        cdef int_t n_bits = flags.shape[0]
+        cdef int_t n_read
+        if n_bits == 0:
+            # nothing below the roots can be divided
+            if self.tree.max_level > 0:
+                raise ValueError("The tree structure is empty")
+            self.finalize()
+            return
+        with nogil:
+            n_read = self.tree.read_structure(&flags[0], n_bits)
+        # the last byte is padded with up to 7 unused bits
+        if n_read > n_bits or n_bits - n_read >= 8:
+            raise ValueError(
+                "The tree structure has {} bits, but the mesh used {}".format(
+                    n_bits, n_read)
+            )
+        self.finalize()
+
     def __len__(self):
         return self.nC
 
@@ -3727,5 +4935,79 @@ cdef class _TreeMesh:
         del self.tree
         del self.wrapper
 
+cdef inline np.uint64_t _morton_code(double x, double y, double z, int_t dim, int_t n_bits) nogil:
+    cdef int_t ind[3]
+    ind[0] = <int_t> x
+    ind[1] = <int_t> y
+    ind[2] = <int_t> z
+    return curve_code(ind, dim, n_bits, 1)
+
 cdef inline double _clip01(double x) nogil:
     return min(1, max(x, 0))
+
+def _regular_csr(V, J, n_per_row, shape):
+    """Sparse matrix with n_per_row entries (V, J) in each row, in order
+
+    Duplicate entries are summed, as they would be when building from (I, J).
+    """
+    indptr = np.arange(0, n_per_row*shape[0] + 1, n_per_row, dtype=np.int64)
+    A = sp.csr_matrix((np.asarray(V), np.asarray(J), indptr), shape=shape)
+    A.sum_duplicates()
+    return A
+
+def _containing_cells(inds, levels, inds_in, levels_in, max_level, n_max):
+    """The cell of (inds_in, levels_in) containing each cell of (inds, levels)
+
+    Cells are given by the location index of their centers and their level,
+    as returned by __getstate__. A cell contains itself, cells that are not
+    inside of any of the other cells are given -1.
+    """
+    def codes(ind, level):
+        code = np.asarray(level, dtype=np.int64)
+        for i in range(ind.shape[1]):
+            code = code*n_max + ind[:, i]
+        return code
+
+    code_in = codes(inds_in, levels_in)
+    order = np.argsort(code_in)
+    code_in = code_in[order]
+    out = np.full(levels.shape[0], -1, dtype=np.int64)
+    for level in range(max_level + 1):
+        # the center of the level's ancestor of each (finer) cell
+        cells = np.where(levels >= level)[0]
+        width = 2 << (max_level - level)
+        code = codes((inds[cells]//width)*width + width//2, np.full(cells.shape[0], level))
+        pos = np.minimum(np.searchsorted(code_in, code), code_in.shape[0] - 1)
+        hit = code_in[pos] == code
+        out[cells[hit]] = order[pos[hit]]
+    return out
+
+def _corner_weights(locs, lo, hi, axes):
+    """Multilinear weights of the points locs on the corners of boxes
+
+    Row i holds the weights on the corners of the box (lo[i], hi[i]), where
+    bit b of the corner number is its side along axes[b].
+    """
+    corners = np.arange(1 << len(axes))
+    W = np.ones((locs.shape[0], corners.shape[0]))
+    for b, a in enumerate(axes):
+        t = ((locs[:, a] - lo[:, a])/(hi[:, a] - lo[:, a]))[:, None]
+        W *= np.where((corners >> b) & 1, t, 1.0 - t)
+    return W
+
+def _deflation_matrix(V, J, n_parents, n, n_total):
+    """Matrix expressing all n_total items in terms of the n non-hanging items
+
+    The non-hanging items are numbered first, row i of (V, J) holds the
+    weights and parents of the hanging item n + i. Parents can themselves be
+    hanging, so they are replaced by their own parents until only non-hanging
+    items are left.
+    """
+    H = _regular_csr(V, J, n_parents, (n_total - n, n_total))
+    Hn = H[:, :n]
+    Hh = H[:, n:]
+    while Hh.nnz > 0:
+        Hh = Hh*H
+        Hn = Hn + Hh[:, :n]
+        Hh = Hh[:, n:]
+    return sp.vstack([sp.identity(n, format='csr'), Hn], format='csr')
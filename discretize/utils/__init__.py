@@ -1,8 +1,8 @@
 from __future__ import print_function
 
 from .matutils import (
-    mkvc, sdiag, sdInv, speye, kron3, spzeros, ddx, av,
-    av_extrap, ndgrid, ind2sub, sub2ind, getSubArray,
+    mkvc, sdiag, sdInv, speye, kron3, KronOperator, sparse_astype, spzeros,
+    ddx, av, av_extrap, ndgrid, ind2sub, sub2ind, getSubArray,
     inv3X3BlockDiagonal, inv2X2BlockDiagonal, TensorType,
     makePropertyTensor, invPropertyTensor, Zero,
     Identity
@@ -10,10 +10,11 @@ from .matutils import (
 from .codeutils import (isScalar, asArray_N_x_Dim)
 from .meshutils import (
     exampleLrmGrid, meshTensor, closestPoints, ExtractCoreMesh,
-    random_model, mesh_builder_xyz, refine_tree_xyz, active_from_xyz
+    random_model, mesh_builder_xyz, refine_tree_xyz, active_from_xyz,
+    point_distance_criterion
 )
 from .curvutils import volTetra, faceInfo, indexCube
-from .interputils import interpmat
+from .interputils import interpmat, volume_average
 from .coordutils import (
     rotatePointsFromNormals, rotationMatrixFromNormals, cyl2cart, cart2cyl
     # rotate_vec_cyl2cart
@@ -0,0 +1,352 @@
+from collections import OrderedDict
+import fnmatch
+import os
+import shutil
+import sys
+import tempfile
+import weakref
+
+import numpy as np
+import scipy.sparse as sp
+
+from .matutils import sparse_astype
+
+
+def cache_nbytes(value):
+    """Approximate number of bytes held by a cached value.
+
+    Counts the arrays of numpy arrays, sparse matrices and linear operators,
+    and of the lists, tuples and dictionaries holding them.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sp.issparse(value):
+        return sum(
+            getattr(value, attr).nbytes
+            for attr in ['data', 'indices', 'indptr', 'row', 'col', 'offsets']
+            if isinstance(getattr(value, attr, None), np.ndarray)
+        )
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            cache_nbytes(v) for v in value.values()
+        )
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(cache_nbytes(v) for v in value)
+    if hasattr(value, '__dict__'):
+        # operator objects, only look one level down for their arrays
+        return sys.getsizeof(value) + sum(
+            cache_nbytes(v) for v in vars(value).values()
+            if isinstance(v, (np.ndarray, list, tuple)) or sp.issparse(v)
+        )
+    return sys.getsizeof(value)
+
+
+def save_csr(path, A):
+    """Write a csr_matrix to the directory path as .npy files.
+
+    The files are written to a temporary directory that is then renamed, so
+    other processes never see a partially written matrix.
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        np.save(os.path.join(tmp, 'data.npy'), A.data)
+        np.save(os.path.join(tmp, 'indices.npy'), A.indices)
+        np.save(os.path.join(tmp, 'indptr.npy'), A.indptr)
+        np.save(os.path.join(tmp, 'shape.npy'), np.array(A.shape, dtype=np.int64))
+        os.rename(tmp, path)
+    except OSError:
+        # most likely another process saved it first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_csr(path):
+    """Memory map a csr_matrix written by save_csr, None if there is none.
+
+    The arrays are mapped copy-on-write, so they are shared between the
+    processes reading them and are only copied if written to.
+    """
+    if not os.path.isdir(path):
+        return None
+    try:
+        data, indices, indptr = [
+            np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+            for name in ['data', 'indices', 'indptr']
+        ]
+        shape = tuple(np.load(os.path.join(path, 'shape.npy')))
+        return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+    except (OSError, ValueError):
+        return None
+
+
+class OperatorCache(object):
+    """Least recently used store for the operators a mesh has built.
+
+    Values are stored by attribute name. Once the stored values use more
+    than ``budget`` bytes, the least recently used ones are dropped and are
+    built again the next time they are needed. The value stored last is
+    always kept, even when it alone is over the budget.
+
+    With a ``directory``, the sparse csr matrices are also saved there, under
+    the fingerprint of the mesh, and later caches of identical meshes memory
+    map them instead of building them again.
+
+    Sparse matrices with floating point values are stored with values of
+    type ``dtype`` and indices of type ``index_dtype``, when they are given.
+
+    :param int budget: number of bytes the values may use, None for no limit
+    :param str directory: directory of the on disk cache, None to disable it
+    :param callable fingerprint: returns the fingerprint of the mesh
+    :param callable variant: returns, for an attribute name, a string naming
+        the state other than the geometry that its value depends on, or None
+    :param numpy.dtype dtype: type of the values of the sparse matrices
+    :param numpy.dtype index_dtype: type of the indices of the sparse matrices
+    """
+
+    def __init__(
+        self, budget=None, directory=None, fingerprint=None, dtype=None,
+        index_dtype=None, variant=None
+    ):
+        self.budget = budget
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.variant = variant
+        self.dtype = dtype
+        self.index_dtype = index_dtype
+        self.evictions = 0
+        self.disk_loads = 0
+        self.disk_saves = 0
+        self._fingerprint = None
+        self._values = OrderedDict()
+        self._nbytes = {}
+        self._stats = {}
+        self._fresh = set()
+        self._last_hit = None
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the stored values"""
+        return sum(self._nbytes.values())
+
+    def get(self, name):
+        """Return the value stored under name, or None, and count the lookup.
+
+        Properties read their cached value twice, once to check it and once
+        to return it, so looking up a value that was just stored, or that was
+        just counted as a hit, is not counted again.
+        """
+        stats = self._stats.setdefault(name, [0, 0])
+        last_hit, self._last_hit = self._last_hit, None
+        if name not in self._values:
+            value = self._load(name)
+            if value is None:
+                stats[1] += 1
+                return None
+            stats[0] += 1
+            self._last_hit = name
+            self.disk_loads += 1
+            self._store(name, value)
+            return value
+        if name in self._fresh:
+            self._fresh.discard(name)
+        elif name != last_hit:
+            stats[0] += 1
+            self._last_hit = name
+        self._values.move_to_end(name)
+        return self._values[name]
+
+    def set(self, name, value):
+        """Store value under name, None removes it"""
+        if value is None:
+            self.pop(name)
+            return
+        self._last_hit = None
+        value = self.astype(value)
+        self._save(name, value)
+        self._store(name, value)
+        self._fresh.add(name)
+
+    def _store(self, name, value):
+        self._values[name] = value
+        self._values.move_to_end(name)
+        self._nbytes[name] = cache_nbytes(value)
+        self.evict(keep=name)
+
+    def astype(self, value):
+        """Convert a sparse operator to the dtype and index_dtype of the cache"""
+        if sp.issparse(value) and np.issubdtype(value.dtype, np.inexact):
+            return sparse_astype(value, self.dtype, self.index_dtype)
+        return value
+
+    def convert(self):
+        """Give the stored operators the current dtype and index_dtype
+
+        Operators whose values were rounded to a narrower dtype than the
+        current one are dropped instead, so that they are built again.
+        """
+        for name, value in list(self._values.items()):
+            if sp.issparse(value) and np.issubdtype(value.dtype, np.inexact):
+                dtype = self.dtype
+                if dtype is None:
+                    dtype = np.result_type(value.dtype, np.float64)
+                if value.dtype != dtype and np.can_cast(value.dtype, dtype):
+                    self.pop(name)
+                    continue
+            self._values[name] = self.astype(value)
+            self._nbytes[name] = cache_nbytes(self._values[name])
+        self.evict()
+
+    def _path(self, name):
+        from discretize import __version__
+        # operators built with other settings or types are kept apart
+        entry = name.lstrip('_')
+        variant = None if self.variant is None else self.variant(name)
+        if variant is not None:
+            entry += '.' + variant
+        for dtype in [self.dtype, self.index_dtype]:
+            if dtype is not None:
+                entry += '.' + np.dtype(dtype).name
+        return os.path.join(
+            self.directory, 'discretize-' + __version__, self.fingerprint(),
+            entry
+        )
+
+    def _load(self, name):
+        if self.directory is None or self.fingerprint is None:
+            return None
+        return load_csr(self._path(name))
+
+    def _save(self, name, value):
+        if (
+            self.directory is None or self.fingerprint is None or
+            not isinstance(value, sp.csr_matrix)
+        ):
+            return
+        path = self._path(name)
+        # the values loaded from the disk are already there
+        if not os.path.isdir(path):
+            save_csr(path, value)
+            self.disk_saves += 1
+
+    def pop(self, name):
+        """Remove the value stored under name"""
+        self._values.pop(name, None)
+        self._nbytes.pop(name, None)
+        self._fresh.discard(name)
+
+    def evict(self, keep=None):
+        """Drop the least recently used values until under the budget"""
+        if self.budget is None:
+            return
+        total = self.nbytes
+        for name in list(self._values):
+            if total <= self.budget:
+                break
+            if name == keep:
+                continue
+            total -= self._nbytes[name]
+            self.pop(name)
+            self.evictions += 1
+
+    def clear(self, pattern=None):
+        """Remove the values whose name matches the glob pattern
+
+        Clearing everything also forgets the fingerprint of the mesh.
+        """
+        if pattern is None:
+            self._fingerprint = None
+        for name in list(self._values):
+            if pattern is None or fnmatch.fnmatchcase(name.lstrip('_'), pattern):
+                self.pop(name)
+
+    def info(self):
+        """Summary of the stored values and of the cache statistics"""
+        entries = OrderedDict()
+        for name in self._values:
+            hits, misses = self._stats.get(name, [0, 0])
+            entries[name.lstrip('_')] = {
+                'nbytes': self._nbytes[name], 'hits': hits, 'misses': misses
+            }
+        return {
+            'budget': self.budget,
+            'nbytes': self.nbytes,
+            'hits': sum(s[0] for s in self._stats.values()),
+            'misses': sum(s[1] for s in self._stats.values()),
+            'evictions': self.evictions,
+            'directory': self.directory,
+            'disk_loads': self.disk_loads,
+            'disk_saves': self.disk_saves,
+            'entries': entries,
+        }
+
+
+def operator_cache(mesh):
+    """The OperatorCache of a mesh, created on first use"""
+    cache = mesh.__dict__.get('_operator_cache')
+    if cache is None:
+        ref = weakref.ref(mesh)
+
+        def variant(name):
+            # see DiffOperators._cache_variant
+            get = getattr(ref(), '_cache_variant', None)
+            return None if get is None else get(name)
+
+        cache = OperatorCache(
+            getattr(mesh, 'default_cache_budget', None),
+            getattr(mesh, 'default_cache_dir', None),
+            lambda: ref().fingerprint,
+            getattr(mesh, 'default_operator_dtype', None),
+            getattr(mesh, 'default_index_dtype', None),
+            variant,
+        )
+        mesh.__dict__['_operator_cache'] = cache
+    return cache
+
+
+class CachedAttribute(object):
+    """Attribute whose value is kept in the OperatorCache of its mesh.
+
+    Reading it gives None when nothing is stored, so the usual
+    ``if getattr(self, '_x', None) is None:`` pattern builds the value again
+    after it was evicted.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, mesh, cls=None):
+        if mesh is None:
+            return self
+        return operator_cache(mesh).get(self.name)
+
+    def __set__(self, mesh, value):
+        operator_cache(mesh).set(self.name, value)
+
+    def __delete__(self, mesh):
+        operator_cache(mesh).pop(self.name)
+
+
+def cached_attributes(*names):
+    """Class decorator keeping the named attributes in the operator cache.
+
+    .. code:: python
+
+        @cached_attributes('_faceDiv', '_edgeCurl')
+        class DiffOperators(object):
+            ...
+    """
+    def decorator(cls):
+        for name in names:
+            setattr(cls, name, CachedAttribute(name))
+        return cls
+    return decorator
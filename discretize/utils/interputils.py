@@ -82,3 +82,177 @@ def interpmat(locs, x, y=None, z=None):
     Q = sp.csr_matrix((vals, (I, J)),
                       shape=(npts, np.prod(shape)))
     return Q
+
+
+def _overlap_1D(lo, hi, x):
+    """Overlaps of the intervals [lo, hi] with the cells of the nodal grid x
+
+    Returns the first overlapped cell, the number of overlapped cells and a
+    function evaluating the overlap length of interval ``i`` with cell ``k``.
+    Overlaps shorter than a relative tolerance of the interval length are
+    ignored so that shared faces (up to round-off) do not produce entries.
+    """
+    tol = 1e-10*(hi - lo)
+    start = np.maximum(np.searchsorted(x, lo + tol, side='right') - 1, 0)
+    end = np.minimum(np.searchsorted(x, hi - tol, side='left'), len(x) - 1)
+    count = np.maximum(end - start, 0)
+
+    def length(i, k):
+        return np.minimum(hi[i], x[k+1]) - np.maximum(lo[i], x[k])
+    return start, count, length
+
+
+def _box_tensor_overlaps(lo, hi, nodes):
+    """Sparse overlap volumes between axis aligned boxes and a tensor grid
+
+    The overlap of a box with the tensor cells is the outer product of the
+    1D overlaps along each axis, so it is built with one interval sweep per
+    axis followed by an expansion of the per-box index ranges.
+
+    :param numpy.ndarray lo: (n_boxes, dim) lower corners of the boxes
+    :param numpy.ndarray hi: (n_boxes, dim) upper corners of the boxes
+    :param list nodes: nodal grid vectors of the tensor mesh
+    :rtype: tuple
+    :return: box indices, tensor cell indices (Fortran ordered) and volumes
+    """
+    box = np.arange(lo.shape[0])
+    ind = np.zeros(lo.shape[0], dtype=np.int64)
+    vol = np.ones(lo.shape[0])
+    stride = 1
+    for dim, x in enumerate(nodes):
+        start, count, length = _overlap_1D(lo[:, dim], hi[:, dim], x)
+        n = count[box]
+        offsets = np.cumsum(n) - n
+        local = np.arange(n.sum()) - np.repeat(offsets, n)
+        box = np.repeat(box, n)
+        k = start[box] + local
+        ind = np.repeat(ind, n) + k*stride
+        vol = np.repeat(vol, n)*length(box, k)
+        stride *= len(x) - 1
+    return box, ind, vol
+
+
+def _cell_bounds(mesh):
+    """Lower and upper corners of the cells of a tensor or tree mesh"""
+    if mesh._meshType == 'TREE':
+        nodes = np.r_[mesh.gridN, mesh.gridhN]
+        cell_nodes = mesh.cell_nodes
+        return nodes[cell_nodes[:, 0]], nodes[cell_nodes[:, -1]]
+    h = mesh.h_gridded.reshape(-1, mesh.dim)
+    lo = mesh.gridCC.reshape(-1, mesh.dim) - 0.5*h
+    return lo, lo + h
+
+
+def _tensor_weights_1D(x_in, x_out):
+    """1D averaging matrix from the cells of x_in to the cells of x_out"""
+    start, count, length = _overlap_1D(x_out[:-1], x_out[1:], x_in)
+    row = np.repeat(np.arange(len(x_out) - 1), count)
+    offsets = np.cumsum(count) - count
+    col = start[row] + np.arange(count.sum()) - np.repeat(offsets, count)
+    W = sp.csr_matrix(
+        (length(row, col), (row, col)), shape=(len(x_out) - 1, len(x_in) - 1)
+    )
+    covered = np.asarray(W.sum(axis=1)).ravel()
+    covered[covered == 0] = 1.0
+    return sp.diags(1.0/covered)*W
+
+
+def volume_average(mesh_in, mesh_out, values=None):
+    """Volume averaging interpolation between two meshes
+
+    Every cell of ``mesh_out`` receives the volume weighted average of the
+    ``mesh_in`` cells it overlaps, which conserves the integrated quantity
+    wherever ``mesh_out`` lies inside ``mesh_in``. Output cells that only
+    partially overlap ``mesh_in`` are averaged over the overlapping part, and
+    cells outside ``mesh_in`` are set to zero.
+
+    Both tensor to tensor and tensor to tree (in either direction) transfers
+    are supported for arbitrary, overlapping grids. Tensor meshes are
+    handled with one 1D interval overlap sweep per axis (the operator is a
+    Kronecker product of the 1D operators), tree meshes with a single pass
+    over their leaf cells. Transfers between two tree meshes that share a
+    base grid are delegated to :meth:`TreeMesh.get_transfer_matrix`.
+
+    :param discretize.base.BaseMesh mesh_in: mesh the values live on
+    :param discretize.base.BaseMesh mesh_out: mesh to average onto
+    :param numpy.ndarray values: optional cell centered values on mesh_in
+    :rtype: scipy.sparse.csr_matrix or numpy.ndarray
+    :return: the (mesh_out.nC, mesh_in.nC) averaging matrix, or, if values
+        are given, the averaged values applied without forming the matrix
+
+    .. code:: python
+
+        import discretize
+        import numpy as np
+        h1 = np.ones(16)/16
+        h2 = np.ones(5)/5
+        mesh_in = discretize.TensorMesh([h1, h1])
+        mesh_out = discretize.TensorMesh([h2, h2])
+        model = np.random.rand(mesh_in.nC)
+        P = discretize.utils.volume_average(mesh_in, mesh_out)
+        np.allclose(P*model, discretize.utils.volume_average(mesh_in, mesh_out, model))
+    """
+    if mesh_in.dim != mesh_out.dim:
+        raise ValueError(
+            "Mesh dimensions do not match: {} and {}".format(
+                mesh_in.dim, mesh_out.dim
+            )
+        )
+    types = (mesh_in._meshType, mesh_out._meshType)
+    for mesh_type in types:
+        if mesh_type not in ['TENSOR', 'TREE']:
+            raise ValueError(
+                "Volume averaging is only implemented for TensorMesh and "
+                "TreeMesh, not {}".format(mesh_type)
+            )
+    if values is not None:
+        values = np.asarray(values, dtype=float)
+        if values.shape != (mesh_in.nC, ):
+            raise ValueError(
+                "values must have shape ({}, ), not {}".format(
+                    mesh_in.nC, values.shape
+                )
+            )
+
+    if types == ('TREE', 'TREE'):
+        P = mesh_in.get_transfer_matrix(mesh_out)
+        return P if values is None else P*values
+
+    if types == ('TENSOR', 'TENSOR'):
+        Ws = [
+            _tensor_weights_1D(x_in, x_out) for x_in, x_out in zip(
+                _nodal_vectors(mesh_in), _nodal_vectors(mesh_out)
+            )
+        ]
+        if values is None:
+            P = Ws[0]
+            for W in Ws[1:]:
+                P = sp.kron(W, P)
+            return P.tocsr()
+        # apply the 1D operators one axis at a time
+        out = values.reshape(mesh_in.vnC, order='F')
+        for dim, W in enumerate(Ws):
+            out = np.moveaxis(out, dim, 0)
+            shape = out.shape
+            out = (W*out.reshape(shape[0], -1)).reshape((-1, ) + shape[1:])
+            out = np.moveaxis(out, 0, dim)
+        return out.reshape(-1, order='F')
+
+    if mesh_in._meshType == 'TENSOR':
+        lo, hi = _cell_bounds(mesh_out)
+        rows, cols, vol = _box_tensor_overlaps(lo, hi, _nodal_vectors(mesh_in))
+    else:
+        lo, hi = _cell_bounds(mesh_in)
+        cols, rows, vol = _box_tensor_overlaps(lo, hi, _nodal_vectors(mesh_out))
+    n_out = mesh_out.nC
+    covered = np.bincount(rows, weights=vol, minlength=n_out)
+    covered[covered == 0] = 1.0
+    vol = vol/covered[rows]
+    if values is None:
+        return sp.csr_matrix((vol, (rows, cols)), shape=(n_out, mesh_in.nC))
+    return np.bincount(rows, weights=vol*values[cols], minlength=n_out)
+
+
+def _nodal_vectors(mesh):
+    """Nodal grid vectors of a tensor mesh"""
+    return [mesh.vectorNx, mesh.vectorNy, mesh.vectorNz][:mesh.dim]
@@ -1,6 +1,7 @@
 from __future__ import division
 import numpy as np
 import scipy.sparse as sp
+from scipy.sparse.linalg import LinearOperator
 from .codeutils import isScalar
 
 
@@ -63,6 +64,204 @@ def kron3(A, B, C):
     return sp.kron(sp.kron(A, B), C, format="csr")
 
 
+def _is_identity(f):
+    # KronOperator stores identity factors by their size
+    return isinstance(f, (int, np.integer))
+
+
+class KronOperator(LinearOperator):
+    """Lazy Kronecker product of 1D operators
+
+    Represents ``kron(factors[0], kron(factors[1], ...))`` without forming
+    it. A product with a vector contracts each factor along its own axis of
+    the Fortran ordered array, the last factor acting on the fastest (x)
+    axis, so only the 1D factors are stored. The full sparse matrix is only
+    built when asked for with :meth:`tocsr`.
+
+    :param factors: sparse or dense 2D matrices, an integer ``n`` stands for
+        the identity of size ``n``
+
+    .. code:: python
+
+        D = KronOperator(ny, ddx(nx))  # same as sp.kron(speye(ny), ddx(nx))
+        D*u
+    """
+
+    def __init__(self, *factors):
+        self.factors = [
+            f if _is_identity(f) else sp.csr_matrix(f) for f in factors
+        ]
+        rows = [f if _is_identity(f) else f.shape[0] for f in self.factors]
+        cols = [f if _is_identity(f) else f.shape[1] for f in self.factors]
+        # the axes of the Fortran ordered array run opposite to the factors
+        self._in_shape = tuple(int(n) for n in cols[::-1])
+        self._out_shape = tuple(int(n) for n in rows[::-1])
+        dtype = np.result_type(*(
+            [np.float64] + [f.dtype for f in self.factors if sp.issparse(f)]
+        ))
+        super(KronOperator, self).__init__(
+            dtype=dtype,
+            shape=(int(np.prod(rows)), int(np.prod(cols)))
+        )
+
+    @staticmethod
+    def _contract(f, X, shape, axis):
+        # apply f along one axis of the Fortran ordered X, seen as a C ordered
+        # (after, axis, before) array so that no transposes are needed
+        before = int(np.prod(shape[:axis]))
+        after = int(np.prod(shape[axis+1:]))
+        X = X.reshape(after, shape[axis], before)
+        n_rows, n_cols = f.shape
+        D = f.todia()
+        if len(D.offsets) > 8:
+            X = np.moveaxis(X, 1, 0).reshape(n_cols, -1)
+            out = f.dot(X).reshape(n_rows, after, before)
+            return np.moveaxis(out, 0, 1)
+        dtype = np.result_type(X, f)
+        if before == 1:
+            # a trailing axis of length one is slow to broadcast over
+            X = X[:, :, 0]
+        # banded 1D factors are applied as strided shifts of the array, the
+        # output is kept divided by a common scale of the diagonals
+        out, scale = None, 1.
+        for offset, d in zip(D.offsets, D.data):
+            j0, j1 = max(0, offset), min(n_cols, n_rows + offset, len(d))
+            if j1 <= j0:
+                continue
+            d = d[j0:j1]
+            if np.all(d == d[0]):
+                d = d[0]
+            elif before != 1:
+                d = d[:, None]
+            src = X[:, j0:j1]
+            if out is None and j1 - j0 == n_rows and np.isscalar(d) and d:
+                out, scale = np.array(src, dtype=dtype), d
+                continue
+            if out is None:
+                out = np.zeros((after, n_rows) + X.shape[2:], dtype=dtype)
+            dst = out[:, j0-offset:j1-offset]
+            if np.isscalar(d) and d == scale:
+                dst += src
+            elif np.isscalar(d) and d == -scale:
+                dst -= src
+            else:
+                dst += (d/scale)*src
+        if out is None:
+            out = np.zeros((after, n_rows) + X.shape[2:], dtype=dtype)
+        elif scale != 1:
+            out *= scale
+        return out
+
+    def _apply(self, X, transpose=False):
+        X = np.asarray(X)
+        n_vec = X.shape[1]
+        if transpose:
+            shape = list(self._out_shape)
+        else:
+            shape = list(self._in_shape)
+        shape.append(n_vec)
+        X = X.ravel(order='F')
+        for axis, f in enumerate(self.factors[::-1]):
+            if _is_identity(f):
+                continue
+            if transpose:
+                f = f.T
+            X = self._contract(f, X, shape, axis)
+            shape[axis] = f.shape[0]
+        return X.reshape(-1).reshape(-1, n_vec, order='F')
+
+    def _matmat(self, X):
+        return self._apply(X)
+
+    def _rmatmat(self, X):
+        if not np.iscomplexobj(X) and self.dtype.kind != 'c':
+            return self._apply(X, transpose=True)
+        return self._apply(np.conj(X), transpose=True).conj()
+
+    def _matvec(self, x):
+        return self._apply(np.reshape(x, (-1, 1)))[:, 0]
+
+    def _rmatvec(self, x):
+        return self._rmatmat(np.reshape(x, (-1, 1)))[:, 0]
+
+    def _transpose(self):
+        return KronOperator(*[
+            f if _is_identity(f) else f.T
+            for f in self.factors
+        ])
+
+    def _adjoint(self):
+        return KronOperator(*[
+            f if _is_identity(f) else f.T.conj()
+            for f in self.factors
+        ])
+
+    def dot(self, x):
+        """Matrix product, kept lazy for a compatible KronOperator"""
+        if (
+            isinstance(x, KronOperator) and
+            len(x.factors) == len(self.factors) and
+            x._out_shape == self._in_shape
+        ):
+            factors = []
+            for a, b in zip(self.factors, x.factors):
+                if _is_identity(a):
+                    factors.append(b)
+                elif _is_identity(b):
+                    factors.append(a)
+                else:
+                    factors.append(a*b)
+            return KronOperator(*factors)
+        return super(KronOperator, self).dot(x)
+
+    def tocsr(self):
+        """Build the full sparse matrix"""
+        A = None
+        for f in self.factors:
+            if _is_identity(f):
+                f = speye(f)
+            A = f if A is None else sp.kron(A, f, format='csr')
+        return sp.csr_matrix(A)
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+
+def sparse_astype(A, dtype=None, index_dtype=None):
+    """Sparse matrix A with values of type dtype and indices of type index_dtype
+
+    None keeps the current type. A itself is returned when it already has the
+    requested types, and is never modified.
+
+    .. code:: python
+
+        D = sparse_astype(mesh.faceDiv, np.float32, np.int32)
+    """
+    if dtype is not None and A.dtype != dtype:
+        A = A.astype(dtype)
+    if index_dtype is None:
+        return A
+    index_dtype = np.dtype(index_dtype)
+    names = [
+        name for name in ['indices', 'indptr', 'row', 'col']
+        if isinstance(getattr(A, name, None), np.ndarray) and
+        getattr(A, name).dtype != index_dtype
+    ]
+    if not names:
+        return A
+    if max(A.shape + (A.nnz,)) > np.iinfo(index_dtype).max:
+        raise ValueError(
+            "{} cannot index a matrix of shape {} with {} entries".format(
+                index_dtype, A.shape, A.nnz
+            )
+        )
+    # a new matrix sharing the values, so that A keeps its indices
+    A = type(A)(A)
+    for name in names:
+        setattr(A, name, getattr(A, name).astype(index_dtype))
+    return A
+
+
 def spzeros(n1, n2):
     """a sparse matrix of zeros"""
     return sp.dia_matrix((n1, n2))
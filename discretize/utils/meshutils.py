@@ -470,6 +470,60 @@ def mesh_builder_xyz(
     return mesh
 
 
+def point_distance_criterion(
+    xyz, distances, levels, default_level=0, workers=1
+):
+    """
+    Refinement criterion on the distance of cell centers to a point cloud
+
+    Builds a function for :meth:`TreeMesh.refine_vectorized` that gives every
+    cell whose center is closer than ``distances[k]`` to any of the points
+    at least the level ``levels[k]``. The points are put in a single
+    cKDTree, and every pass of the refinement locates all of the cells it
+    tests with one batched query.
+
+    Parameters
+    ----------
+    xyz: numpy.ndarray
+        2D array of points
+    distances: array_like
+        Distances from the points for each of the levels
+    levels: array_like of int
+        Minimum level of the cells within each distance
+    default_level: int
+        Level of the cells further than all distances
+    workers: int
+        Number of parallel workers for the queries (-1 uses all processors).
+
+    Returns
+    --------
+    callable
+        function(centers, widths, levels) of the desired cell levels
+
+    Examples
+    --------
+    >>> mesh = discretize.TreeMesh([64, 64])
+    >>> points = np.random.rand(100, 2)
+    >>> criterion = point_distance_criterion(points, [0.02, 0.1], [6, 4])
+    >>> mesh.refine_vectorized(criterion)
+    """
+    tree = cKDTree(xyz)
+    distances = np.atleast_1d(distances)
+    levels = np.broadcast_to(levels, distances.shape)
+    # only scipy>=1.6 knows about the workers
+    query_kwargs = {} if workers == 1 else {'workers': workers}
+
+    def criterion(centers, widths, cell_levels):
+        r, _ = tree.query(
+            centers, distance_upper_bound=distances.max(), **query_kwargs
+        )
+        out = np.full(len(r), default_level, dtype=np.int64)
+        for distance, level in zip(distances, levels):
+            out[(r < distance) & (out < level)] = level
+        return out
+    return criterion
+
+
 def refine_tree_xyz(
     mesh, xyz,
     method="radial",
@@ -477,7 +531,8 @@ def refine_tree_xyz(
     octree_levels_padding=None,
     finalize=False,
     min_level=0,
-    max_distance=np.inf
+    max_distance=np.inf,
+    workers=1
 ):
     """
     Refine a TreeMesh based on xyz point locations
@@ -506,6 +561,9 @@ def refine_tree_xyz(
     max_distance: float
         Maximum refinement distance from xyz locations.
         Used for method="surface" to reduce interpolation distance.
+    workers: int
+        Number of parallel workers for the nearest neighbor queries of
+        method="radial" and "surface" (-1 uses all processors).
 
     Returns
     --------
@@ -534,9 +592,6 @@ def refine_tree_xyz(
     # Trigger different refine methods
     if method.lower() == "radial":
 
-        # Build a cKDTree for fast nearest lookup
-        tree = cKDTree(xyz)
-
         # Compute the outer limits of each octree level
         rMax = np.cumsum(
             mesh.hx.min() *
@@ -544,20 +599,13 @@ def refine_tree_xyz(
             2**np.arange(len(octree_levels))
         )
 
-        # Radial function
-        def inBall(cell):
-            xyz = cell.center
-            r, ind = tree.query(xyz)
-
-            for ii, nC in enumerate(octree_levels):
-
-                if r < rMax[ii]:
-
-                    return mesh.max_level-ii
-
-            return min_level
-
-        mesh.refine(inBall, finalize=finalize)
+        # Refine one level at a time, locating all of the cell centers of
+        # each pass with a single nearest neighbor query
+        criterion = point_distance_criterion(
+            xyz, rMax, mesh.max_level - np.arange(len(octree_levels)),
+            default_level=min_level, workers=workers
+        )
+        mesh.refine_vectorized(criterion, finalize=finalize)
 
     elif method.lower() == 'surface':
 
@@ -590,8 +638,14 @@ def refine_tree_xyz(
             2**np.arange(len(octree_levels_padding))
         )
 
-        # Increment the vertical offset
-        zOffset = 0
+        # Only keep points within max_distance
+        tree = cKDTree(xyz) if np.isfinite(max_distance) else None
+        # only scipy>=1.6 knows about the workers
+        query_kwargs = {} if workers == 1 else {'workers': workers}
+
+        # Number of sampled points processed at a time
+        n_chunk = 100000
+        dim = mesh.dim - 1
         xyPad = -1
         depth = zmax[-1]
         # Cycle through the Tree levels backward
@@ -618,62 +672,55 @@ def refine_tree_xyz(
                     tri2D = Delaunay(xLoc[:, :2])
                     F = interpolate.LinearNDInterpolator(tri2D, xLoc[:, 2])
                 else:
-                    F = interpolate.interp1d(xLoc[:, 0], xLoc[:, 1], fill_value='extrapolate')
+                    F = interpolate.interp1d(
+                        xLoc[:, 0], xLoc[:, 1], fill_value='extrapolate'
+                    )
 
+            # A grid at the octree level over the surface
             limx = np.r_[xLoc[:, 0].max(), xLoc[:, 0].min()]
             nCx = int(np.ceil((limx[0]-limx[1]) / dx))
-
+            grid = [np.linspace(limx[1], limx[0], nCx)]
             if mesh.dim == 3:
                 limy = np.r_[xLoc[:, 1].max(), xLoc[:, 1].min()]
                 nCy = int(np.ceil((limy[0]-limy[1]) / dy))
+                grid.append(np.linspace(limy[1], limy[0], nCy))
+            n_grid = int(np.prod([g.shape[0] for g in grid]))
 
-                # Create a grid at the octree level in xy
-                CCx, CCy = np.meshgrid(
-                    np.linspace(
-                        limx[1], limx[0], nCx
-                        ),
-                    np.linspace(
-                        limy[1], limy[0], nCy
-                        )
-                )
-
-                xy = np.c_[CCx.reshape(-1), CCy.reshape(-1)]
-
-                # Only keep points within triangulation
-                indexTri = tri2D.find_simplex(xy)
-
-            else:
-                xy = np.linspace(
-                        limx[1], limx[0], nCx
-                        )
-                indexTri = np.ones_like(xy, dtype='bool')
-
-            # Interpolate the elevation linearly
-            z = F(xy[indexTri != -1])
+            # Vertical padding for current octree level
+            zOffsets = []
+            zOffset = 0
+            while zOffset < depth:
+                zOffsets.append(zOffset)
+                zOffset += dz
 
-            newLoc = np.c_[xy[indexTri != -1], z]
+            # Sample the surface in chunks of the grid, keeping the points
+            # within the triangulation and max_distance, and insert the
+            # columns below each chunk at once
+            for start in range(0, n_grid, n_chunk):
+                inds = np.arange(start, min(start + n_chunk, n_grid))
+                if mesh.dim == 3:
+                    xy = np.c_[grid[0][inds % nCx], grid[1][inds // nCx]]
+                    xy = xy[tri2D.find_simplex(xy) != -1]
+                else:
+                    xy = grid[0][inds]
 
-            # Only keep points within max_distance
-            tree = cKDTree(xyz)
-            r, ind = tree.query(newLoc)
+                # Interpolate the elevation linearly
+                newLoc = np.c_[xy, F(xy)]
+                if tree is not None:
+                    r, _ = tree.query(newLoc, **query_kwargs)
+                    newLoc = newLoc[r < (max_distance + padWidth[ii])]
 
-            # Apply vertical padding for current octree level
-            dim = mesh.dim - 1
-            zOffset = 0
-            while zOffset < depth:
-                indIn = r < (max_distance + padWidth[ii])
-                nnz = int(np.sum(indIn))
-                if nnz > 0:
+                nnz = newLoc.shape[0]
+                if nnz > 0 and zOffsets:
                     mesh.insert_cells(
-                        np.c_[
-                                newLoc[indIn, :dim],
-                                newLoc[indIn, -1]-zOffset],
-                        np.ones(nnz)*mesh.max_level-ii,
+                        np.vstack([
+                            np.c_[newLoc[:, :dim], newLoc[:, -1]-z]
+                            for z in zOffsets
+                        ]),
+                        np.ones(nnz*len(zOffsets))*mesh.max_level-ii,
                         finalize=False
                     )
 
-                zOffset += dz
-
             depth -= dz * octree_levels[ii]
 
         if finalize:
@@ -751,18 +798,13 @@ def refine_tree_xyz(
                 )
             ]
 
-        def inBox(cell):
-
-            xyz = cell.center
-
-            for ii, (nC, bsw, tne) in enumerate(zip(octree_levels, BSW, TNE)):
-
-                if np.all([xyz > bsw, xyz < tne]):
-                    return mesh.max_level-ii
-
-            return cell._level
-
-        mesh.refine(inBox, finalize=finalize)
+        # Refine the cells whose centers fall inside the boxes, tested
+        # natively in the same order as a per cell refine function
+        mesh._refine_center_boxes(
+            np.vstack(BSW), np.vstack(TNE),
+            mesh.max_level-np.arange(len(octree_levels)),
+            finalize=finalize
+        )
 
     else:
         raise NotImplementedError(
@@ -773,7 +815,48 @@ def refine_tree_xyz(
     return mesh
 
 
-def active_from_xyz(mesh, xyz, grid_reference='CC', method='linear'):
+def _active_locations(mesh, grid_reference):
+    """Unique locations tested by active_from_xyz, and the ones of each cell
+
+    Returns the locations and an (nC, n) array of the index of the locations
+    tested for each cell. For nodes only the top corners of each cell are
+    tested, and nodes shared between cells appear once.
+    """
+    if grid_reference == 'CC':
+        return mesh.gridCC, np.arange(mesh.nC)[:, None]
+
+    n_top = 2**(mesh.dim - 1)
+    if isinstance(mesh, discretize.TreeMesh):
+        nodes = np.r_[mesh.gridN, mesh.gridhN]
+        top = mesh.cell_nodes[:, -n_top:]
+        used, inverse = np.unique(top, return_inverse=True)
+        return nodes[used], inverse.reshape(top.shape)
+
+    if isinstance(mesh, discretize.TensorMesh):
+        # nodes above the bottom layer, indexed from the cell indexes
+        shape = list(mesh.vnN[:-1]) + [mesh.vnC[-1]]
+        ijk = np.unravel_index(np.arange(mesh.nC), mesh.vnC, order='F')
+        corners = []
+        for corner in range(n_top):
+            shift = [(corner >> d) & 1 for d in range(mesh.dim - 1)] + [0]
+            corners.append(np.ravel_multi_index(
+                [i + s for i, s in zip(ijk, shift)], shape, order='F'
+            ))
+        return mesh.gridN[-np.prod(shape):], np.column_stack(corners)
+
+    # top corners of every cell
+    signs = np.array(np.meshgrid(*[[-1, 1]]*(mesh.dim - 1), indexing='ij'))
+    signs = np.c_[signs.reshape(mesh.dim - 1, -1).T, np.ones(n_top)]
+    locations = np.vstack([
+        mesh.gridCC + sign * mesh.h_gridded / 2. for sign in signs
+    ])
+    return locations, np.arange(mesh.nC*n_top).reshape((mesh.nC, -1), order='F')
+
+
+def active_from_xyz(
+    mesh, xyz, grid_reference='CC', method='linear', chunk_size=500000,
+    workers=1
+):
     """Returns an active cell index array below a surface
 
     Get active cells in the `mesh` that are below the surface create by
@@ -802,6 +885,11 @@ def active_from_xyz(mesh, xyz, grid_reference='CC', method='linear'):
         Use cell coordinates from cells-center 'CC' or nodes 'N'.
     method : {'linear', 'nearest'}
         Interpolation method for the xyz points.
+    chunk_size : int
+        Number of locations interpolated at a time, which bounds the memory
+        used for large meshes.
+    workers : int
+        Number of chunks interpolated in parallel threads.
 
     Returns
     -------
@@ -870,49 +958,46 @@ def active_from_xyz(mesh, xyz, grid_reference='CC', method='linear'):
         if xyz.ndim != 1:
             raise ValueError("xyz locations of shape (*, ) required for 1D mesh")
 
-    if grid_reference == 'CC':
-        locations = mesh.gridCC
-
-        if mesh.dim == 1:
-            active = np.zeros(mesh.nC, dtype='bool')
+    if mesh.dim == 1:
+        active = np.zeros(mesh.nC, dtype='bool')
+        if grid_reference == 'CC':
             active[np.searchsorted(mesh.vectorCCx, xyz).max():] = True
-            return active
-
-    elif grid_reference == 'N':
-
-        if mesh.dim == 3:
-            locations = np.vstack([
-                mesh.gridCC + (np.c_[-1, 1, 1][:, None] * mesh.h_gridded / 2.).squeeze(),
-                mesh.gridCC + (np.c_[-1, -1, 1][:, None] * mesh.h_gridded / 2.).squeeze(),
-                mesh.gridCC + (np.c_[1, 1, 1][:, None] * mesh.h_gridded / 2.).squeeze(),
-                mesh.gridCC + (np.c_[1, -1, 1][:, None] * mesh.h_gridded / 2.).squeeze()
-            ])
-
-        elif mesh.dim == 2:
-            locations = np.vstack([
-                mesh.gridCC + (np.c_[-1, 1][:, None] * mesh.h_gridded / 2.).squeeze(),
-                mesh.gridCC + (np.c_[1, 1][:, None] * mesh.h_gridded / 2.).squeeze(),
-            ])
-
         else:
-            active = np.zeros(mesh.nC, dtype='bool')
             active[np.searchsorted(mesh.vectorNx, xyz).max():] = True
+        return active
+
+    # Every unique location is tested once, in chunks
+    locations, cell_locations = _active_locations(mesh, grid_reference)
+    below = np.empty(locations.shape[0], dtype=bool)
+    # the nearest neighbours used for points in extrapolation
+    nearest = []
+
+    def test_chunk(start):
+        chunk = locations[start:start + chunk_size]
+
+        # Interpolate z values on CC or N
+        z_xyz = z_interpolate(chunk[:, :-1]).reshape(-1)
+
+        # Apply nearest neighbour if in extrapolation
+        ind_nan = np.isnan(z_xyz)
+        if np.any(ind_nan):
+            if not nearest:
+                nearest.append(cKDTree(xyz))
+            _, ind = nearest[0].query(chunk[ind_nan, :])
+            z_xyz[ind_nan] = xyz[ind, dim]
+
+        below[start:start + chunk_size] = chunk[:, dim] < z_xyz
+
+    starts = range(0, locations.shape[0], chunk_size)
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        # build the neighbour tree once, before the threads need it
+        nearest.append(cKDTree(xyz))
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(test_chunk, starts))
+    else:
+        for start in starts:
+            test_chunk(start)
 
-            return active
-
-    # Interpolate z values on CC or N
-    z_xyz = z_interpolate(locations[:, :-1]).squeeze()
-
-    # Apply nearest neighbour if in extrapolation
-    ind_nan = np.isnan(z_xyz)
-    if any(ind_nan):
-        tree = cKDTree(xyz)
-        _, ind = tree.query(locations[ind_nan, :])
-        z_xyz[ind_nan] = xyz[ind, dim]
-
-    # Create an active bool of all True
-    active = np.all(
-        (locations[:, dim] < z_xyz).reshape((mesh.nC, -1), order='F'), axis=1
-    )
-
-    return active.ravel()
+    # Active if all of the locations of the cell are below
+    return np.all(below[cell_locations], axis=1)
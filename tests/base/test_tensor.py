@@ -1,5 +1,8 @@
 from __future__ import print_function
 import numpy as np
+import os
+import shutil
+import tempfile
 import unittest
 import discretize
 from pymatsolver import Solver
@@ -117,6 +120,222 @@ class BasicTensorMeshTests(unittest.TestCase):
         M = discretize.TensorMesh([[(10., 2)]])
         self.assertLess(np.abs(M.hx - np.r_[10., 10.]).sum(), TOL)
 
+    def test_ray_matrix(self):
+        starts = np.array([[2., 5.5], [3., 5.], [0., 0.]])
+        ends = np.array([[7., 5.5], [6., 8.], [1., 1.]])
+        G = self.mesh2.get_ray_matrix(starts, ends).toarray()
+        self.assertEqual(G.shape, (3, self.mesh2.nC))
+        self.assertTrue(np.allclose(G[0], [1, 1, 1, 0, 0, 0]))
+        self.assertTrue(np.allclose(G[1], np.sqrt(2)*np.r_[1, 0, 0, 0, 1, 1]))
+        self.assertTrue(np.all(G[2] == 0))
+
+    def test_volume_average(self):
+        mesh_in = discretize.TensorMesh([np.ones(16)/16, np.ones(8)/8, [1]])
+        mesh_out = discretize.TensorMesh([np.ones(5)/5, np.ones(3)/3, [1]])
+        model = np.random.rand(mesh_in.nC)
+        P = discretize.utils.volume_average(mesh_in, mesh_out)
+        self.assertTrue(np.allclose(P.sum(axis=1), 1))
+        self.assertTrue(np.allclose(mesh_out.vol @ (P*model), mesh_in.vol @ model))
+        out = discretize.utils.volume_average(mesh_in, mesh_out, model)
+        self.assertTrue(np.allclose(P*model, out))
+
+        # the parts of mesh_out outside of mesh_in are ignored
+        mesh_out = discretize.TensorMesh([[0.5, 1.], [2.], [1.]], x0=[0.5, -0.5, 0])
+        P = discretize.utils.volume_average(mesh_in, mesh_out).toarray()
+        self.assertTrue(np.allclose(P[0], mesh_in.vol*(mesh_in.gridCC[:, 0] > 0.5)*2))
+        self.assertTrue(np.all(P[1] == 0))
+
+    def test_matrix_free_operators(self):
+        names = [
+            'faceDiv', 'faceDivx', 'faceDivy', 'faceDivz', 'nodalGrad',
+            'cellGrad', 'edgeCurl', 'aveF2CC', 'aveF2CCV', 'aveCC2F',
+            'aveCCV2F', 'aveE2CC', 'aveE2CCV', 'aveEx2CC', 'aveN2CC',
+            'aveN2E', 'aveN2F'
+        ]
+        rng = np.random.RandomState(21)
+        mesh1 = discretize.TensorMesh([np.r_[1., 2., 1.5]])
+        self.mesh3.setCellGradBC(
+            [['dirichlet', 'neumann'], 'dirichlet', 'neumann']
+        )
+        for mesh in [mesh1, self.mesh2, self.mesh3]:
+            for name in names:
+                if mesh.dim == 1 and name == 'edgeCurl':
+                    continue
+                A = getattr(mesh, name)
+                B = mesh.get_matrix_free_operator(name)
+                if A is None:
+                    self.assertIsNone(B)
+                    continue
+                self.assertEqual(A.shape, B.shape)
+                self.assertLess(abs(B.tocsr() - A).max(), TOL)
+                x = rng.rand(A.shape[1], 2)
+                y = rng.rand(A.shape[0])
+                self.assertTrue(np.allclose(B*x, A*x))
+                self.assertTrue(np.allclose(B*x[:, 0], A*x[:, 0]))
+                self.assertTrue(np.allclose(B.T*y, A.T*y))
+        with self.assertRaises(ValueError):
+            self.mesh2.get_matrix_free_operator('faceInnerProduct')
+
+    def test_kron_operators(self):
+        names = [
+            'faceDivx', 'faceDivy', 'faceDivz', 'cellGradx', 'cellGrady',
+            'cellGradz', 'aveFx2CC', 'aveFy2CC', 'aveFz2CC', 'aveEx2CC',
+            'aveEy2CC', 'aveEz2CC', 'aveN2CC', '_nodalGradStencilx',
+            '_nodalGradStencily', '_nodalGradStencilz', 'aveCC2F', 'aveN2E'
+        ]
+        rng = np.random.RandomState(22)
+        for mesh in [self.mesh2, self.mesh3]:
+            for name in names:
+                A = getattr(mesh, name)
+                K = mesh.get_kron_operator(name)
+                if A is None:
+                    self.assertIsNone(K)
+                    continue
+                self.assertLess(abs(K.tocsr() - A).max(), TOL)
+                x = rng.rand(A.shape[1])
+                self.assertTrue(np.allclose(K*x, A*x))
+        with self.assertRaises(ValueError):
+            self.mesh3.get_kron_operator('faceDiv')
+
+    def test_operator_cache(self):
+        mesh = discretize.TensorMesh([8, 8, 8])
+        D = mesh.faceDiv
+        entry = mesh.cache_info()['entries']['faceDiv']
+        self.assertEqual((entry['hits'], entry['misses']), (0, 1))
+        # one hit for every access to a cached operator
+        self.assertIs(mesh.faceDiv, D)
+        entry = mesh.cache_info()['entries']['faceDiv']
+        self.assertEqual((entry['hits'], entry['misses']), (1, 1))
+        self.assertIs(mesh.faceDiv, D)
+        info = mesh.cache_info()
+        entry = info['entries']['faceDiv']
+        self.assertEqual((entry['hits'], entry['misses']), (2, 1))
+        self.assertEqual(
+            entry['nbytes'], D.data.nbytes + D.indices.nbytes + D.indptr.nbytes
+        )
+        self.assertEqual(
+            info['nbytes'], sum(e['nbytes'] for e in info['entries'].values())
+        )
+
+        mesh.aveE2CC
+        mesh.clear_cache('ave*')
+        self.assertNotIn('aveE2CC', mesh.cache_info()['entries'])
+        self.assertIn('faceDiv', mesh.cache_info()['entries'])
+
+        # the least recently used operators are dropped and rebuilt later
+        mesh.cache_budget = entry['nbytes'] + mesh.vol.nbytes
+        self.assertLessEqual(mesh.cache_info()['nbytes'], mesh.cache_budget)
+        self.assertIn('vol', mesh.cache_info()['entries'])
+        mesh.cache_budget = 1
+        self.assertEqual(len(mesh.cache_info()['entries']), 0)
+        self.assertGreater(mesh.cache_info()['evictions'], 0)
+        self.assertEqual(abs(mesh.faceDiv - D).max(), 0)
+        mesh.cache_budget = None
+        mesh.clear_cache()
+        self.assertEqual(mesh.cache_info()['nbytes'], 0)
+
+    def test_disk_cache(self):
+        mesh = discretize.TensorMesh([[1, 2, 3], 4, 5], x0='C00')
+        other = discretize.TensorMesh([[1, 2, 3], 4, 5], x0='C00')
+        self.assertEqual(mesh.fingerprint, other.fingerprint)
+        self.assertNotEqual(
+            mesh.fingerprint, discretize.TensorMesh([[1, 2, 3], 4, 5]).fingerprint
+        )
+
+        directory = tempfile.mkdtemp()
+        try:
+            mesh.cache_dir = directory
+            D = mesh.faceDiv
+            self.assertEqual(mesh.cache_info()['disk_saves'], 1)
+
+            # an identical mesh maps the saved arrays instead of building them
+            other.cache_dir = directory
+            D2 = other.faceDiv
+            self.assertEqual(other.cache_info()['disk_loads'], 1)
+            self.assertEqual(other.cache_info()['disk_saves'], 0)
+            self.assertEqual(abs(D2 - D).max(), 0)
+            base = D2.data
+            while base is not None and not isinstance(base, np.memmap):
+                base = base.base
+            self.assertIsInstance(base, np.memmap)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_cache_cell_grad_bc(self):
+        directory = tempfile.mkdtemp()
+        try:
+            meshes = []
+            for BC in ['dirichlet', 'neumann', 'dirichlet']:
+                mesh = discretize.TensorMesh([4, 5, 6])
+                mesh.cache_dir = directory
+                mesh.setCellGradBC(BC)
+                meshes.append(mesh)
+            G = [mesh.cellGrad for mesh in meshes]
+            Gbc = [mesh.cellGradBC for mesh in meshes]
+
+            # the meshes only differ by their boundary conditions
+            self.assertEqual(meshes[0].fingerprint, meshes[1].fingerprint)
+            entries = os.listdir(os.path.join(
+                directory, 'discretize-' + discretize.__version__,
+                meshes[0].fingerprint
+            ))
+            for entry in ['cellGrad', 'cellGradBC']:
+                self.assertIn(entry + '.bc-dd-dd-dd', entries)
+                self.assertIn(entry + '.bc-nn-nn-nn', entries)
+            self.assertEqual(abs(G[2] - G[0]).max(), 0)
+            self.assertEqual(abs(Gbc[2] - Gbc[0]).max(), 0)
+            self.assertGreater(abs(G[1] - G[0]).max(), 0)
+            self.assertGreater(abs(Gbc[1] - Gbc[0]).max(), 0)
+
+            neumann = discretize.TensorMesh([4, 5, 6])
+            self.assertEqual(abs(G[1] - neumann.cellGrad).max(), 0)
+            self.assertEqual(abs(Gbc[1] - neumann.cellGradBC).max(), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fingerprint_x0(self):
+        mesh = discretize.TensorMesh([4, 5])
+        fingerprint = mesh.fingerprint
+        mesh.x0 = np.r_[1., 2.]
+        self.assertNotEqual(mesh.fingerprint, fingerprint)
+        self.assertEqual(
+            mesh.fingerprint, discretize.TensorMesh([4, 5], x0=[1, 2]).fingerprint
+        )
+
+    def test_operator_dtype(self):
+        mesh = discretize.TensorMesh([6, 7, 8])
+        D = mesh.faceDiv
+        self.assertIsNone(mesh.operator_dtype)
+        mesh.operator_dtype = np.float32
+        mesh.index_dtype = np.int64
+        # the cached operators are converted, the new ones built with them
+        for A in [mesh.faceDiv, mesh.edgeCurl, mesh.getEdgeInnerProduct()]:
+            self.assertEqual(A.dtype, np.float32)
+            self.assertEqual(A.indices.dtype, np.int64)
+            self.assertEqual(A.indptr.dtype, np.int64)
+        self.assertTrue(np.allclose(mesh.faceDiv.toarray(), D.toarray()))
+        self.assertEqual(mesh.vol.dtype, np.float64)
+        self.assertEqual(D.dtype, np.float64)
+        with self.assertRaises(ValueError):
+            mesh.operator_dtype = np.int32
+        with self.assertRaises(ValueError):
+            mesh.index_dtype = np.uint32
+
+    def test_operator_dtype_widen(self):
+        mesh = discretize.TensorMesh([np.r_[1., 2., 0.5, 3.], [0.3, 1.7, 1.]])
+        names = ['faceDiv', 'edgeCurl', 'cellGrad', 'aveN2CC']
+        full = [getattr(mesh, name) for name in names]
+        for dtype in [None, np.float64]:
+            mesh.operator_dtype = np.float32
+            for name in names:
+                self.assertEqual(getattr(mesh, name).dtype, np.float32)
+            # the rounded operators are built again, not converted back
+            mesh.operator_dtype = dtype
+            for name, A in zip(names, full):
+                B = getattr(mesh, name)
+                self.assertEqual(B.dtype, np.float64)
+                self.assertEqual(abs(B - A).max(), 0)
+
     def test_serialization(self):
         mesh = discretize.TensorMesh.deserialize(self.mesh2.serialize())
         self.assertTrue(np.all(self.mesh2.x0 == mesh.x0))
@@ -2,13 +2,15 @@ from __future__ import print_function
 import unittest
 import numpy as np
 import scipy.sparse as sp
+from scipy import interpolate
+from scipy.spatial import cKDTree, Delaunay
 from discretize.utils import (
     sdiag, sub2ind, ndgrid, mkvc, isScalar,
     inv2X2BlockDiagonal, inv3X3BlockDiagonal,
     invPropertyTensor, makePropertyTensor, indexCube,
     ind2sub, asArray_N_x_Dim, TensorType, Zero, Identity,
     ExtractCoreMesh, active_from_xyz, mesh_builder_xyz, refine_tree_xyz,
-    meshTensor
+    meshTensor, KronOperator, sparse_astype, ddx, av
 )
 from discretize.Tests import checkDerivative
 import discretize
@@ -240,6 +242,43 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertTrue(true.shape == listArray.shape)
 
 
+    def test_KronOperator(self):
+        rng = np.random.RandomState(22)
+        A = sp.random(4, 3, density=0.5, format='csr', random_state=rng)
+        factors = [A, 2, ddx(5), av(3).T]
+        K = KronOperator(*factors)
+        full = sp.kron(sp.kron(sp.kron(A, sp.identity(2)), ddx(5)), av(3).T)
+        self.assertEqual(K.shape, full.shape)
+        self.assertTrue(np.allclose(K.toarray(), full.toarray()))
+        x = rng.rand(K.shape[1], 3)
+        y = rng.rand(K.shape[0])
+        self.assertTrue(np.allclose(K*x, full*x))
+        self.assertTrue(np.allclose(K*x[:, 0], full*x[:, 0]))
+        self.assertTrue(np.allclose(K.T*y, full.T*y))
+        self.assertTrue(np.allclose(K.rmatvec(y), full.T*y))
+
+        # products of compatible operators stay factored
+        K2 = KronOperator(sp.random(5, 3, density=0.5, random_state=rng), 2, ddx(5), 3)
+        P = K2*K.T
+        self.assertIsInstance(P, KronOperator)
+        self.assertTrue(np.allclose(P.toarray(), K2.toarray() @ K.T.toarray()))
+
+    def test_sparse_astype(self):
+        A = ddx(6)
+        self.assertIs(sparse_astype(A), A)
+        self.assertIs(sparse_astype(A, A.dtype, A.indices.dtype), A)
+        B = sparse_astype(A, np.float32, np.int64)
+        self.assertEqual(B.dtype, np.float32)
+        self.assertEqual(B.indices.dtype, np.int64)
+        self.assertEqual(B.indptr.dtype, np.int64)
+        self.assertEqual(A.indices.dtype, np.int32)
+        self.assertEqual(abs(B - A).max(), 0)
+        C = sparse_astype(A.tocoo(), index_dtype=np.int64)
+        self.assertEqual(C.row.dtype, np.int64)
+        self.assertEqual(C.dtype, np.float64)
+        with self.assertRaises(ValueError):
+            sparse_astype(sp.csr_matrix((1, 2**16)), index_dtype=np.int16)
+
 class TestZero(unittest.TestCase):
 
     def test_zero(self):
@@ -547,6 +586,55 @@ class TestMeshUtils(unittest.TestCase):
         with self.assertRaises(TypeError):
             indTopoCC = active_from_xyz(mesh_curvi, topo3D, grid_reference='CC', method='nearest')
 
+    def test_active_from_xyz_chunks(self):
+        [xx, yy] = np.meshgrid(np.linspace(-200, 200, 20), np.linspace(-200, 200, 20))
+        zz = 50 * np.exp(-0.5 * ((xx / 50) ** 2. + (yy / 50) ** 2.))
+        topo3D = np.c_[xx.ravel(), yy.ravel(), zz.ravel()]
+
+        mesh_tensor = discretize.TensorMesh([[(10., 24)], [(10., 20)], [(10., 30)]], x0='CCC')
+        mesh_tree = discretize.TreeMesh([[(10., 64)]]*3, x0='CCC')
+        mesh_tree.refine_ball([0, 0, 50], 100, mesh_tree.max_level)
+        for mesh in [mesh_tensor, mesh_tree]:
+            for grid_reference in ['CC', 'N']:
+                active = active_from_xyz(mesh, topo3D, grid_reference)
+                chunked = active_from_xyz(
+                    mesh, topo3D, grid_reference, chunk_size=1000, workers=2
+                )
+                self.assertTrue(np.all(active == chunked))
+
+    def test_active_from_xyz_nodes(self):
+        rng = np.random.RandomState(20)
+        topo = np.c_[
+            rng.uniform(-200, 200, (300, 2)), rng.uniform(-20, 60, 300)
+        ]
+        tri = Delaunay(topo[:, :2])
+        surface = interpolate.LinearNDInterpolator(tri, topo[:, 2])
+        nearest = cKDTree(topo)
+
+        def surface_at(locations):
+            z = surface(locations[:, :2])
+            ind_nan = np.isnan(z)
+            z[ind_nan] = topo[nearest.query(locations[ind_nan])[1], 2]
+            return z
+
+        mesh = discretize.TreeMesh([[(10., 64)]]*3, x0='CCC')
+        mesh.refine_ball([0, 0, 20], 150, mesh.max_level - 1, finalize=False)
+        mesh.refine_ball([50, -30, 0], 60, mesh.max_level)
+        self.assertTrue(mesh.ntN > mesh.nN)
+
+        # the top nodes of each cell, hanging nodes included
+        nodes = np.r_[mesh.gridN, mesh.gridhN]
+        top = nodes[mesh.cell_nodes[:, -4:]]
+        z_top = surface_at(top.reshape(-1, 3)).reshape(top.shape[:2])
+        expected = np.all(top[:, :, 2] < z_top, axis=1)
+        active = active_from_xyz(mesh, topo, 'N')
+        self.assertTrue(0 < expected.sum() < mesh.nC)
+        self.assertTrue(np.all(active == expected))
+
+        expected = mesh.gridCC[:, 2] < surface_at(mesh.gridCC)
+        active = active_from_xyz(mesh, topo, 'CC')
+        self.assertTrue(np.all(active == expected))
+
 
 if __name__ == '__main__':
     unittest.main()
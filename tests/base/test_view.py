@@ -56,5 +56,48 @@ class Cyl3DView(unittest.TestCase):
         with self.assertRaises(Exception):
             self.mesh.plotImage(np.random.rand(self.mesh.nC))
 
+
+class TreeView(unittest.TestCase):
+    def setUp(self):
+        mesh = discretize.TreeMesh([16, 16])
+        mesh.refine_ball([0.5, 0.5], 0.3, mesh.max_level)
+        self.mesh = mesh
+
+    def test_plotImage(self):
+        v = self.mesh.gridCC[:, 0].copy()
+        v[0] = np.nan
+        fig, ax = plt.subplots(1, 1)
+        self.mesh.plotImage(v, ax=ax, grid=True)
+        pc = ax.collections[0]
+        self.assertEqual(len(pc.get_paths()), self.mesh.nC - 1)
+        bounds = pc.get_paths()[0].get_extents().get_points()
+        cell = self.mesh[1]
+        self.assertTrue(np.allclose(bounds[0], cell.x0))
+        self.assertTrue(np.allclose(bounds[1] - bounds[0], cell.h))
+
+        fig, ax = plt.subplots(1, 1)
+        self.mesh.plotImage(v, ax=ax, raster=(32, 32))
+        image = np.ma.filled(ax.images[0].get_array(), np.nan)
+        self.assertEqual(image.shape, (32, 32))
+        # every pixel shows the x center of the cell it falls in
+        x = np.tile(np.linspace(0, 1, 65)[1::2], (32, 1))
+        self.assertTrue(np.all(np.abs(image - x)[~np.isnan(image)] < 1/16.))
+        self.assertEqual(np.isnan(image).sum(), np.prod(self.mesh[0].h*32))
+        plt.close('all')
+
+    def test_plotGrid(self):
+        ax = self.mesh.plotGrid()
+        segments = np.array(ax.collections[0].get_segments())
+        self.assertEqual(len(segments), self.mesh.nE)
+        lengths = np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1)
+        self.assertAlmostEqual(lengths.sum(), self.mesh.edge.sum())
+
+        mesh = discretize.TreeMesh([8, 8, 8])
+        mesh.refine_ball([0.5, 0.5, 0.5], 0.3, mesh.max_level)
+        ax = mesh.plotGrid()
+        ax.figure.canvas.draw()
+        self.assertEqual(len(ax.collections[0].get_segments()), mesh.nE)
+        plt.close('all')
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
 from __future__ import print_function
 import numpy as np
+import shutil
+import tempfile
 import unittest
 import discretize
 
@@ -52,6 +54,140 @@ class TestSimpleQuadTree(unittest.TestCase):
         M.refine(1)
         self.assertEqual(M.nC, 8)
 
+    def test_refine_vectorized(self):
+        M = discretize.TreeMesh([32, 32])
+
+        def func(centers, widths, levels):
+            r = np.linalg.norm(centers - 0.5, axis=1)
+            return np.where(r < 0.2, M.max_level, 2)
+
+        M.refine_vectorized(func)
+        levels = M._cell_levels_by_indexes(np.arange(M.nC))
+        self.assertTrue(np.all(func(M.gridCC, M.h_gridded, levels) <= levels))
+        self.assertTrue(np.allclose(M.vol.sum(), 1.0))
+
+        # read only results are accepted
+        def read_only(centers, widths, levels):
+            out = func(centers, widths, levels)
+            out.setflags(write=False)
+            return out
+
+        M2 = discretize.TreeMesh([32, 32])
+        M2.refine_vectorized(read_only)
+        self.assertEqual(M2.nC, M.nC)
+        M3 = discretize.TreeMesh([32, 32])
+        M3.refine_vectorized(
+            lambda centers, widths, levels: np.broadcast_to(3, levels.shape)
+        )
+        self.assertEqual(M3.nC, 64)
+
+        # a finalized mesh is changed with adapt
+        with self.assertRaises(ValueError):
+            M.refine_vectorized(func)
+
+    def test_hilbert_ordering(self):
+        M = discretize.TreeMesh([16, 16], ordering='hilbert')
+        M.refine(4)
+        self.assertEqual(M.ordering, 'hilbert')
+        # consecutive cells of a uniform mesh share a face along the curve
+        steps = np.linalg.norm(np.diff(M.gridCC, axis=0), axis=1)
+        self.assertTrue(np.allclose(steps, 1.0/16))
+
+        P = M.get_ordering_permutation('CC')
+        M2 = discretize.TreeMesh([16, 16])
+        M2.refine(4)
+        self.assertTrue(np.allclose(M.gridCC[P], M2.gridCC))
+
+        with self.assertRaises(ValueError):
+            discretize.TreeMesh([16, 16], ordering='peano')
+
+    def test_adapt(self):
+        def coarse(cell):
+            return 3 if cell.center[0] < 0.5 else 2
+
+        def fine(cell):
+            return 5 if np.linalg.norm(cell.center - 0.4) < 0.3 else 1
+
+        M = discretize.TreeMesh([16, 16])
+        M.refine(coarse)
+        M.faceDiv
+        gridCC, gridN = M.gridCC, M.gridN
+        gridF = np.r_[M.gridFx[:, 0], M.gridFy[:, 1]]
+        P = M.adapt(fine)
+
+        M2 = discretize.TreeMesh([16, 16])
+        M2.refine(coarse, finalize=False)
+        M2.refine(fine)
+        self.assertTrue(np.allclose(M.gridCC, M2.gridCC))
+        self.assertEqual((M.faceDiv - M2.faceDiv).nnz, 0)
+
+        # cells keep the value of the cell they were split from, linear
+        # fields are carried over exactly on the nodes and faces
+        old_cells = np.argmax(P['CC'].toarray(), axis=1)
+        self.assertTrue(np.allclose(P['CC'].sum(axis=1), 1))
+        self.assertTrue(np.all(np.abs(gridCC[old_cells] - M.gridCC) < 0.25))
+        self.assertTrue(np.allclose(P['N']*gridN.sum(1), M.gridN.sum(1)))
+        self.assertTrue(np.allclose(
+            P['F']*gridF, np.r_[M.gridFx[:, 0], M.gridFy[:, 1]]
+        ))
+
+        with self.assertRaises(ValueError):
+            discretize.TreeMesh([16, 16]).adapt(2)
+
+    def test_coarsen(self):
+        M = discretize.TreeMesh([32, 32])
+        M.refine(M.max_level)
+        r = np.linalg.norm(M.gridCC - 0.5, axis=1)
+        M.coarsen(np.where(r < 0.2, M.max_level, 0))
+        self.assertTrue(np.allclose(M.vol.sum(), 1.0))
+        r = np.linalg.norm(M.gridCC - 0.5, axis=1)
+        self.assertTrue(np.all(M.h_gridded[r < 0.2] == 1.0/32))
+
+        # the same mesh built from its cells has the same nodes and operators
+        M2 = discretize.TreeMesh([32, 32])
+        M2.__setstate__(M.__getstate__())
+        self.assertEqual(M.ntN, M2.ntN)
+        self.assertEqual((M.faceDiv - M2.faceDiv).nnz, 0)
+        self.assertEqual((M.nodalGrad - M2.nodalGrad).nnz, 0)
+
+        # no leaf is next to a leaf more than one level finer, the finer
+        # neighbors are all leaves (with an index)
+        for cell in M:
+            for neighbor in cell.neighbors:
+                if isinstance(neighbor, list):
+                    self.assertTrue(min(neighbor) >= 0)
+
+        M.coarsen(lambda cell: 0)
+        self.assertEqual(M.nC, 1)
+
+    def test_topology(self):
+        M = discretize.TreeMesh([16, 16])
+        M.refine_ball([0.5, 0.5], 0.2, M.max_level)
+        M.finalize()
+
+        ind, cells = M.cell_neighbors
+        off_e = np.r_[0, 0, M.ntEx, M.ntEx]
+        off_f = np.r_[0, 0, M.ntFx, M.ntFx]
+        for cell in M:
+            i = cell.index
+            self.assertEqual(list(M.cell_nodes[i]), cell.nodes)
+            self.assertEqual(list(M.cell_edges[i] - off_e), cell.edges)
+            self.assertEqual(list(M.cell_faces[i] - off_f), cell.faces)
+            for j, nb in enumerate(cell.neighbors):
+                nb = [] if nb == -1 else np.atleast_1d(nb).tolist()
+                self.assertEqual(list(cells[ind[4*i+j]:ind[4*i+j+1]]), nb)
+
+        # every cell lists itself on the inner side of its faces
+        fc = M.face_cells
+        self.assertTrue(np.all(fc[M.cell_faces[:, ::2], 1] == np.arange(M.nC)[:, None]))
+        self.assertTrue(np.all(fc[M.cell_faces[:, 1::2], 0] == np.arange(M.nC)[:, None]))
+
+        # edges run between their nodes
+        gridN = np.r_[M.gridN, M.gridhN]
+        gridE = np.r_[M.gridEx, M.gridhEx, M.gridEy, M.gridhEy]
+        en = M.edge_nodes
+        self.assertTrue(np.allclose(0.5*(gridN[en[:, 0]] + gridN[en[:, 1]]), gridE))
+
     def test_h_gridded_2D(self):
         hx, hy = np.ones(4), np.r_[1., 2., 3., 4.]
 
@@ -154,6 +290,406 @@ class TestOcTree(unittest.TestCase):
         # self.assertTrue(np.allclose(M._edgeEyFull, (M._deflationMatrix('E') * M.edge)[M.ntEx:(M.ntEx+M.ntEy)])
         # self.assertTrue(np.allclose(M._edgeEzFull, (M._deflationMatrix('E') * M.edge)[(M.ntEx+M.ntEy):]))
 
+    def test_refine_vectorized(self):
+        M = discretize.TreeMesh([16, 16, 16])
+
+        def func(cell):
+            r = np.linalg.norm(cell.center - 0.5)
+            return M.max_level if r < 0.2 else 2
+
+        def vfunc(centers, widths, levels):
+            r = np.linalg.norm(centers - 0.5, axis=1)
+            return np.where(r < 0.2, M.max_level, 2)
+
+        M.refine_vectorized(vfunc)
+        M2 = discretize.TreeMesh([16, 16, 16])
+        M2.refine(func)
+        self.assertEqual(M.nC, M2.nC)
+        self.assertTrue(np.allclose(M.gridCC, M2.gridCC))
+
+    def test_refine_ball(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        center, radius = np.r_[0.4, 0.5, 0.6], 0.2
+        M.refine_ball(center, radius, M.max_level)
+
+        # every cell touching the ball is refined
+        levels = M._cell_levels_by_indexes(np.arange(M.nC))
+        x0 = M.gridCC - M.h_gridded/2
+        x1 = M.gridCC + M.h_gridded/2
+        dist = np.linalg.norm(np.clip(center, x0, x1) - center, axis=1)
+        self.assertTrue(np.all(levels[dist <= radius] == M.max_level))
+        self.assertTrue(np.any(levels < M.max_level))
+
+    def test_refine_box(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        x0, x1 = np.r_[0.25, 0.25, 0.5], np.r_[0.5, 0.75, 0.75]
+        M.refine_box(x0, x1, M.max_level)
+
+        # the box is aligned with the cells, so only the cells inside are
+        # at the finest level
+        levels = M._cell_levels_by_indexes(np.arange(M.nC))
+        inside = np.all((M.gridCC > x0) & (M.gridCC < x1), axis=1)
+        self.assertTrue(np.all(levels[inside] == M.max_level))
+        self.assertTrue(np.all(levels[~inside] < M.max_level))
+
+    def test_refine_line(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        path = np.array([[0.1, 0.1, 0.1], [0.6, 0.8, 0.3], [0.9, 0.2, 0.9]])
+        M.refine_line(path, M.max_level)
+
+        t = np.linspace(0, 1, 101)[:, None]
+        points = np.vstack([path[0] + t*(path[1]-path[0]),
+                            path[1] + t*(path[2]-path[1])])
+        inds = M._get_containing_cell_indexes(points)
+        levels = M._cell_levels_by_indexes(inds)
+        self.assertTrue(np.all(levels == M.max_level))
+
+    def test_refine_surface(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        vertices = np.array([[0.1, 0.1, 0.5], [0.9, 0.1, 0.5],
+                             [0.9, 0.9, 0.5], [0.1, 0.9, 0.5]])
+        simplices = np.array([[0, 1, 2], [0, 2, 3]])
+        M.refine_surface((vertices, simplices), M.max_level, padding=[0, 0, 0.1])
+
+        xy = np.random.rand(100, 2)*0.8 + 0.1
+        for z in [0.41, 0.5, 0.59]:
+            inds = M._get_containing_cell_indexes(np.c_[xy, np.full(100, z)])
+            levels = M._cell_levels_by_indexes(inds)
+            self.assertTrue(np.all(levels == M.max_level))
+        self.assertTrue(np.allclose(M.vol.sum(), 1.0))
+
+    def test_refine_errors(self):
+        M = discretize.TreeMesh([16, 16])
+        tri = [[0.1, 0.1], [0.9, 0.1], [0.5, 0.9]]
+        refines = [
+            lambda levels: M.refine_ball([0.5, 0.5], 0.2, levels),
+            lambda levels: M.refine_box([0.2, 0.2], [0.6, 0.6], levels),
+            lambda levels: M.refine_line([[0.1, 0.1], [0.9, 0.9]], levels),
+            lambda levels: M.refine_surface([tri], levels),
+        ]
+        for refine in refines:
+            # negative levels would wrap around in the C++ tree
+            with self.assertRaises(ValueError):
+                refine(-1)
+        M.refine_ball([0.5, 0.5], 0.2, M.max_level)
+        for refine in refines:
+            with self.assertRaises(ValueError):
+                refine(M.max_level)
+
+    def test_point2index(self):
+        # several roots along y and z
+        M = discretize.TreeMesh([np.ones(8), np.ones(16), np.ones(32)])
+        M.refine_ball([4, 8, 16], 3, M.max_level)
+        M.finalize()
+
+        # includes points on the root boundaries and outside of the mesh
+        points = np.r_[np.random.rand(500, 3)*[10, 18, 34] - 1, M.gridN]
+        inds = M.point2index(points)
+        self.assertTrue(np.all(inds == M.point2index(points, sort=True)))
+
+        clipped = np.clip(points, 0, [8, 16, 32])
+        lo = M.gridCC[inds] - M.h_gridded[inds]/2
+        hi = M.gridCC[inds] + M.h_gridded[inds]/2
+        self.assertTrue(np.all((clipped >= lo - 1e-12) & (clipped <= hi + 1e-12)))
+
+    def test_ray_matrix(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine_ball([0.5, 0.5, 0.5], 0.2, M.max_level)
+        M.finalize()
+
+        starts = np.random.rand(50, 3)*1.4 - 0.2
+        ends = np.random.rand(50, 3)*1.4 - 0.2
+        # along the faces and through the corners of cells
+        starts[:5] = [[0, 0.25, 0.5], [0.5, 0, 0.5], [0, 0, 0], [1, 1, 1], [0.5, 0.5, 0.5]]
+        ends[:5] = [[1, 0.25, 0.5], [0.5, 1, 0.5], [1, 1, 1], [0, 0, 0], [0.5, 0.5, 0.5]]
+        G = M.get_ray_matrix(starts, ends)
+
+        # the lengths add up to the part of each segment inside of the mesh
+        t = np.linspace(0, 1, 20001)
+        for i in range(50):
+            p = starts[i] + t[:, None]*(ends[i] - starts[i])
+            inside = np.all((p >= 0) & (p <= 1), axis=1)
+            length = inside.mean()*np.linalg.norm(ends[i] - starts[i])
+            self.assertAlmostEqual(G[i].sum(), length, delta=1e-3)
+
+        # and match the tensor mesh of the same cells
+        T = discretize.TensorMesh([16, 16, 16])
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine(M.max_level)
+        G = M.get_ray_matrix(starts, ends)
+        order = np.lexsort(M.gridCC.T)
+        self.assertTrue(np.allclose(
+            G[:, order].toarray(), T.get_ray_matrix(starts, ends).toarray()
+        ))
+
+    def test_transfer_matrix(self):
+        M1 = discretize.TreeMesh([16, 16, 16])
+        M1.refine_ball([0.3, 0.3, 0.3], 0.2, M1.max_level)
+        M2 = discretize.TreeMesh([16, 16, 16])
+        M2.refine_ball([0.6, 0.6, 0.6], 0.3, M2.max_level)
+
+        # averages that conserve the integral of the model
+        P = M1.get_transfer_matrix(M2)
+        self.assertEqual(P.shape, (M2.nC, M1.nC))
+        self.assertTrue(np.allclose(P.sum(axis=1), 1))
+        self.assertTrue(np.allclose(M2.vol @ P, M1.vol))
+
+        # the cell of M1 containing the center of each cell of M2
+        P = M1.get_transfer_matrix(M2, kind='nearest')
+        self.assertTrue(np.all(P.indices == M1.point2index(M2.gridCC)))
+
+        with self.assertRaises(ValueError):
+            M1.get_transfer_matrix(discretize.TreeMesh([8, 8, 8]))
+        with self.assertRaises(ValueError):
+            M1.get_transfer_matrix(M2, kind='linear')
+
+    def test_get_slice(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine_ball([0.3, 0.3, 0.3], 0.2, M.max_level)
+        slice_mesh, index = M.get_slice('y', 5)
+        self.assertEqual(slice_mesh.dim, 2)
+        self.assertEqual(len(index), slice_mesh.nC)
+        # each slice cell lies in its 3D cell
+        self.assertTrue(np.allclose(M.gridCC[index][:, [0, 2]], slice_mesh.gridCC))
+        self.assertTrue(np.all(np.abs(M.gridCC[index][:, 1] - 5.5/16) < M.h_gridded[index, 1]/2))
+        # the slice is cached until the mesh changes
+        self.assertIs(M.get_slice('Y', 5)[0], slice_mesh)
+        M._clear_cache()
+        self.assertIsNot(M.get_slice('Y', 5)[0], slice_mesh)
+        with self.assertRaises(ValueError):
+            M.get_slice('w', 5)
+
+        # moving the mesh moves its slices
+        slice_mesh = M.get_slice('Z', 5)[0]
+        M.x0 = [10, 10, 10]
+        moved = M.get_slice('Z', 5)[0]
+        self.assertIsNot(moved, slice_mesh)
+        self.assertTrue(np.allclose(moved.x0, [10, 10]))
+        self.assertTrue(np.allclose(moved.gridCC, slice_mesh.gridCC + 10))
+
+    def test_operator_cache(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine_ball([0.3, 0.3, 0.3], 0.2, M.max_level)
+        C = M.edgeCurl
+        self.assertIn('edgeCurl', M.cache_info()['entries'])
+        M.cache_budget = 1
+        self.assertNotIn('edgeCurl', M.cache_info()['entries'])
+        self.assertEqual(abs(M.edgeCurl - C).max(), 0)
+        M.cache_budget = None
+        M.clear_cache('edge*')
+        self.assertNotIn('edgeCurl', M.cache_info()['entries'])
+        M._clear_cache()
+        self.assertEqual(M.cache_info()['nbytes'], 0)
+
+    def test_disk_cache(self):
+        def mesh():
+            M = discretize.TreeMesh([16, 16, 16])
+            M.refine_ball([0.3, 0.3, 0.3], 0.2, M.max_level)
+            return M
+
+        directory = tempfile.mkdtemp()
+        try:
+            M = mesh()
+            M.cache_dir = directory
+            C = M.edgeCurl
+            R = M._deflate_edges_x()
+            self.assertIs(M._deflate_edges_x(), R)
+            self.assertGreater(M.cache_info()['disk_saves'], 0)
+
+            M2 = mesh()
+            M2.cache_dir = directory
+            self.assertEqual(M2.fingerprint, M.fingerprint)
+            self.assertEqual(abs(M2.edgeCurl - C).max(), 0)
+            self.assertEqual(abs(M2._deflate_edges_x() - R).max(), 0)
+            self.assertEqual(M2.cache_info()['disk_loads'], 2)
+
+            # changing the structure changes the fingerprint
+            fingerprint = M2.fingerprint
+            M2.coarsen(M2.max_level - 1)
+            self.assertNotEqual(M2.fingerprint, fingerprint)
+            self.assertEqual(M2.edgeCurl.shape, (M2.nF, M2.nE))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_cache_fingerprint_before_refine(self):
+        directory = tempfile.mkdtemp()
+        try:
+            meshes = []
+            for level in [3, 4]:
+                M = discretize.TreeMesh([16, 16])
+                M.cache_dir = directory
+                empty = M.fingerprint
+                M.refine(level)
+                self.assertNotEqual(M.fingerprint, empty)
+                self.assertEqual(M.faceDiv.shape, (M.nC, M.nF))
+                meshes.append(M)
+            self.assertNotEqual(meshes[0].fingerprint, meshes[1].fingerprint)
+
+            # every change of an unfinalized tree changes the fingerprint
+            M = discretize.TreeMesh([16, 16])
+            fingerprints = [M.fingerprint]
+            M.refine(2, finalize=False)
+            fingerprints.append(M.fingerprint)
+            M.insert_cells([0.3, 0.3], M.max_level, finalize=False)
+            fingerprints.append(M.fingerprint)
+            M.refine_ball([0.7, 0.7], 0.1, M.max_level - 1, finalize=False)
+            fingerprints.append(M.fingerprint)
+            M.finalize()
+            self.assertEqual(len(set(fingerprints)), 4)
+            self.assertEqual(M.fingerprint, fingerprints[-1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cell_adjacency(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine_ball([0.3, 0.3, 0.3], 0.2, M.max_level)
+        A = M.cell_adjacency
+        self.assertEqual((A != A.T).nnz, 0)
+        indptr, indices = M.cell_neighbors
+        self.assertEqual(A.nnz, len(indices))
+        rows = np.repeat(np.arange(M.nC), np.diff(indptr).reshape(M.nC, -1).sum(1))
+        self.assertTrue(np.all(A[rows, indices] == 1))
+
+        # the shared areas add up to the interior faces of the unit cube
+        A = [M.get_cell_adjacency(d, weighted=True) for d in 'xyz']
+        self.assertAlmostEqual(A[0].sum(), 2*(M.area[:M.nFx].sum() - 2))
+        self.assertAlmostEqual(A[2].sum(), 2*(M.area[-M.nFz:].sum() - 2))
+        total = M.get_cell_adjacency(weighted=True)
+        self.assertAlmostEqual(abs(total - A[0] - A[1] - A[2]).sum(), 0)
+        with self.assertRaises(ValueError):
+            M.get_cell_adjacency('w')
+
+    def test_volume_average(self):
+        tree = discretize.TreeMesh([16, 16, 16])
+        tree.refine_ball([0.3, 0.3, 0.3], 0.2, tree.max_level)
+        tensor = discretize.TensorMesh([7, 5, 6])
+
+        model = np.random.rand(tensor.nC)
+        P = discretize.utils.volume_average(tensor, tree)
+        self.assertEqual(P.shape, (tree.nC, tensor.nC))
+        self.assertTrue(np.allclose(tree.vol @ (P*model), tensor.vol @ model))
+        out = discretize.utils.volume_average(tensor, tree, model)
+        self.assertTrue(np.allclose(P*model, out))
+
+        model = np.random.rand(tree.nC)
+        P = discretize.utils.volume_average(tree, tensor)
+        self.assertTrue(np.allclose(P.sum(axis=1), 1))
+        self.assertTrue(np.allclose(tensor.vol @ (P*model), tree.vol @ model))
+        out = discretize.utils.volume_average(tree, tensor, model)
+        self.assertTrue(np.allclose(P*model, out))
+
+        # the finest tensor grid reproduces the tree model exactly
+        tensor = discretize.TensorMesh([16, 16, 16])
+        P_to = discretize.utils.volume_average(tree, tensor)
+        P_back = discretize.utils.volume_average(tensor, tree)
+        self.assertTrue(np.allclose(P_back*(P_to*model), model))
+
+    def test_ordering(self):
+        points = np.random.rand(50, 3)
+        M0 = discretize.TreeMesh([16, 16, 16])
+        M0.insert_cells(points, np.full(50, 4))
+        for ordering in ['morton', 'hilbert']:
+            M = discretize.TreeMesh([16, 16, 16], ordering=ordering)
+            M.insert_cells(points, np.full(50, 4))
+            P = {loc: M.get_ordering_permutation(loc)
+                 for loc in ['CC', 'N', 'Fz', 'Ex', 'F', 'E']}
+            self.assertTrue(np.allclose(M.gridCC[P['CC']], M0.gridCC))
+            self.assertTrue(np.allclose(M.gridN[P['N']], M0.gridN))
+            self.assertTrue(np.allclose(M.gridFz[P['Fz']], M0.gridFz))
+            self.assertTrue(np.allclose(M.gridEx[P['Ex']], M0.gridEx))
+
+            D = M.faceDiv[P['CC']][:, P['F']]
+            self.assertEqual((D - M0.faceDiv).nnz, 0)
+            C = M.edgeCurl[P['F']][:, P['E']]
+            self.assertEqual((C - M0.edgeCurl).nnz, 0)
+            G = M.nodalGrad[P['E']][:, P['N']]
+            self.assertEqual((G - M0.nodalGrad).nnz, 0)
+
+    def test_adapt(self):
+        def linear_fields(M):
+            # linear fields that each type of item can represent exactly
+            F = [M.gridFx[:, 0], M.gridFy[:, 1], M.gridFz[:, 2]]
+            E = [M.gridEx[:, [1, 2]], M.gridEy[:, [0, 2]], M.gridEz[:, [0, 1]]]
+            return {
+                'N': M.gridN.sum(1),
+                'F': np.concatenate(F),
+                'E': np.concatenate([e.sum(1) for e in E]),
+            }
+
+        M = discretize.TreeMesh([16, 16, 16], ordering='hilbert')
+        M.refine_ball([0.5, 0.5, 0.5], 0.2, 3)
+        old = linear_fields(M)
+        P = M.adapt(lambda cell: 4 if cell.center[2] < 0.25 else 0)
+
+        M2 = discretize.TreeMesh([16, 16, 16], ordering='hilbert')
+        M2.refine_ball([0.5, 0.5, 0.5], 0.2, 3, finalize=False)
+        M2.refine(lambda cell: 4 if cell.center[2] < 0.25 else 0)
+        self.assertTrue(np.allclose(M.gridCC, M2.gridCC))
+        self.assertEqual((M.edgeCurl - M2.edgeCurl).nnz, 0)
+
+        new = linear_fields(M)
+        for loc in ['N', 'F', 'E']:
+            self.assertTrue(np.allclose(P[loc]*old[loc], new[loc]))
+        self.assertTrue(np.allclose(P['CC'].sum(axis=1), 1))
+
+    def test_coarsen(self):
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine(M.max_level)
+        M.coarsen(np.random.randint(0, M.max_level + 1, M.nC))
+        M2 = discretize.TreeMesh([16, 16, 16])
+        M2.__setstate__(M.__getstate__())
+        self.assertEqual(M.ntN, M2.ntN)
+        self.assertEqual(M.ntE, M2.ntE)
+        self.assertEqual((M.edgeCurl - M2.edgeCurl).nnz, 0)
+
+    def test_adapt_moving_front(self):
+        def front(x):
+            def func(cell):
+                return 4 if abs(cell.center[0] - x) < 0.1 else 1
+            return func
+
+        M = discretize.TreeMesh([16, 16, 16])
+        M.refine(front(0.2))
+        gridCC = M.gridCC
+        for x in [0.4, 0.6, 0.8, 0.2]:
+            vol, v = M.vol, np.random.rand(M.nC)
+            gridFx = M.gridFx
+            P = M.adapt(front(x), coarsen=front(x))
+            self.assertAlmostEqual((P['CC']*v).dot(M.vol), v.dot(vol))
+            self.assertTrue(np.allclose(
+                P['F'][:M.nFx, :gridFx.shape[0]]*gridFx[:, 0], M.gridFx[:, 0]
+            ))
+        # the mesh follows the front instead of growing with it
+        self.assertTrue(np.allclose(M.gridCC, gridCC))
+
+    def test_topology(self):
+        M = discretize.TreeMesh([8, 8, 8])
+        M.refine_ball([0.5, 0.5, 0.5], 0.2, M.max_level)
+        M.finalize()
+
+        ind, cells = M.cell_neighbors
+        off_e = np.repeat([0, M.ntEx, M.ntEx + M.ntEy], 4)
+        off_f = np.repeat([0, M.ntFx, M.ntFx + M.ntFy], 2)
+        for cell in M:
+            i = cell.index
+            self.assertEqual(list(M.cell_nodes[i]), cell.nodes)
+            self.assertEqual(list(M.cell_edges[i] - off_e), cell.edges)
+            self.assertEqual(list(M.cell_faces[i] - off_f), cell.faces)
+            for j, nb in enumerate(cell.neighbors):
+                nb = [] if nb == -1 else np.atleast_1d(nb).tolist()
+                self.assertEqual(list(cells[ind[6*i+j]:ind[6*i+j+1]]), nb)
+
+        # both sides of a hanging face are known, and its cells are neighbors
+        fc = M.face_cells
+        hanging = np.r_[
+            np.arange(M.nFx, M.ntFx),
+            M.ntFx + np.arange(M.nFy, M.ntFy),
+            M.ntFx + M.ntFy + np.arange(M.nFz, M.ntFz)
+        ]
+        self.assertTrue(np.all(fc[hanging] >= 0))
+        levels = M._cell_levels_by_indexes(fc[hanging].ravel()).reshape(-1, 2)
+        self.assertTrue(np.all(np.abs(levels[:, 0] - levels[:, 1]) == 1))
+
     def test_faceDiv(self):
 
         hx, hy, hz = np.r_[1., 2, 3, 4], np.r_[5., 6, 7, 8], np.r_[9., 10, 11, 12]
@@ -216,5 +216,38 @@ class TestSerialize(unittest.TestCase):
         self.assertTrue(np.allclose(np.array(mesh0.h), np.array(mesh1.h)))
         print('json serialize 3D is working')
 
+    def test_copy_and_old_format(self):
+        mesh0 = discretize.TreeMesh([8, 16, 8])
+        mesh0.refine_ball([0.3, 0.6, 0.5], 0.2, mesh0.max_level)
+
+        mesh1 = mesh0.copy()
+        self.assertTrue(np.allclose(mesh0.gridCC, mesh1.gridCC))
+        self.assertEqual((mesh0.faceDiv != mesh1.faceDiv).nnz, 0)
+
+        # the cells are listed by default, as in earlier versions
+        mesh_dict = mesh0.serialize()
+        inds, levels = mesh0.__getstate__()
+        self.assertNotIn('tree_structure', mesh_dict)
+        self.assertEqual(mesh_dict['cell_indexes'], inds.tolist())
+        self.assertEqual(mesh_dict['cell_levels'], levels.tolist())
+        mesh2 = discretize.TreeMesh.deserialize(mesh_dict)
+        self.assertTrue(np.allclose(mesh0.gridCC, mesh2.gridCC))
+
+        # the compact bitstream is opt in and versioned
+        mesh_dict = mesh0.serialize(compact=True)
+        self.assertNotIn('cell_indexes', mesh_dict)
+        self.assertEqual(mesh_dict['tree_format'], 1)
+        mesh2 = discretize.TreeMesh.deserialize(
+            json.loads(json.dumps(mesh_dict))
+        )
+        self.assertTrue(np.allclose(mesh0.gridCC, mesh2.gridCC))
+        mesh_dict['tree_format'] = 2
+        with self.assertRaises(ValueError):
+            discretize.TreeMesh.deserialize(mesh_dict)
+
+        # the structure can only be set on an unrefined mesh
+        with self.assertRaises(ValueError):
+            mesh1.__setstate__(mesh0._get_structure())
+
 if __name__ == '__main__':
     unittest.main()
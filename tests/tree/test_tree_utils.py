@@ -39,6 +39,42 @@ class TestRefineOcTree(unittest.TestCase):
 
         self.assertTrue(residual < 3)
 
+    def test_workers(self):
+        rng = np.random.RandomState(18)
+        xyz = np.c_[rng.uniform(-1, 1, (50, 2)), rng.uniform(-0.1, 0.1, 50)]
+        for method in ['radial', 'surface']:
+            meshes = []
+            for workers in [1, 2]:
+                mesh = discretize.TreeMesh([np.ones(32)/8]*3, x0='CCC')
+                meshes.append(meshutils.refine_tree_xyz(
+                    mesh, xyz, octree_levels=[1, 1], method=method,
+                    max_distance=0.5, finalize=True, workers=workers
+                ))
+            self.assertGreater(meshes[0].nC, 32**3/8**3)
+            self.assertEqual(meshes[0].nC, meshes[1].nC)
+            self.assertTrue(np.all(meshes[0].gridCC == meshes[1].gridCC))
+
+    def test_point_distance_criterion(self):
+        points = np.random.rand(20, 3)
+        mesh = discretize.TreeMesh([32, 32, 32])
+        criterion = meshutils.point_distance_criterion(
+            points, [0.05, 0.2], [5, 3], default_level=1
+        )
+        mesh.refine_vectorized(criterion)
+
+        levels = mesh._cell_levels_by_indexes(range(mesh.nC))
+        r = np.min(
+            np.linalg.norm(mesh.gridCC[:, None] - points[None], axis=2), axis=1
+        )
+        self.assertTrue(np.all(levels[r < 0.05] == 5))
+        self.assertTrue(np.all(levels[r < 0.2] >= 3))
+        self.assertTrue(np.all(levels >= 1))
+
+        # the criterion evaluated on the final cells
+        self.assertTrue(np.all(
+            criterion(mesh.gridCC, mesh.h_gridded, levels) <= levels
+        ))
+
     def test_box(self):
         dx = 0.25
         dl = 10
@@ -102,6 +138,26 @@ class TestRefineOcTree(unittest.TestCase):
 
         self.assertTrue(residual < 5)
 
+    def test_surface_counts(self):
+        # pin the refinement of the surface method
+        x = np.linspace(0, 1, 11)
+        xz = np.c_[x, 0.2 + 0.6*x]
+        mesh = discretize.TreeMesh([64, 64])
+        mesh = meshutils.refine_tree_xyz(
+            mesh, xz, octree_levels=[1, 1], method='surface', finalize=True
+        )
+        self.assertEqual(mesh.nC, 364)
+
+        x, y = np.meshgrid(np.linspace(-1, 1, 21), np.linspace(-1, 1, 21))
+        z = 0.3*np.sin(np.pi*x)*np.cos(np.pi*y)
+        xyz = np.c_[x.ravel(), y.ravel(), z.ravel()]
+        mesh = discretize.TreeMesh([np.ones(32)/8]*3, x0='CCC')
+        mesh = meshutils.refine_tree_xyz(
+            mesh, xyz, octree_levels=[1, 1], octree_levels_padding=[1, 2],
+            method='surface', finalize=True
+        )
+        self.assertEqual(mesh.nC, 1982)
+
     def test_errors(self):
         dx = 0.25
         rad = 10